@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018-2021 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+This script compares the HDF5 compression filters that can be used when saving data cubes. A synthetic PWS cube is saved
+with each setting, both in the 16-bit fixed point format used for analysis results and as 32-bit floats. The write speed
+and read speed (in MB/s of the uncompressed float32 data) and the compression ratio are printed. The Blosc and Zstd
+filters are skipped if `hdf5plugin` is not installed.
+"""
+
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+import pwspy.dataTypes as pwsdt
+
+
+def syntheticCube(shape=(512, 512, 101), seed=0) -> pwsdt.PwsCube:
+    """A cube with smooth spectra that vary across the image, plus noise. Similar to a normalized PWS acquisition."""
+    rng = np.random.default_rng(seed)
+    wavelengths = np.linspace(500, 700, shape[2])
+    opd = rng.uniform(1, 10, shape[:2] + (1,)).astype(np.float32)
+    data = 1 + 0.1 * np.sin(2 * np.pi * opd * 1000 / wavelengths[None, None, :]).astype(np.float32)
+    data += 0.01 * rng.standard_normal(shape, dtype=np.float32)
+    md = pwsdt.PwsMetaData({'system': 'benchmark', 'time': '01-01-2020 01:01:01', 'exposure': 100.0, 'pixelSizeUm': None,
+                            'binning': 1, 'wavelengths': wavelengths.tolist()}, filePath=None, fileFormat=None)
+    return pwsdt.PwsCube(data, md)
+
+
+if __name__ == '__main__':
+    cube = syntheticCube()
+    settings = {
+        'none': pwsdt.HDFCompression(),
+        'shuffle': pwsdt.HDFCompression(shuffle=True),
+        'lzf': pwsdt.HDFCompression('lzf'),
+        'lzf+shuffle': pwsdt.HDFCompression('lzf', shuffle=True),
+        'gzip1+shuffle': pwsdt.HDFCompression('gzip', level=1, shuffle=True),
+        'gzip4+shuffle': pwsdt.HDFCompression('gzip', level=4, shuffle=True),
+        'gzip9+shuffle': pwsdt.HDFCompression('gzip', level=9, shuffle=True),
+        'blosc-lz4+shuffle': pwsdt.HDFCompression('blosc', shuffle=True),
+        'blosc-zstd+shuffle': pwsdt.HDFCompression('blosc', shuffle=True, bloscCompressor='zstd'),
+        'zstd+shuffle': pwsdt.HDFCompression('zstd', shuffle=True),
+    }
+    rawMB = cube.data.nbytes / 1e6
+    print(f"Cube shape: {cube.data.shape}, {rawMB:.0f} MB as float32")
+    print(f"{'filter':20} {'format':12} {'write MB/s':>10} {'read MB/s':>10} {'ratio':>7}")
+    with tempfile.TemporaryDirectory() as tempDir:
+        path = os.path.join(tempDir, 'benchmark.h5')
+        for name, compression in settings.items():
+            try:
+                compression.toDatasetKwargs()
+            except ImportError:
+                print(f"{name:20} skipped, `hdf5plugin` is not installed.")
+                continue
+            for fixedPoint in [True, False]:
+                startTime = time.perf_counter()
+                with h5py.File(path, 'w') as hf:
+                    cube.toHdfDataset(hf, 'cube', fixedPointCompression=fixedPoint, compression=compression)
+                writeTime = time.perf_counter() - startTime
+                size = os.path.getsize(path)
+                startTime = time.perf_counter()
+                with h5py.File(path, 'r') as hf:
+                    pwsdt.PwsCube.fromHdfDataset(hf['cube'])
+                readTime = time.perf_counter() - startTime
+                print(f"{name:20} {'fixed point' if fixedPoint else 'float32':12} {rawMB / writeTime:10.0f} {rawMB / readTime:10.0f} {cube.data.nbytes / size:7.2f}")
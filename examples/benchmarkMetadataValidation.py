@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018-2021 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+This script measures the time it takes to construct a metadata object. It compares validating the metadata
+the way it was done before the validators were cached (a new resolver and validator for every object), using the
+cached validator of each class, and skipping validation entirely as is done for metadata loaded from a `MetadataIndex`.
+"""
+
+import copy
+import pathlib
+import timeit
+
+import jsonschema
+
+import pwspy.dataTypes as pwsdt
+from pwspy.dataTypes._metadata import _TupleValidator
+
+if __name__ == '__main__':
+    N = 2000
+    pwsMd = {'system': 'bench', 'time': '01-01-2020 01:01:01', 'exposure': 100.0, 'pixelSizeUm': 0.13, 'binning': 1,
+             'wavelengths': list(range(500, 701, 2)), 'darkCounts': 1957, 'linearityPoly': [0, 1]}
+    dynMd = {'system': 'bench', 'time': '01-01-2020 01:01:01', 'exposure': 20.0, 'pixelSizeUm': 0.13, 'binning': 1,
+             'wavelength': 550, 'times': [i * 20.0 for i in range(200)], 'darkCounts': 1957, 'linearityPoly': [0, 1]}
+    fluorMd = {'system': 'bench', 'time': '01-01-2020 01:01:01', 'exposure': 500.0, 'pixelSizeUm': 0.13, 'binning': 1}
+
+    def uncached(mdClass, md):
+        refResolver = jsonschema.RefResolver(pathlib.Path(mdClass._jsonSchemaPath).as_uri(), None)
+        jsonschema.validate(instance=md, schema=mdClass._jsonSchema, resolver=refResolver, cls=_TupleValidator)
+        return mdClass(md, skipValidation=True)
+
+    for mdClass, md in [(pwsdt.PwsMetaData, pwsMd), (pwsdt.DynMetaData, dynMd), (pwsdt.FluorMetaData, fluorMd)]:
+        mdClass(copy.deepcopy(md))  # Make sure that the cached validator has been built before timing.
+        times = {
+            'uncached': timeit.timeit(lambda: uncached(mdClass, copy.deepcopy(md)), number=N),
+            'cached': timeit.timeit(lambda: mdClass(copy.deepcopy(md)), number=N),
+            'skipValidation': timeit.timeit(lambda: mdClass(copy.deepcopy(md), skipValidation=True), number=N)
+        }
+        print(f"{mdClass.__name__}: " + ", ".join(f"{k}={v / N * 1e6:.1f} us" for k, v in times.items()))
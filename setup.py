@@ -35,7 +35,7 @@ setup(name='pwspy',
       author='Nick Anthony',
       author_email='nicholas.anthony@northwestern.edu',
       url='https://github.com/BackmanLab/PWSpy',
-      python_requires='>=3.7',
+      python_requires='>=3.8',
       install_requires=['numpy',
                         'scipy',
                         'matplotlib',
@@ -43,7 +43,7 @@ setup(name='pwspy',
                         'psutil',
                         'shapely',
                         'pandas',
-                        'h5py',
+                        'h5py>=3.5',  # For the `locking` argument of `h5py.File`.
                         'jsonschema',
                         'opencv-python', #opencv is required but naming differences between conda and pip seem to cause issues. Maybe should be commented out?
                         'scikit-image',
@@ -37,18 +37,19 @@ Inheritance
 
 """
 import os
-from ._abstract import AbstractAnalysisSettings, AbstractAnalysis, AbstractAnalysisResults, AbstractHDFAnalysisResults
+from ._abstract import AbstractAnalysisSettings, AbstractAnalysis, AbstractAnalysisResults, AbstractHDFAnalysisResults, LazyField
+from ._directoryStore import DirectoryStore, DirectoryStoreDataset
 from . import pws
 from . import dynamics
 from . import compilation
-from ._utility import ParallelRunner
+from ._utility import ParallelRunner, AnalysisFailure
 # TODO settings are missing reference IDtag but they exist in the results. Results and settings both contain extra reflectance idTag, reduntant
 
 resources = os.path.join(os.path.split(__file__)[0], '_resources')
 defaultSettingsPath = os.path.join(resources, 'defaultAnalysisSettings')
 
 __all__ = ['AbstractAnalysisSettings', 'AbstractAnalysis', 'AbstractAnalysisResults',
-           'AbstractHDFAnalysisResults', 'resources', 'defaultSettingsPath', 'pws', 'dynamics', 'compilation', 'ParallelRunner']
+           'AbstractHDFAnalysisResults', 'LazyField', 'DirectoryStore', 'DirectoryStoreDataset', 'resources', 'defaultSettingsPath', 'pws', 'dynamics', 'compilation', 'ParallelRunner', 'AnalysisFailure']
 
 
 
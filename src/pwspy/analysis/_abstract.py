@@ -17,10 +17,13 @@
 
 from __future__ import annotations
 
+import enum
 import logging
 from abc import ABC, abstractmethod
 import json
+import os
 import os.path as osp
+import shutil
 import h5py
 import numpy as np
 import typing as t_
@@ -28,10 +31,11 @@ import pandas as pd
 
 from pwspy import __version__ as pwspyversion
 from pwspy.analysis.warnings import AnalysisWarning
+from pwspy.analysis._directoryStore import DirectoryStore
 from pwspy.utility.fileIO import processParallel
 from pwspy.utility.misc import cached_property
 if t_.TYPE_CHECKING:
-    from pwspy.dataTypes import ICBase, MetaDataBase
+    from pwspy.dataTypes import ICBase, MetaDataBase, Roi, HDFCompression
 
 
 class AbstractAnalysisSettings(ABC):
@@ -191,27 +195,104 @@ def _getFromDict(func):
     return newFunc
 
 
+class LazyField:
+    """A read-only view of an array field of analysis results. Data is only read from file when the view is indexed,
+    and only the region indexed is read. Get one of these with `AbstractHDFAnalysisResults.getLazyField`.
+
+    Args:
+        data: The `h5py.Dataset` or numpy array that is being viewed.
+        index: For 3D data cubes, the values of the index of the last axis. e.g. wavenumbers.
+        decoder: A function that takes the dataset and a tuple of slices and returns the decoded data for that region.
+            If `None` then the dataset is simply indexed.
+    """
+    def __init__(self, data: t_.Union[h5py.Dataset, np.ndarray], index: t_.Optional[t_.Tuple[float, ...]] = None,
+                 decoder: t_.Optional[t_.Callable[[h5py.Dataset, t_.Tuple[slice, ...]], np.ndarray]] = None):
+        self._data = data
+        self.index = index
+        self._decoder = decoder
+
+    @property
+    def shape(self) -> t_.Tuple[int, ...]:
+        """The shape of the full data array."""
+        return self._data.shape
+
+    def __getitem__(self, region: t_.Tuple[slice, ...]) -> np.ndarray:
+        if self._decoder is None:
+            return np.asarray(self._data[region])
+        else:
+            return self._decoder(self._data, region)
+
+    def __array__(self, dtype=None):
+        arr = self[()]
+        return arr if dtype is None else arr.astype(dtype)
+
+    def readRoi(self, roi: Roi) -> t_.Tuple[np.ndarray, np.ndarray]:
+        """Read only the region of the data that is within the bounding box of an ROI.
+
+        Args:
+            roi: The ROI to read data for.
+
+        Returns:
+            A tuple containing: The data within the bounding box of the ROI, The mask of the ROI cropped to the same bounding box.
+        """
+        return self[roi.getBoundingBox()], roi.croppedMask
+
+    def getRoiValues(self, roi: Roi) -> np.ndarray:
+        """
+        Args:
+            roi: The ROI to read data for.
+
+        Returns:
+            The values of the data for each pixel in `roi`. For a 2D image this is 1D. For a 3D cube this is (pixels, index).
+        """
+        data, mask = self.readRoi(roi)
+        return data[mask]
+
+    def getMeanSpectra(self, roi: Roi) -> t_.Tuple[np.ndarray, np.ndarray]:
+        """Equivalent to `ICBase.getMeanSpectra` but only the data within the bounding box of `roi` is read.
+
+        Args:
+            roi: The ROI to average over.
+
+        Returns:
+            The average spectra within the region, the standard deviation of the spectra within the region
+        """
+        values = self.getRoiValues(roi)
+        return values.mean(axis=0), values.std(axis=0)
+
+
 class AbstractHDFAnalysisResults(AbstractAnalysisResults):
     """
     This abstract class implements methods of `AbstractAnalysisResults` for an object that can be saved and loaded to/from an HDF file.
     And the `fileName2Name` method which does the opposite operation. Can be instantiated with one of the two constructor arguments.
     The constructor should not be run directly, it should only be used by the `create` and `load` class methods.
+    Results can alternatively be saved to a `DirectoryStore`, a Zarr format directory with a separate file for each chunk
+    of each dataset, see `FileFormats`.
 
     Args:
-        file: To load from file provide the `h5py.File`.
+        file: To load from file provide the `h5py.File` or `DirectoryStore`.
         variablesDict: To create a new object from variables, provide a dictionary keyed by all the field names.
         analysisName: Optionally store the name of the analysis.
     """
+    class FileFormats(enum.Enum):
+        """The formats that analysis results can be saved in."""
+        Hdf = enum.auto()  # A single HDF5 file.
+        DirectoryStore = enum.auto()  # A directory of chunk files. See `DirectoryStore`.
+
+    StoreSuffix = '.zarr'  # The file extension of the directories of results saved as a `DirectoryStore`.
+
     @staticmethod
     def FieldDecorator(func):
         """Decorate functions in subclasses that access their fields from the HDF file with this decorator. It will:
         1: Make it so the data is load from disk on the first access and stored in memory for every further access.
         2: Report an understandable error if the field isn't found in the HDF file.
-        3: Make the accessors work even if the the object isn't associated with an HDF file."""
+        3: Make the accessors work even if the the object isn't associated with an HDF file.
+        Accessors should only use the parts of the `h5py` interface that `DirectoryStore` also implements, so that they
+        work with both file formats."""
         return cached_property(_clearError(_getFromDict(func)))
 
     #TODO this holds onto the reference to the h5py.File meaning that the file can't be deleted until the object has been deleted. Maybe that's good. but it causes some problems.
-    def __init__(self, file: t_.Optional[h5py.File] = None, variablesDict: t_.Optional[dict] = None, analysisName: t_.Optional[str] = None):
+    def __init__(self, file: t_.Union[None, h5py.File, DirectoryStore] = None, variablesDict: t_.Optional[dict] = None, analysisName: t_.Optional[str] = None):
         if file is not None:
             assert variablesDict is None
         elif variablesDict is not None:
@@ -260,47 +341,142 @@ class AbstractHDFAnalysisResults(AbstractAnalysisResults):
         """
         pass
 
-    def toHDF(self, directory: str, name: str, overwrite: bool = False, compression: str = None):
+    @classmethod
+    def name2StoreName(cls, name: str) -> str:
+        """
+
+        Args:
+            name: An analysis name.
+        Returns:
+            The corresponding directory name for results saved as a `DirectoryStore`.
+        """
+        return osp.splitext(cls.name2FileName(name))[0] + cls.StoreSuffix
+
+    @classmethod
+    def storeName2Name(cls, storeName: str) -> str:
+        """
+
+        Args:
+            storeName: The directory name that the `DirectoryStore` was saved as.
+
+        Returns:
+            The analysis name.
+        """
+        if not storeName.endswith(cls.StoreSuffix):
+            raise ValueError(f"{storeName} is not the name of an analysis directory store.")
+        return cls.fileName2Name(storeName[:-len(cls.StoreSuffix)] + osp.splitext(cls.name2FileName(''))[1])
+
+    def toHDF(self, directory: str, name: str, overwrite: bool = False, compression: t_.Union[None, str, int, HDFCompression] = None,
+              fileFormat: FileFormats = FileFormats.Hdf):
         """
         Save the AnalysisResults object to an HDF file in `directory`. The name of the file will be determined by `name`. If you want to know what the full file name
-        will be you can use this class's `name2FileName` method.
+        will be you can use this class's `name2FileName` method, or `name2StoreName` for the `DirectoryStore` format.
 
         Args:
             directory: The path to the folder to save the file in.
             name: The name of the analysis. This determines the file name.
-            overwrite: If `True` then any existing file of the same name will be replaced.
-            compression: The value of this argument will be passed to h5py.create_dataset for numpy arrays. See h5py documentation for available options.
+            overwrite: If `True` then any existing file of the same name will be replaced, in either format.
+            compression: The compression filter used for every array and data cube in the file. Either an `HDFCompression`,
+                the name of a filter (e.g. 'gzip', 'lzf'), or a gzip level. Data cubes are also saved in 16-bit fixed point format.
+                Only gzip compression is available for the `DirectoryStore` format.
+            fileFormat: The format to save the results in. `FileFormats.Hdf` saves a single HDF5 file. `FileFormats.DirectoryStore`
+                saves a directory of separate chunk files which can be read without holding any file open.
         """
-        from pwspy.dataTypes import ICBase  # Need this for instance checking
+        from pwspy.dataTypes import HDFCompression
+        compression = HDFCompression.fromValue(compression)
+        if not isinstance(fileFormat, self.FileFormats):
+            raise ValueError(f"File format {fileFormat} is not supported.")
+        if fileFormat is self.FileFormats.DirectoryStore and compression.filter not in (None, 'gzip'):  # Check this before anything is deleted.
+            raise ValueError(f"Compression filter {compression.filter} is not supported by the directory store. Only gzip is available.")
         fileName = osp.join(directory, self.name2FileName(name))
-        if (not overwrite) and osp.exists(fileName):
-            raise OSError(f'{fileName} already exists.')
-        with open(fileName, 'wb') as pythonFile:
-            with h5py.File(pythonFile, 'w', driver='fileobj') as hf:  # Using the default driver causes write errors when writing from windows to a Samba shared server. Using a reference to a python `File Object` solves this issue.
-                # Save version
-                hf.create_dataset('pwspy_version', data=np.string_(self._currentmoduleversion))
-                # Save fields defined by implementing subclass
-                for field in self.fields():
-                    k = field
-                    v = getattr(self, field)
-                    if isinstance(v, AbstractAnalysisSettings):
-                        v = v.toJsonString() # Convert to string, then string case will then handle saving the string.
-                    elif isinstance(v, dict):  # Save as json. The str case will handle the actual saving.
-                        v = json.dumps(v)
-                    if isinstance(v, str):
-                        hf.create_dataset(k, data=np.string_(v))  # h5py recommends encoding strings this way for compatability.
-                    elif isinstance(v, ICBase):
-                        hf = v.toHdfDataset(hf, k, fixedPointCompression=True)
-                    elif isinstance(v, np.ndarray):
-                        hf.create_dataset(k, data=v, compression=compression)
-                    elif v is None:
-                        pass
-                    else:
-                        raise TypeError(f"Analysis results type {k}, {type(v)} not supported or expected")
+        storeName = osp.join(directory, self.name2StoreName(name))
+        for path in (fileName, storeName):
+            if osp.exists(path):
+                if not overwrite:
+                    raise OSError(f'{path} already exists.')
+                elif osp.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        if fileFormat is self.FileFormats.Hdf:
+            with open(fileName, 'wb') as pythonFile:
+                with h5py.File(pythonFile, 'w', driver='fileobj') as hf:  # Using the default driver causes write errors when writing from windows to a Samba shared server. Using a reference to a python `File Object` solves this issue.
+                    self._writeFields(hf, compression)
+        else:
+            try:
+                with DirectoryStore(storeName, 'w') as store:
+                    self._writeFields(store, compression)
+            except BaseException:
+                shutil.rmtree(storeName, ignore_errors=True)  # Don't leave a partial store that `load` and `getAnalyses` would find.
+                raise
+
+    def _writeFields(self, hf: t_.Union[h5py.File, DirectoryStore], compression: HDFCompression):
+        """Save the version and each of the `fields` to an open HDF file or `DirectoryStore`."""
+        from pwspy.dataTypes import ICBase  # Need this for instance checking
+        # Save version
+        hf.create_dataset('pwspy_version', data=np.string_(self._currentmoduleversion))
+        # Save fields defined by implementing subclass
+        for field in self.fields():
+            k = field
+            v = getattr(self, field)
+            if isinstance(v, AbstractAnalysisSettings):
+                v = v.toJsonString() # Convert to string, then string case will then handle saving the string.
+            elif isinstance(v, dict):  # Save as json. The str case will handle the actual saving.
+                v = json.dumps(v)
+            if isinstance(v, str):
+                hf.create_dataset(k, data=np.string_(v))  # h5py recommends encoding strings this way for compatability.
+            elif isinstance(v, ICBase):
+                hf = v.toHdfDataset(hf, k, fixedPointCompression=True, compression=compression)
+            elif isinstance(v, np.ndarray):
+                hf.create_dataset(k, data=v, chunks=self._getHdfChunks(v.shape), **compression.toDatasetKwargs())
+            elif v is None:
+                pass
+            else:
+                raise TypeError(f"Analysis results type {k}, {type(v)} not supported or expected")
+
+    @staticmethod
+    def _getHdfChunks(shape: t_.Tuple[int, ...]) -> t_.Optional[t_.Tuple[int, ...]]:
+        """Images are saved in chunks of 256x256 tiles so that a small region can be read without reading the whole image."""
+        if len(shape) != 2 or 0 in shape:
+            return None  # Let h5py decide.
+        return tuple(min(256, i) for i in shape)
+
+    def getLazyField(self, field: str) -> LazyField:
+        """Get a lazy view of one of the `fields` of the results. Unlike the normal accessors, which read the whole array
+        into memory, the view only reads the region of the data that is indexed. This is useful when only a small region
+        (e.g. an ROI) of a large dataset is needed.
+
+        Args:
+            field: The name of the field to access.
+
+        Returns:
+            A view of the field's data array. If the field has already been loaded into memory, or if these results
+                aren't associated with a file, then the view wraps the in-memory array.
+        """
+        from pwspy.dataTypes import ICBase
+        if field not in self.fields():
+            raise ValueError(f"{field} is not a field of {self.__class__.__name__}")
+        if self.file is None or field in self.__dict__:  # The field is available in memory. `cached_property` stores values in `__dict__`
+            v = getattr(self, field)
+            if isinstance(v, ICBase):
+                return LazyField(v.data, v.index)
+            elif isinstance(v, np.ndarray):
+                return LazyField(v)
+            elif v is None:
+                raise KeyError(f"The analysis does not contain a {field} item.")
+            else:
+                raise TypeError(f"Field {field} of type {type(v)} is not an array.")
+        if field not in self.file:
+            raise KeyError(f"The analysis file does not contain a {field} item.")
+        dset = self.file[field]
+        if 'index' in dset.attrs:  # This dataset was saved by `ICBase.toHdfDataset`
+            return LazyField(dset, tuple(dset.attrs['index']), decoder=ICBase._decodeHdfData)
+        else:
+            return LazyField(dset)
 
     @classmethod
     def load(cls, directory: str, name: str) -> AbstractHDFAnalysisResults:
-        """Load an analyis results object from an HDF5 file located in `directory`.
+        """Load an analyis results object from an HDF5 file or `DirectoryStore` located in `directory`.
 
         Args:
             directory: The path to the folder containing the file.
@@ -309,9 +485,13 @@ class AbstractHDFAnalysisResults(AbstractAnalysisResults):
             A new instance of analysis results loaded from file.
         """
         filePath = osp.join(directory, cls.name2FileName(name))
-        if not osp.exists(filePath):
+        storePath = osp.join(directory, cls.name2StoreName(name))
+        if osp.exists(filePath):
+            file = h5py.File(filePath, 'r')
+        elif osp.isdir(storePath):
+            file = DirectoryStore(storePath, 'r')
+        else:
             raise OSError(f"The {cls.__name__} analysis file does not exist. {filePath}")
-        file = h5py.File(filePath, 'r')
         return cls(file, None, name)
 
     def __del__(self):
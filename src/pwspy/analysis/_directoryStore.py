@@ -0,0 +1,429 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+A chunked directory store that can be used in place of an HDF5 file to save analysis results. The layout on disk follows
+version 2 of the Zarr storage specification, so the stores can also be opened with the `zarr` package.
+"""
+from __future__ import annotations
+import itertools
+import json
+import os
+import os.path as osp
+import shutil
+import tempfile
+import typing as t_
+import zlib
+
+import numpy as np
+
+__all__ = ['DirectoryStore', 'DirectoryStoreDataset']
+
+
+class DirectoryStoreDataset:
+    """An array saved in a `DirectoryStore`. Implements the subset of the `h5py.Dataset` interface that is used by PWSpy.
+    Each chunk of the array is saved to a separate file, so indexing a region only reads the chunks that overlap the region,
+    and separate processes can write separate chunks of the same dataset at the same time. Don't create these directly,
+    use `DirectoryStore.create_dataset` or index a `DirectoryStore`.
+
+    Args:
+        path: The path to the directory of the dataset.
+        metadata: The contents of the `.zarray` metadata file.
+        attrs: The contents of the `.zattrs` metadata file.
+        writable: If False then the data and attributes can't be changed.
+    """
+    def __init__(self, path: str, metadata: dict, attrs: dict, writable: bool):
+        self._path = path
+        self._writable = writable
+        self.shape: t_.Tuple[int, ...] = tuple(metadata['shape'])
+        self.chunks: t_.Tuple[int, ...] = tuple(metadata['chunks'])
+        self.dtype = np.dtype(metadata['dtype'])
+        compressor = metadata['compressor']
+        if compressor is not None and compressor['id'] != 'zlib':
+            raise ValueError(f"Compressor {compressor['id']} is not supported.")
+        self._level = None if compressor is None else compressor['level']
+        filters = metadata['filters'] or []
+        if any(f['id'] != 'shuffle' for f in filters):
+            raise ValueError(f"Filters {filters} are not supported.")
+        self.shuffle = len(filters) > 0
+        self.attrs = _Attributes(osp.join(path, '.zattrs'), attrs, writable)
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    @property
+    def compression(self) -> t_.Optional[str]:
+        """'gzip' if the chunks are compressed (using zlib, as gzip compression does in HDF5), otherwise `None`."""
+        return None if self._level is None else 'gzip'
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        arr = self._read(self._normalizeRegion(())[0])
+        return arr if dtype is None else arr.astype(dtype)
+
+    def __getitem__(self, region) -> np.ndarray:
+        ranges, squeeze = self._normalizeRegion(region)
+        arr = self._read(ranges)
+        return arr[tuple(0 if i in squeeze else slice(None) for i in range(arr.ndim))]  # Like h5py, 0D results are returned as scalars.
+
+    def __setitem__(self, region, value):
+        if not self._writable:
+            raise OSError("The directory store was opened as read-only.")
+        ranges, squeeze = self._normalizeRegion(region)
+        if any(r.step != 1 for r in ranges):
+            raise ValueError("Writing with a step other than 1 is not supported.")
+        regionShape = tuple(len(r) for r in ranges)
+        unsqueezedShape = tuple(len(r) for i, r in enumerate(ranges) if i not in squeeze)
+        value = np.broadcast_to(np.asarray(value, dtype=self.dtype), unsqueezedShape).reshape(regionShape)
+        if 0 in regionShape:
+            return
+        starts = tuple(r.start for r in ranges)
+        for chunkIdx in self._overlappingChunks(ranges):
+            chunkSlices, valueSlices, fullyCovered = self._chunkIntersection(chunkIdx, ranges, starts)
+            chunk = self._emptyChunk() if fullyCovered else self._readChunk(chunkIdx)
+            chunk[chunkSlices] = value[valueSlices]
+            self._writeChunk(chunkIdx, chunk)
+
+    def _normalizeRegion(self, region) -> t_.Tuple[t_.List[range], t_.Set[int]]:
+        """Convert an index into a range of indices for each axis and the set of axes that were indexed with an integer."""
+        if not isinstance(region, tuple):
+            region = (region,)
+        if any(r is Ellipsis for r in region):
+            i = region.index(Ellipsis)
+            region = region[:i] + (slice(None),) * (self.ndim - len(region) + 1) + region[i + 1:]
+        if len(region) > self.ndim:
+            raise IndexError(f"Too many indices for a dataset with {self.ndim} dimensions.")
+        region = region + (slice(None),) * (self.ndim - len(region))
+        ranges, squeeze = [], set()
+        for axis, (r, n) in enumerate(zip(region, self.shape)):
+            if isinstance(r, slice):
+                ranges.append(range(*r.indices(n)))
+            elif isinstance(r, (int, np.integer)):
+                i = int(r) + n if r < 0 else int(r)
+                if not 0 <= i < n:
+                    raise IndexError(f"Index {r} is out of range for axis {axis} with size {n}.")
+                ranges.append(range(i, i + 1))
+                squeeze.add(axis)
+            else:
+                raise TypeError(f"Indexing with {type(r)} is not supported.")
+        return ranges, squeeze
+
+    def _read(self, ranges: t_.List[range]) -> np.ndarray:
+        """Read the values at the indices given by `ranges`. Only the chunks that contain the indices are read."""
+        out = np.zeros(tuple(len(r) for r in ranges), dtype=self.dtype)
+        if out.size == 0:
+            return out
+        # Read the bounding box of the selection, then take every `step`th element if needed.
+        bounds = [range(min(r), max(r) + 1) for r in ranges]
+        box = out if bounds == ranges else np.zeros(tuple(len(r) for r in bounds), dtype=self.dtype)
+        starts = tuple(r.start for r in bounds)
+        for chunkIdx in self._overlappingChunks(bounds):
+            chunkSlices, boxSlices, _ = self._chunkIntersection(chunkIdx, bounds, starts)
+            box[boxSlices] = self._readChunk(chunkIdx)[chunkSlices]
+        if box is not out:
+            out[...] = box[np.ix_(*[np.arange(len(r)) * r.step + (r.start - b.start) for r, b in zip(ranges, bounds)])]
+        return out
+
+    def _overlappingChunks(self, ranges: t_.List[range]) -> t_.Iterator[t_.Tuple[int, ...]]:
+        """Iterate over the indices of the chunks that overlap the box given by `ranges` (which must have a step of 1)."""
+        return itertools.product(*[range(r.start // c, (r.stop - 1) // c + 1) for r, c in zip(ranges, self.chunks)])
+
+    def _chunkIntersection(self, chunkIdx: t_.Tuple[int, ...], ranges: t_.List[range], starts: t_.Tuple[int, ...]):
+        """Return the slices of a chunk and of a region that overlap, and whether the region covers all valid data in the chunk."""
+        chunkSlices, regionSlices, fullyCovered = [], [], True
+        for i, r, c, n, s in zip(chunkIdx, ranges, self.chunks, self.shape, starts):
+            chunkStart, chunkStop = i * c, min((i + 1) * c, n)
+            lo, hi = max(chunkStart, r.start), min(chunkStop, r.stop)
+            chunkSlices.append(slice(lo - chunkStart, hi - chunkStart))
+            regionSlices.append(slice(lo - s, hi - s))
+            fullyCovered &= lo == chunkStart and hi == chunkStop
+        return tuple(chunkSlices), tuple(regionSlices), fullyCovered
+
+    def _chunkPath(self, chunkIdx: t_.Tuple[int, ...]) -> str:
+        return osp.join(self._path, '.'.join(str(i) for i in chunkIdx) if len(chunkIdx) > 0 else '0')
+
+    def _emptyChunk(self) -> np.ndarray:
+        return np.zeros(self.chunks, dtype=self.dtype)
+
+    def _readChunk(self, chunkIdx: t_.Tuple[int, ...]) -> np.ndarray:
+        """Read and decode a single chunk. Chunks at the edge of the array are the full chunk size, as in Zarr. Chunks
+        that have never been written are filled with zeros."""
+        try:
+            with open(self._chunkPath(chunkIdx), 'rb') as f:
+                buffer = f.read()
+        except FileNotFoundError:
+            return self._emptyChunk()
+        if self._level is not None:
+            buffer = zlib.decompress(buffer)
+        if self.shuffle and self.dtype.itemsize > 1:
+            buffer = np.frombuffer(buffer, dtype=np.uint8).reshape(self.dtype.itemsize, -1).T.tobytes()
+        return np.frombuffer(buffer, dtype=self.dtype).reshape(self.chunks).copy()
+
+    def _writeChunk(self, chunkIdx: t_.Tuple[int, ...], chunk: np.ndarray):
+        """Encode and save a single chunk. The chunk is written to a temporary file which then replaces the chunk file, so
+        a reader in another process never sees a partially written chunk."""
+        buffer = np.ascontiguousarray(chunk).tobytes()
+        if self.shuffle and self.dtype.itemsize > 1:  # Group the bytes of equal significance together, like the HDF5 shuffle filter.
+            buffer = np.frombuffer(buffer, dtype=np.uint8).reshape(-1, self.dtype.itemsize).T.tobytes()
+        if self._level is not None:
+            buffer = zlib.compress(buffer, self._level)
+        _atomicWrite(self._chunkPath(chunkIdx), buffer)
+
+
+class DirectoryStore:
+    """A directory containing one subdirectory of chunk files per dataset. Implements the subset of the `h5py.File`
+    interface that is used by `AbstractHDFAnalysisResults` so that it can be used in place of an HDF5 file.
+
+    Unlike HDF5 no file is held open, data is only read from disk when a dataset is indexed. Each chunk is written atomically to
+    its own file so multiple processes may write to separate datasets, or separate chunks of a dataset, at the same time by
+    opening the store in 'a' mode. The metadata of all datasets is consolidated into a single file when a store that was
+    opened for writing is closed, so opening the store for reading only needs to read a single small file.
+
+    Args:
+        path: The path to the store directory.
+        mode: 'r' to read an existing store. 'w' to create a new store, replacing any existing store. 'a' to read and write
+            an existing store, creating it if it doesn't exist.
+    """
+    _consolidatedMetadataName = '.zmetadata'
+
+    def __init__(self, path: str, mode: str = 'r'):
+        if mode not in ('r', 'w', 'a'):
+            raise ValueError(f"Mode {mode} is not supported.")
+        self.path = path
+        self.mode = mode
+        if mode == 'w' and osp.exists(path):
+            shutil.rmtree(path)
+        if mode != 'r' and not osp.exists(path):
+            os.makedirs(path)
+            _atomicWrite(osp.join(path, '.zgroup'), json.dumps({'zarr_format': 2}).encode())
+        if not osp.isdir(path) or not osp.exists(osp.join(path, '.zgroup')):
+            raise OSError(f"{path} is not a directory store.")
+        self._datasets: t_.Dict[str, t_.Tuple[dict, dict]] = self._readMetadata()
+
+    def _readMetadata(self) -> t_.Dict[str, t_.Tuple[dict, dict]]:
+        """Load the metadata of each dataset. When the store is only being read the consolidated metadata is used, otherwise
+        the directory is scanned so that datasets added by other writers are found."""
+        consolidatedPath = osp.join(self.path, self._consolidatedMetadataName)
+        datasets = {}
+        if self.mode == 'r' and osp.exists(consolidatedPath):
+            with open(consolidatedPath, 'r') as f:
+                md = json.load(f)['metadata']
+            for key, value in md.items():
+                name, _, fileName = key.rpartition('/')
+                if fileName == '.zarray':
+                    datasets[name] = (value, md.get(f"{name}/.zattrs", {}))
+            return datasets
+        for name in sorted(os.listdir(self.path)):
+            arrayPath = osp.join(self.path, name, '.zarray')
+            if osp.exists(arrayPath):
+                with open(arrayPath, 'r') as f:
+                    metadata = json.load(f)
+                attrsPath = osp.join(self.path, name, '.zattrs')
+                attrs = {}
+                if osp.exists(attrsPath):
+                    with open(attrsPath, 'r') as f:
+                        attrs = json.load(f)
+                datasets[name] = (metadata, attrs)
+        return datasets
+
+    @property
+    def writable(self) -> bool:
+        return self.mode != 'r'
+
+    def create_dataset(self, name: str, shape: t_.Optional[t_.Tuple[int, ...]] = None, dtype=None,
+                       data: t_.Optional[np.ndarray] = None, chunks: t_.Union[None, bool, t_.Tuple[int, ...]] = None,
+                       compression: t_.Union[None, str, int] = None, compression_opts: t_.Optional[int] = None,
+                       shuffle: bool = False) -> DirectoryStoreDataset:
+        """Create a new dataset. The arguments have the same meaning as for `h5py.Group.create_dataset`.
+
+        Args:
+            name: The name of the new dataset.
+            shape: The shape of the new dataset. Not needed if `data` is provided.
+            dtype: The data type of the new dataset. Not needed if `data` is provided.
+            data: Optional data to fill the new dataset with.
+            chunks: The shape of the chunks that the dataset is divided into. If `None` or `True` then the dataset is saved as
+                a single chunk.
+            compression: `None` or 'gzip'. An integer from 0 to 9 is interpreted as a gzip compression level, like h5py
+                does. Other HDF5 filters are not supported.
+            compression_opts: The gzip compression level.
+            shuffle: If `True` the bytes of the values in each chunk are reordered before compression, like the HDF5 shuffle filter.
+
+        Returns:
+            The new dataset.
+        """
+        if not self.writable:
+            raise OSError("The directory store was opened as read-only.")
+        if '/' in name or name.startswith('.'):
+            raise ValueError(f"{name} is not a valid dataset name.")
+        if name in self._datasets:
+            raise ValueError(f"Dataset {name} already exists.")
+        if data is not None:
+            data = np.asarray(data, dtype=dtype)
+            shape, dtype = data.shape, data.dtype
+        elif shape is None:
+            raise ValueError("One of `shape` or `data` must be provided.")
+        shape = tuple(shape)
+        dtype = np.dtype(dtype if dtype is not None else np.float32)
+        if dtype.hasobject or dtype.fields is not None:
+            raise TypeError(f"Data type {dtype} is not supported.")
+        if chunks is None or chunks is True:
+            chunks = shape
+        elif chunks is False:
+            raise ValueError("Datasets in a directory store are always chunked.")
+        if len(chunks) != len(shape):
+            raise ValueError(f"Chunks {chunks} don't match the dataset shape {shape}.")
+        chunks = tuple(max(1, int(c)) for c in chunks)
+        if isinstance(compression, (int, np.integer)) and not isinstance(compression, bool) and 0 <= compression <= 9:
+            compression, compression_opts = 'gzip', int(compression)  # Like h5py. Other integers are HDF5 filter IDs.
+        if compression not in (None, 'gzip'):
+            raise ValueError(f"Compression {compression} is not supported by the directory store. Only gzip is available.")
+        metadata = {
+            'zarr_format': 2,
+            'shape': list(shape),
+            'chunks': list(chunks),
+            'dtype': dtype.str,
+            'compressor': None if compression is None else {'id': 'zlib', 'level': 4 if compression_opts is None else int(compression_opts)},
+            'fill_value': None,
+            'filters': [{'id': 'shuffle', 'elementsize': dtype.itemsize}] if shuffle else None,
+            'order': 'C'
+        }
+        path = osp.join(self.path, name)
+        os.makedirs(path, exist_ok=True)
+        _atomicWrite(osp.join(path, '.zarray'), json.dumps(metadata, indent=4).encode())
+        self._datasets[name] = (metadata, {})
+        dset = self[name]
+        if data is not None:
+            dset[...] = data
+        return dset
+
+    def __getitem__(self, name: str) -> DirectoryStoreDataset:
+        if name not in self._datasets:
+            raise KeyError(f"Dataset {name} was not found in {self.path}.")
+        metadata, attrs = self._datasets[name]
+        return DirectoryStoreDataset(osp.join(self.path, name), metadata, attrs, self.writable)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._datasets
+
+    def __iter__(self) -> t_.Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._datasets)
+
+    def keys(self) -> t_.List[str]:
+        return list(self._datasets.keys())
+
+    def consolidate(self):
+        """Save the metadata of every dataset to a single file so that the store can be opened without scanning every
+        dataset directory. This is done automatically when a writable store is closed. If several processes are writing to
+        the store then call this once they are all done."""
+        self._datasets = self._readMetadata()
+        md = {'.zgroup': {'zarr_format': 2}}
+        for name, (metadata, attrs) in self._datasets.items():
+            md[f"{name}/.zarray"] = metadata
+            md[f"{name}/.zattrs"] = attrs
+        _atomicWrite(osp.join(self.path, self._consolidatedMetadataName),
+                     json.dumps({'metadata': md, 'zarr_consolidated_format': 1}, indent=4).encode())
+
+    def close(self):
+        if self.writable:
+            self.consolidate()
+            self.mode = 'r'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _Attributes:
+    """The attributes of a `DirectoryStoreDataset`. Values are saved as JSON and are returned as the same numpy types that
+    `h5py` returns. e.g. arrays are returned as arrays and byte strings are returned as bytes."""
+    _typesKey = '_pwspyTypes'  # Records the numpy type of each attribute so it can be restored.
+
+    def __init__(self, path: str, attrs: dict, writable: bool):
+        self._path = path
+        self._attrs = attrs  # Shared with the metadata of the `DirectoryStore` so that it doesn't need to be reloaded.
+        self._writable = writable
+
+    def __getitem__(self, key: str):
+        if key == self._typesKey:
+            raise KeyError(key)
+        value = self._attrs[key]
+        typeName = self._attrs.get(self._typesKey, {}).get(key)
+        if typeName is None:
+            return value
+        elif typeName == 'bytes':
+            return np.bytes_(value.encode('latin-1'))
+        elif typeName.startswith('array:'):
+            return np.array(value, dtype=typeName[len('array:'):])
+        else:
+            return np.dtype(typeName).type(value)
+
+    def __setitem__(self, key: str, value):
+        if not self._writable:
+            raise OSError("The directory store was opened as read-only.")
+        if key == self._typesKey:
+            raise KeyError(f"{key} is reserved.")
+        types = self._attrs.setdefault(self._typesKey, {})
+        types.pop(key, None)
+        if isinstance(value, bytes):  # Includes `np.bytes_`
+            value, types[key] = value.decode('latin-1'), 'bytes'
+        elif isinstance(value, np.ndarray):
+            if value.dtype.kind not in 'biuf':
+                raise TypeError(f"Attribute arrays of type {value.dtype} are not supported.")
+            value, types[key] = value.tolist(), f"array:{value.dtype.str}"
+        elif isinstance(value, np.generic):
+            value, types[key] = value.item(), value.dtype.str
+        elif not isinstance(value, (str, int, float, bool)):
+            raise TypeError(f"Attributes of type {type(value)} are not supported.")
+        self._attrs[key] = value
+        _atomicWrite(self._path, json.dumps(self._attrs, indent=4).encode())
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._attrs and key != self._typesKey
+
+    def keys(self) -> t_.List[str]:
+        return [k for k in self._attrs.keys() if k != self._typesKey]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+
+def _atomicWrite(path: str, buffer: bytes):
+    """Write to a temporary file in the same directory and then move it to `path`, replacing any existing file."""
+    fd, tempPath = tempfile.mkstemp(dir=osp.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(buffer)
+        os.replace(tempPath, path)
+    except BaseException:
+        if osp.exists(tempPath):
+            os.remove(tempPath)
+        raise
@@ -1,27 +1,165 @@
 from __future__ import annotations
+import copy
+import dataclasses
+import multiprocessing as mp
+import queue
+import threading
 import typing as t_
-import pandas as pd
-from pwspy.dataTypes import ICRawBase, MetaDataBase
-from pwspy.utility.fileIO import processParallel
+import weakref
+from multiprocessing import shared_memory
+import numpy as np
+import psutil
+from pwspy.dataTypes import ICRawBase, MetaDataBase, FFTBackend, getFFTBackend, setFFTBackend
 import logging
 if t_.TYPE_CHECKING:
     from pwspy.analysis import AbstractAnalysis, AbstractAnalysisResults
     from pwspy.analysis.warnings import AnalysisWarning
 
 
+class _SharedArray(np.ndarray):
+    """A numpy array whose data lives in a named block of `multiprocessing.shared_memory`. When this array is pickled
+    (e.g. when it is sent to a worker process) only the name of the memory block is transferred and the unpickled array
+    is attached to the same memory rather than being a copy. This works for both the `fork` and `spawn` start methods.
+
+    Only the array returned by `fromArray` is shared by name. Slices of it and the results of arithmetic are pickled
+    by value like any other array.
+    """
+    def __array_finalize__(self, obj):
+        self._shmName = None  # Views and copies are not shared by name.
+        self._shm = None
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        # Calculations on a shared array return ordinary arrays rather than instances of this class.
+        inputs = tuple(i.view(np.ndarray) if isinstance(i, _SharedArray) else i for i in inputs)
+        if 'out' in kwargs:
+            kwargs['out'] = tuple(o.view(np.ndarray) if isinstance(o, _SharedArray) else o for o in kwargs['out'])
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __reduce__(self):
+        if self._shmName is None:
+            return self.view(np.ndarray).__reduce__()
+        return _SharedArray._attach, (self._shmName, self.shape, self.dtype.str)
+
+    @classmethod
+    def fromArray(cls, arr: np.ndarray) -> _SharedArray:
+        """Copy an array into a new block of shared memory. The memory block is released once the returned array (and
+        any views of it) have been garbage collected.
+
+        Args:
+            arr: The array to copy.
+
+        Returns:
+            A copy of `arr` in shared memory.
+        """
+        arr = np.asarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        out = cls._fromSharedMemory(shm, arr.shape, arr.dtype)
+        np.copyto(out, arr)
+        weakref.finalize(out, cls._release, shm)
+        return out
+
+    @classmethod
+    def _attach(cls, name: str, shape: t_.Tuple[int, ...], dtype: str) -> _SharedArray:
+        """Used when unpickling. Attach to an existing block of shared memory."""
+        return cls._fromSharedMemory(shared_memory.SharedMemory(name=name), shape, np.dtype(dtype))
+
+    @classmethod
+    def _fromSharedMemory(cls, shm: shared_memory.SharedMemory, shape: t_.Tuple[int, ...], dtype: np.dtype) -> _SharedArray:
+        out = np.ndarray.__new__(cls, shape, dtype=dtype, buffer=shm.buf)
+        out._shmName = shm.name
+        out._shm = shm  # Keep the memory block open as long as this array exists.
+        return out
+
+    @staticmethod
+    def _release(shm: shared_memory.SharedMemory):
+        shm.close()
+        shm.unlink()
+
+
+class _MemoryBudget:
+    """Keeps track of how many bytes of data are currently in flight. `reserve` blocks while the budget is used up.
+
+    Args:
+        maxBytes: The budget, in bytes.
+    """
+    def __init__(self, maxBytes: int):
+        self.maxBytes = maxBytes
+        self._used = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def reserve(self, nBytes: int) -> bool:
+        """Wait until `nBytes` fit in the budget and then reserve them. A single reservation larger than the whole
+        budget is allowed once nothing else is in flight so that large items can't cause a deadlock.
+
+        Returns:
+            False if the budget was closed while waiting, in which case nothing was reserved.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or self._used == 0 or self._used + nBytes <= self.maxBytes)
+            if self._closed:
+                return False
+            self._used += nBytes
+            return True
+
+    def adjust(self, nBytes: int):
+        """Change an existing reservation by `nBytes` without blocking. Used once the true size of an item is known."""
+        with self._condition:
+            self._used += nBytes
+            self._condition.notify_all()
+
+    def release(self, nBytes: int):
+        """Return `nBytes` to the budget."""
+        self.adjust(-nBytes)
+
+    def close(self):
+        """Wake up all waiting threads. Any further calls to `reserve` will fail."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+@dataclasses.dataclass
+class AnalysisFailure:
+    """An image that could not be loaded, analyzed, or saved by `ParallelRunner.iterate`.
+
+    Attributes:
+        index: The position of the image in the iterable passed to `iterate`.
+        metadata: The metadata of the image. None if the input had no metadata.
+        exception: The exception that was raised.
+    """
+    index: int
+    metadata: t_.Optional[MetaDataBase]
+    exception: Exception
+
+
 class ParallelRunner:
     """
-    A utility class for Running an analysis on multiple images in parallel on multiple cores
+    A utility class for Running an analysis on multiple images in parallel on multiple cores.
+
+    The data that is shared by every image (the reference, extra reflection, etc.) is copied into shared memory once and
+    each worker process attaches to it by name. The worker processes are started on the first call to `run` and are
+    reused by subsequent calls until `close` is called. This class can be used as a context manager.
+
+    The worker processes use the FFT backend (see `pwspy.dataTypes.setFFTBackend`) that was selected when they were
+    started, regardless of the `multiprocessing` start method.
 
     Args:
-        The analysis object to run.
+        analysis: The analysis object to run.
+        numProcesses: The number of worker processes. If None then one less than the number of physical cores is used.
+        startMethod: The `multiprocessing` start method to use, e.g. 'spawn' or 'fork'. If None then the platform default is used.
     """
-    def __init__(self, analysis: AbstractAnalysis):
+    def __init__(self, analysis: AbstractAnalysis, numProcesses: t_.Optional[int] = None, startMethod: t_.Optional[str] = None):
         self._analysis = analysis
         analysis.copySharedDataToSharedMemory()
+        if numProcesses is None:
+            numProcesses = max(psutil.cpu_count(logical=False) - 1, 1)  # Use one less than number of available cores. If we use all cores then things can get locked up.
+        self._numProcesses = numProcesses
+        self._context = mp.get_context(startMethod)
+        self._pool: t_.Optional[mp.pool.Pool] = None
 
     def run(self, cubes: t_.List[t_.Union[MetaDataBase, ICRawBase]],
-                  saveName: t_.Optional[str] = None) -> t_.List[t_.Tuple[t_.List[AnalysisWarning, AbstractAnalysisResults, MetaDataBase]]]:
+                  saveName: t_.Optional[str] = None) -> t_.List[t_.Tuple[t_.List[AnalysisWarning], AbstractAnalysisResults, MetaDataBase]]:
         """
         Run an analysis on several images in parallel.
 
@@ -29,26 +167,237 @@ class ParallelRunner:
             cubes: A list of either data objects or the associated metadata object.s
             saveName: If this name is supplied then the analysis results will be saved under this name for each image.
         """
-        out = processParallel(pd.DataFrame({'cube': cubes}), processorFunc=self._process, initializer=self._initializer, initArgs=(self._analysis, saveName))
-        return out
+        return self._getPool().starmap(self._process, [(cube, saveName) for cube in cubes])
+
+    def iterate(self, cubes: t_.Iterable[t_.Union[MetaDataBase, ICRawBase]], saveName: t_.Optional[str] = None,
+                memoryBudget: int = 8 * 1024**3, ioThreads: int = 2, writerThreads: int = 1,
+                failures: t_.Optional[t_.List[AnalysisFailure]] = None
+                ) -> t_.Iterator[t_.Tuple[t_.List[AnalysisWarning], AbstractAnalysisResults, MetaDataBase]]:
+        """
+        Run an analysis on a stream of images, yielding the results as soon as each image is done (in no particular
+        order). Unlike `run` this only ever holds a limited amount of data in memory so it can be used for batches of
+        any size.
+
+        This is a three stage pipeline connected by bounded queues. `ioThreads` threads load the images from file and
+        place them in shared memory, the worker processes run the analysis, and `writerThreads` threads save the results
+        to file. When the consumer of this iterator or any stage falls behind the stages before it wait.
+
+        An image that fails to load, analyze, or save doesn't stop the others. The failure is logged and appended to
+        `failures` and no results are yielded for that image.
+
+        Args:
+            cubes: An iterable of either data objects or the associated metadata objects.
+            saveName: If this name is supplied then the analysis results will be saved under this name for each image.
+            memoryBudget: The approximate maximum number of bytes to have in flight. Each image is charged for its raw
+                data plus the same amount again for its analysis results. The budget is released when the results are
+                yielded.
+            ioThreads: The number of threads used to load images.
+            writerThreads: The number of threads used to save results.
+            failures: If a list is supplied then an `AnalysisFailure` is appended to it for each image that failed.
+
+        Yields:
+            A tuple of the warnings, the analysis results, and the metadata for each image.
+        """
+        logger = logging.getLogger(__name__)
+        pool = self._getPool()
+        budget = _MemoryBudget(memoryBudget)
+        stop = threading.Event()
+        computeQueue = queue.Queue(maxsize=self._numProcesses)
+        writeQueue = queue.Queue(maxsize=2 * writerThreads)
+        outQueue = queue.Queue(maxsize=2 * writerThreads)  # Holds tuples of the number of bytes reserved for an image and either its results or an `AnalysisFailure`.
+        inFlight = {}  # The loaded images that the workers are attached to, along with the number of bytes reserved for each.
+        inputs = enumerate(cubes)
+        inputLock = threading.Lock()
+        done = object()  # Sentinel marking the end of a queue.
+        estimate = [0]  # The size of the most recently loaded image. Used to reserve memory before the next one is loaded.
+
+        def put(q: queue.Queue, item) -> bool:
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q: queue.Queue):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return done
+
+        def fail(index: int, e: Exception) -> bool:
+            """Pass on the failure of an image that was sent to the workers and release its memory."""
+            im, cost = inFlight.pop(index)
+            return put(outQueue, (cost, AnalysisFailure(index, im.metadata, e)))
+
+        def load():
+            while not stop.is_set():
+                with inputLock:
+                    try:
+                        index, im = next(inputs)
+                    except StopIteration:
+                        return
+                reserved = estimate[0]
+                if not budget.reserve(reserved):
+                    return
+                md = im if isinstance(im, MetaDataBase) else getattr(im, 'metadata', None)
+                try:
+                    if isinstance(im, MetaDataBase):
+                        im = im.toDataClass(lock=None)
+                    else:
+                        im = copy.copy(im)  # Don't replace the data of the caller's object, it may be passed in again.
+                    im.data = _SharedArray.fromArray(im.data)  # Workers attach to this by name rather than receiving a copy.
+                except Exception as e:
+                    if not put(outQueue, (reserved, AnalysisFailure(index, md, e))):
+                        return
+                    continue
+                cost = 2 * im.data.nbytes
+                estimate[0] = cost
+                budget.adjust(cost - reserved)
+                inFlight[index] = (im, cost)
+                if not put(computeQueue, (index, im)):
+                    return
+
+        def feed():
+            while True:
+                item = get(computeQueue)
+                if item is done:
+                    return
+                yield item
+
+        def collect():
+            # Every result is received, even after the consumer has stopped. The images that were sent to the workers
+            # must stay in shared memory until the workers are done with them, and the pool can't be closed until all
+            # of its tasks have finished.
+            resultIterator = pool.imap_unordered(self._processStreamed, feed())
+            while True:
+                try:
+                    index, outcome = resultIterator.next()
+                except StopIteration:
+                    break
+                except Exception as e:  # Not caused by a single image, e.g. the results couldn't be sent back. End the stream.
+                    put(outQueue, e)
+                    continue
+                if stop.is_set():
+                    continue
+                if isinstance(outcome, Exception):
+                    fail(index, outcome)
+                else:
+                    put(writeQueue, (index, outcome))
+            if stop.is_set():  # The consumer stopped early. The remaining images won't be written.
+                inFlight.clear()
+
+        def write():
+            while True:
+                item = get(writeQueue)
+                if item is done:
+                    return
+                index, (warnings, results) = item
+                if saveName is not None:
+                    try:
+                        inFlight[index][0].metadata.saveAnalysis(results, saveName, overwrite=True)
+                    except Exception as e:
+                        if not fail(index, e):
+                            return
+                        continue
+                im, cost = inFlight.pop(index)
+                if not put(outQueue, (cost, (warnings, results, im.metadata))):
+                    return
+
+        def runStage(target: t_.Callable, nThreads: int, nextQueue: queue.Queue, nSentinels: int):
+            """Run `target` in `nThreads` threads. When they have all finished put sentinels in `nextQueue`. Any
+            exception is passed on to the consumer through `outQueue`."""
+            def wrapped():
+                try:
+                    target()
+                except BaseException as e:
+                    put(outQueue, e)
+            threads = [threading.Thread(target=wrapped, daemon=True) for i in range(nThreads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for i in range(nSentinels):
+                put(nextQueue, done)
+
+        stages = [threading.Thread(target=runStage, args=args, daemon=True) for args in [
+            (load, ioThreads, computeQueue, 1),
+            (collect, 1, writeQueue, writerThreads),
+            (write, writerThreads, outQueue, 1)]]
+        for stage in stages:
+            stage.start()
+        try:
+            while True:
+                item = get(outQueue)
+                if item is done:
+                    break
+                if isinstance(item, BaseException):  # Something went wrong in the pipeline itself rather than with one image.
+                    raise item
+                cost, item = item
+                budget.release(cost)
+                if isinstance(item, AnalysisFailure):
+                    path = getattr(item.metadata, 'filePath', None)
+                    logger.error(f"Failed to process image {item.index}{f' at {path}' if path else ''}: {item.exception!r}")
+                    if failures is not None:
+                        failures.append(item)
+                    continue
+                yield item
+        finally:
+            stop.set()  # Images that are still being analyzed are released by `collect` once their results are received.
+            budget.close()
+
+    def _getPool(self) -> mp.pool.Pool:
+        """Start the worker processes if they aren't already running."""
+        if self._pool is None:
+            self._pool = self._context.Pool(processes=self._numProcesses, initializer=self._initializer, initargs=(self._analysis, getFFTBackend()))
+            self._poolFinalizer = weakref.finalize(self, self._pool.terminate)
+        return self._pool
+
+    def close(self):
+        """Shut down the worker processes. They will be restarted if `run` is called again."""
+        if self._pool is not None:
+            self._poolFinalizer.detach()
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self) -> ParallelRunner:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     @staticmethod
-    def _initializer(analysis: AbstractAnalysis, saveName: t_.Optional[str]):
+    def _initializer(analysis: AbstractAnalysis, fftBackend: FFTBackend):
         """This method is run once for each process that is spawned. it initialized _resources that are shared between each iteration of _process."""
         global pwspyAnalysisParallelGlobals
-        pwspyAnalysisParallelGlobals = {'analysis': analysis, 'saveName': saveName}
+        setFFTBackend(fftBackend)  # A spawned process would otherwise start with the default backend.
+        pwspyAnalysisParallelGlobals = {'analysis': analysis}
 
     @staticmethod
-    def _process(rowIndex: int, row: pd.Series):
+    def _process(im: t_.Union[MetaDataBase, ICRawBase], saveName: t_.Optional[str]):
         """This method is run in parallel. once for each acquisition data that we want to analyze.
         Returns a list of AnalysisWarnings objects with the associated metadat object"""
         global pwspyAnalysisParallelGlobals
         analysis = pwspyAnalysisParallelGlobals['analysis']
-        saveName = pwspyAnalysisParallelGlobals['saveName']
-        im = row['cube']
         if isinstance(im, MetaDataBase):
             im = im.toDataClass(lock=None)
         results, warnings = analysis.run(im)
         if saveName is not None:
             im.metadata.saveAnalysis(results, saveName, overwrite=True)
-        return warnings, results, im.metadata
\ No newline at end of file
+        return warnings, results, im.metadata
+
+    @staticmethod
+    def _processStreamed(item: t_.Tuple[int, ICRawBase]):
+        """Used by `iterate`. The image has already been loaded and the results are saved by the parent process. An
+        exception is returned rather than raised so that the parent knows which image it belongs to."""
+        global pwspyAnalysisParallelGlobals
+        index, im = item
+        try:
+            results, warnings = pwspyAnalysisParallelGlobals['analysis'].run(im)
+        except Exception as e:
+            return index, e
+        return index, (warnings, results)
@@ -18,9 +18,13 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Tuple, List
+from typing import Tuple, List, Sequence, Iterator
+
+import numpy as np
+from scipy import sparse
 
 from .. import AbstractAnalysisResults, warnings
+from .._abstract import LazyField
 from ...dataTypes._other import Roi
 
 
@@ -43,12 +47,86 @@ class AbstractRoiCompiler(ABC):
         """
         pass
 
+    def runBatch(self, results: AbstractAnalysisResults, rois: Sequence[Roi]) -> List[Tuple[AbstractRoiCompilationResults, List[warnings.AnalysisWarning]]]:
+        """Compile several ROIs of the same analysis results. Subclasses may override this to share work between the ROIs.
+
+        Args:
+            results: The analysis results to compile.
+            rois: The ROIs to be used to segment out sections of the results.
+
+        Returns:
+            A list with the output of `run` for each ROI, in the same order as `rois`.
+        """
+        return [self.run(results, roi) for roi in rois]
+
 
 class AbstractRoiCompilationResults(ABC):
     """The results produced by the compilation."""
     pass
 
 
+class _RoiLabels:
+    """Labels the pixels of several ROIs within the bounding box that contains all of them. The labels are stored as a
+    sparse (ROI, pixel) matrix rather than a label image so that ROIs are allowed to overlap. Per-ROI sums of an image
+    are then calculated with a single matrix product rather than by indexing the image with the mask of each ROI.
+
+    Args:
+        rois: The ROIs to label.
+    """
+    def __init__(self, rois: Sequence[Roi]):
+        boxes = [roi.getBoundingBox() for roi in rois]
+        nonEmpty = [(rows, cols) for rows, cols in boxes if rows.stop > rows.start and cols.stop > cols.start]
+        if len(nonEmpty) > 0:
+            rowStart, rowStop = min(b[0].start for b in nonEmpty), max(b[0].stop for b in nonEmpty)
+            colStart, colStop = min(b[1].start for b in nonEmpty), max(b[1].stop for b in nonEmpty)
+        else:
+            rowStart = rowStop = colStart = colStop = 0
+        self.box = (slice(rowStart, rowStop), slice(colStart, colStop))
+        self.shape = (rowStop - rowStart, colStop - colStart)
+        indices, indptr = [], [0]
+        for roi, (rows, cols) in zip(rois, boxes):
+            r, c = np.divmod(np.flatnonzero(roi.croppedMask), max(cols.stop - cols.start, 1))
+            indices.append((r + rows.start - rowStart) * self.shape[1] + (c + cols.start - colStart))
+            indptr.append(indptr[-1] + len(indices[-1]))
+        indices = np.concatenate(indices) if len(indices) > 0 else np.zeros(0, dtype=int)
+        self.matrix = sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(rois), self.shape[0] * self.shape[1]))
+        self.counts = np.diff(indptr)
+
+    def getValues(self, image: np.ndarray, i: int) -> np.ndarray:
+        """The values of `image`, already cropped to `box`, for each pixel of the `i`th ROI."""
+        return image.reshape((self.matrix.shape[1],) + image.shape[2:])[self.matrix.indices[self.matrix.indptr[i]:self.matrix.indptr[i + 1]]]
+
+    def sum(self, image: np.ndarray) -> np.ndarray:
+        """The sum of `image`, already cropped to `box`, over each ROI. For a 3D image the result is (ROI, index)."""
+        return self.matrix @ image.reshape((self.matrix.shape[1],) + image.shape[2:])
+
+    def mean(self, image: np.ndarray) -> np.ndarray:
+        """The mean of `image`, already cropped to `box`, over each ROI. Empty ROIs are NaN."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum(image) / self.counts.reshape((-1,) + (1,) * (image.ndim - 2))
+
+    def iterTiles(self, field: LazyField, maxBytes: int = 2**26) -> Iterator[Tuple[sparse.spmatrix, np.ndarray]]:
+        """Read a 3D field within `box` one block of rows at a time. Blocks that don't contain any ROI pixels are not read.
+
+        Args:
+            field: The 3D data to read.
+            maxBytes: The approximate maximum size of each block, assuming 8 bytes per value.
+
+        Yields:
+            The columns of `matrix` for the pixels of the block, The data of the block as a (pixels, index) array.
+        """
+        width = self.shape[1]
+        tileRows = max(1, maxBytes // max(width * field.shape[-1] * 8, 1))
+        matrix = self.matrix.tocsc()  # Column slices are efficient in this format.
+        for start in range(0, self.shape[0], tileRows):
+            stop = min(start + tileRows, self.shape[0])
+            tileMatrix = matrix[:, start * width:stop * width]
+            if tileMatrix.nnz == 0:
+                continue
+            data = field[slice(self.box[0].start + start, self.box[0].start + stop), self.box[1]]
+            yield tileMatrix, data.reshape((-1, data.shape[-1]))
+
+
 @dataclass
 class AbstractCompilerSettings(ABC):
     """These settings determine which values should be processed during compilation"""
@@ -68,8 +68,9 @@ class DynamicsRoiCompiler(AbstractRoiCompiler):
         """Returns the average of arr over the ROI.
         if condition is provided then only value of arr where the condition is satisfied are included."""
         assert len(arr.shape) == 2
+        box = roi.getBoundingBox()  # Only index the region of the image that contains the ROI.
         if condition is not None:
-            return arr[np.logical_and(roi.mask, condition)].mean()
+            return arr[box][np.logical_and(roi.croppedMask, condition[box])].mean()
         else:
-            return arr[roi.mask].mean()
+            return arr[box][roi.croppedMask].mean()
 
@@ -44,7 +44,7 @@ class GenericRoiCompiler:
 
     def run(self, roi: RoiFile) -> GenericRoiCompilationResults:
         if self.settings.roiArea:
-            roiArea: typing.Optional[int] = np.sum(roi.getRoi().mask)
+            roiArea: typing.Optional[int] = np.sum(roi.getRoi().croppedMask)
         else:
             roiArea = None
 
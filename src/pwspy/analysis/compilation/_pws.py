@@ -20,9 +20,10 @@ from dataclasses import dataclass
 import typing as t_
 import numpy as np
 
-from ._abstract import AbstractCompilerSettings, AbstractRoiCompilationResults, AbstractRoiCompiler
+from ._abstract import AbstractCompilerSettings, AbstractRoiCompilationResults, AbstractRoiCompiler, _RoiLabels
 from .. import warnings
-from ...dataTypes import Roi
+from .._abstract import AbstractHDFAnalysisResults, LazyField
+from ...dataTypes import Roi, KCube, ICBase
 from ...dataTypes._other import RoiFile
 
 if t_.TYPE_CHECKING:
@@ -67,11 +68,11 @@ class PWSRoiCompiler(AbstractRoiCompiler):
 
     def run(self, results: PWSAnalysisResults, roi: Roi) -> t_.Tuple[PWSRoiCompilationResults, t_.List[warnings.AnalysisWarning]]:
         warns = []
-        reflectance = self._avgOverRoi(roi, results.meanReflectance) if self.settings.reflectance else None
-        rms = self._avgOverRoi(roi, results.rms) if self.settings.rms else None
+        reflectance = self._getRoiValues(results, 'meanReflectance', roi).mean() if self.settings.reflectance else None
+        rms = self._getRoiValues(results, 'rms', roi).mean() if self.settings.rms else None
         if self.settings.polynomialRms:
             try:
-                polynomialRms = self._avgOverRoi(roi, results.polynomialRms)
+                polynomialRms = self._getRoiValues(results, 'polynomialRms', roi).mean()
             except KeyError:
                 polynomialRms = None
         else:
@@ -79,9 +80,8 @@ class PWSRoiCompiler(AbstractRoiCompiler):
 
         if self.settings.autoCorrelationSlope:
             try:
-                autoCorrelationSlope = self._avgOverRoi(roi, results.autoCorrelationSlope,
-                    condition=np.logical_and(results.rSquared > 0.9,
-                        results.autoCorrelationSlope < 0))
+                slope = self._getRoiValues(results, 'autoCorrelationSlope', roi)
+                autoCorrelationSlope = slope[np.logical_and(self._getRoiValues(results, 'rSquared', roi) > 0.9, slope < 0)].mean()
             except KeyError:
                 autoCorrelationSlope = None
         else:
@@ -89,8 +89,9 @@ class PWSRoiCompiler(AbstractRoiCompiler):
 
         if self.settings.rSquared:
             try:
-                warns.append(warnings.checkRSquared(results.rSquared[roi.mask]))
-                rSquared = self._avgOverRoi(roi, results.rSquared)
+                rSquaredValues = self._getRoiValues(results, 'rSquared', roi)
+                warns.append(warnings.checkRSquared(rSquaredValues))
+                rSquared = rSquaredValues.mean()
             except KeyError:
                 rSquared = None
         else:
@@ -98,7 +99,7 @@ class PWSRoiCompiler(AbstractRoiCompiler):
 
         if self.settings.ld:
             try:
-                ld = self._avgOverRoi(roi, results.ld)
+                ld = self._getRoiValues(results, 'ld', roi).mean()
             except KeyError:
                 ld = None
         else:
@@ -106,8 +107,7 @@ class PWSRoiCompiler(AbstractRoiCompiler):
 
         if self.settings.opd:
             try:
-                opd, opdIndex = results.opd
-                opd = opd[roi.mask].mean(axis=0)
+                opd, opdIndex = self._getRoiOpd(results, roi)
             except KeyError:
                 opd = opdIndex = None
         else:
@@ -115,9 +115,9 @@ class PWSRoiCompiler(AbstractRoiCompiler):
 
         if self.settings.meanSigmaRatio:
             try:
-                spectra = results.reflectance.getMeanSpectra(roi)[0]
+                spectra = self._getLazyField(results, 'reflectance').getMeanSpectra(roi)[0]
                 meanRms = spectra.std()
-                varRatio = meanRms**2 / (results.rms[roi.mask] ** 2).mean()
+                varRatio = meanRms**2 / (self._getRoiValues(results, 'rms', roi) ** 2).mean()
                 warns.append(warnings.checkMeanSpectraRatio(varRatio))
             except KeyError:
                 varRatio = None
@@ -139,12 +139,124 @@ class PWSRoiCompiler(AbstractRoiCompiler):
         warns = [w for w in warns if w is not None]  # Strip None from warns list
         return results, warns
 
+    def runBatch(self, results: PWSAnalysisResults, rois: t_.Sequence[Roi]) -> t_.List[t_.Tuple[PWSRoiCompilationResults, t_.List[warnings.AnalysisWarning]]]:
+        """Compile many ROIs of the same results at once. This gives the same values as calling `run` for each ROI but
+        each field is only read once, for the bounding box containing all of the ROIs, and each statistic is calculated for
+        every ROI with a single sparse matrix product. The reflectance cube, needed for `opd` and `meanSigmaRatio`, is read
+        one block of rows at a time.
+
+        Args:
+            results: The analysis results to compile.
+            rois: The ROIs to be used to segment out sections of the results. ROIs may overlap.
+
+        Returns:
+            A list with the output of `run` for each ROI, in the same order as `rois`.
+        """
+        rois = list(rois)
+        labels = _RoiLabels(rois)
+        warns = [[] for _ in rois]
+        cache = {}
+
+        def getField(field: str) -> np.ndarray:
+            if field not in cache:
+                cache[field] = self._getLazyField(results, field)[labels.box]
+            return cache[field]
+
+        def meanOf(field: str) -> t_.Optional[np.ndarray]:
+            try:
+                return labels.mean(getField(field))
+            except KeyError:
+                return None
+
+        reflectance = labels.mean(getField('meanReflectance')) if self.settings.reflectance else None
+        rms = labels.mean(getField('rms')) if self.settings.rms else None
+        polynomialRms = meanOf('polynomialRms') if self.settings.polynomialRms else None
+
+        autoCorrelationSlope = None
+        if self.settings.autoCorrelationSlope:
+            try:
+                slope = getField('autoCorrelationSlope')
+                valid = np.logical_and(getField('rSquared') > 0.9, slope < 0)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    autoCorrelationSlope = labels.sum(np.where(valid, slope, 0)) / labels.sum(valid.astype(float))
+            except KeyError:
+                pass
+
+        rSquared = None
+        if self.settings.rSquared:
+            rSquared = meanOf('rSquared')
+            if rSquared is not None:
+                for i in range(len(rois)):
+                    warns[i].append(warnings.checkRSquared(labels.getValues(cache['rSquared'], i)))
+
+        ld = meanOf('ld') if self.settings.ld else None
+
+        opd = opdIndex = varRatio = None
+        if self.settings.opd or self.settings.meanSigmaRatio:
+            try:
+                reflectanceField = self._getLazyField(results, 'reflectance')
+            except KeyError:
+                reflectanceField = None
+            if reflectanceField is not None:
+                spectraSums = opdSums = dtype = None
+                for tileMatrix, data in labels.iterTiles(reflectanceField):
+                    dtype = data.dtype
+                    if self.settings.meanSigmaRatio:
+                        s = tileMatrix @ data
+                        spectraSums = s if spectraSums is None else spectraSums + s
+                    if self.settings.opd:
+                        used = np.flatnonzero(tileMatrix.getnnz(axis=0))  # Only calculate the OPD of pixels that are in an ROI.
+                        tileOpd, opdIndex = KCube(data[used][:, None, :], reflectanceField.index).getOpd(useHannWindow=False, indexOpdStop=100)
+                        s = tileMatrix[:, used] @ tileOpd[:, 0, :]
+                        opdSums = s if opdSums is None else opdSums + s
+                with np.errstate(invalid='ignore', divide='ignore'):  # Empty ROIs give NaN
+                    if opdSums is not None:
+                        opd = (opdSums / labels.counts[:, None]).astype(dtype)
+                    if spectraSums is not None:
+                        meanSpectra = spectraSums / labels.counts[:, None]
+                        varRatio = meanSpectra.std(axis=1)**2 / labels.mean(getField('rms')**2)
+                if varRatio is not None:
+                    for i in range(len(rois)):
+                        warns[i].append(warnings.checkMeanSpectraRatio(varRatio[i]))
+
+        def item(values: t_.Optional[np.ndarray], i: int):
+            return values[i] if values is not None else None
+
+        out = []
+        for i in range(len(rois)):
+            out.append((PWSRoiCompilationResults(
+                        cellIdTag=results.imCubeIdTag,
+                        analysisName=results.analysisName,
+                        reflectance=item(reflectance, i),
+                        rms=item(rms, i),
+                        polynomialRms=item(polynomialRms, i),
+                        autoCorrelationSlope=item(autoCorrelationSlope, i),
+                        rSquared=item(rSquared, i),
+                        ld=item(ld, i),
+                        opd=item(opd, i),
+                        opdIndex=opdIndex if opd is not None else None,
+                        varRatio=item(varRatio, i)),
+                        [w for w in warns[i] if w is not None]))  # Strip None from warns list
+        return out
+
     @staticmethod
-    def _avgOverRoi(roi: Roi, arr: np.ndarray, condition: np.ndarray = None) -> float:
-        """Returns the average of arr over the ROI.
-        if condition is provided then only value of arr where the condition is satisfied are included."""
-        assert len(arr.shape) == 2
-        if condition is not None:
-            return arr[np.logical_and(roi.mask, condition)].mean()
-        else:
-            return arr[roi.mask].mean()
+    def _getLazyField(results: PWSAnalysisResults, field: str) -> LazyField:
+        """Get a view of a field of the results that only reads from file the region that is used."""
+        if isinstance(results, AbstractHDFAnalysisResults):
+            return results.getLazyField(field)
+        else:  # Results that don't support lazy access.
+            v = getattr(results, field)
+            return LazyField(v.data, v.index) if isinstance(v, ICBase) else LazyField(v)
+
+    @classmethod
+    def _getRoiValues(cls, results: PWSAnalysisResults, field: str, roi: Roi) -> np.ndarray:
+        """Returns the values of a 2D field of the results within the ROI. Only the bounding box of the ROI is read from file."""
+        return cls._getLazyField(results, field).getRoiValues(roi)
+
+    @classmethod
+    def _getRoiOpd(cls, results: PWSAnalysisResults, roi: Roi) -> t_.Tuple[np.ndarray, np.ndarray]:
+        """Returns the OPD averaged over the ROI in the same way as `PWSAnalysisResults.opd`. Only the bounding box of the
+        ROI is read from the reflectance cube."""
+        reflectance = cls._getLazyField(results, 'reflectance')
+        data, mask = reflectance.readRoi(roi)
+        return KCube(data, reflectance.index).getOpd(useHannWindow=False, indexOpdStop=100, mask=mask)
@@ -43,9 +43,9 @@ from datetime import datetime
 import numpy as np
 import pandas as pd
 from numpy import ma
-import multiprocessing as mp
 import typing as t_
 from . import AbstractAnalysis, warnings, AbstractAnalysisSettings, AbstractHDFAnalysisResults
+from ._utility import _SharedArray
 from pwspy import dateTimeFormat
 import pwspy.dataTypes as pwsdt
 from pwspy.utility.reflection import reflectanceHelper, Material
@@ -102,7 +102,7 @@ class DynamicsAnalysis(AbstractAnalysis):
 
         self.refMean = ref.data.mean(axis=2)
         ref.normalizeByReference(self.refMean)  # We normalize so that the average is 1. This is for scaling purposes with the AC. Seems like the AC should be scale independent though, not sure.
-        self.refAc = ref.getAutocorrelation()[:, :, :settings.diffusionRegressionLength+1].mean(axis=(0, 1))  # We find the average autocorrlation of the background to cut down on noise, presumably this is uniform accross the field of view any way, right?
+        self.refAc = ref.getAutocorrelation(maxLag=settings.diffusionRegressionLength).mean(axis=(0, 1))  # We find the average autocorrlation of the background to cut down on noise, presumably this is uniform accross the field of view any way, right?
         self.refTag = ref.metadata.idTag
         self.erTag = extraReflectance.metadata.idTag if extraReflectance is not None else None
 
@@ -119,8 +119,7 @@ class DynamicsAnalysis(AbstractAnalysis):
             cube.subtractExtraReflection(self.extraReflection)
         cube.normalizeByReference(self.refMean)
 
-        cubeAc = cube.getAutocorrelation()
-        cubeAc = cubeAc[:, :, :self.settings.diffusionRegressionLength+1] # We are only going to use the first few time points of the ACF, we can get rid of the rest.
+        cubeAc = cube.getAutocorrelation(maxLag=self.settings.diffusionRegressionLength)  # We are only going to use the first few time points of the ACF, there is no need to calculate the rest.
         rms_t_squared = cubeAc[:, :, 0] - self.refAc[0]  # The rms^2 noise of the reference averaged over the whole image.
         rms_t_squared[rms_t_squared < 0] = 0  # Sometimes the above noise subtraction can cause some of our values to be barely below 0, that's going to be a problem.
         # If we didn't care about noise subtraction we could get rms_t as just `cube.data.std(axis=2)`
@@ -129,16 +128,19 @@ class DynamicsAnalysis(AbstractAnalysis):
         reflectance = cube.data.mean(axis=2)
 
         # Diffusion
-        cubeAc = ma.array(cubeAc)  # Convert to the numpy.MaskedArray type to help us mark some data as invalid.
-        cubeAc[cubeAc.data[:, :, 0] < np.sqrt(2)*self.refAc[0]] = ma.masked  # Remove pixels with low SNR. Default threshold removes values where 1st point of acf is less than sqrt(2) of background acf
-        ac = ma.array(cubeAc - self.refAc)  # Background subtracted autocorrelation function.
-        ac = ac / ac[:, :, 0][:, :, None]  # Normalize by the zero-lag value
-        ac[np.any(ac <= 0, axis=2)] = ma.masked  # Before taking the log of the autocorrelation any negative or zero values will cause problems. Remove the pixel entirely
+        valid = cubeAc[:, :, 0] >= np.sqrt(2)*self.refAc[0]  # Remove pixels with low SNR. Default threshold removes values where 1st point of acf is less than sqrt(2) of background acf
+        ac = cubeAc - self.refAc  # Background subtracted autocorrelation function.
+        with np.errstate(divide='ignore', invalid='ignore'):  # Invalid pixels are excluded below.
+            ac /= ac[:, :, :1]  # Normalize by the zero-lag value
+            val = np.log(ac)
+        valid &= np.isfinite(val).all(axis=2)  # Any negative or zero values of the autocorrelation result in an invalid logarithm. Remove the pixel entirely
 
         dt = (cube.times[-1] - cube.times[0]) / (len(cube.times) - 1) / 1e3  # Convert to seconds
         k = (self.n_medium * 2 * np.pi) / (cube.metadata.wavelength / 1e3)  # expressing wavelength in microns to match up with old matlab code.
-        val = np.log(ac) / (4 * k ** 2)  # See the `theory` section of the paper for an explanation of the 4k^2. The slope of log(ac) should be equivalent to 1/t_c in the paper.
-        d_slope = -self._maskedLinearRegression(val, dt)  # Get the slope of the autocorrelation. This is related to the diffusion in the cell. The minus is here to make the number positive, the slope is really negative.
+        val /= (4 * k ** 2)  # See the `theory` section of the paper for an explanation of the 4k^2. The slope of log(ac) should be equivalent to 1/t_c in the paper.
+        slope = self._linearRegression(val, dt)  # Get the slope of the autocorrelation. This is related to the diffusion in the cell.
+        slope[~valid] = 0
+        d_slope = ma.masked_array(-slope, mask=~valid)  # The minus is here to make the number positive, the slope is really negative.
 
         results = DynamicsAnalysisResults.create(meanReflectance=reflectance,
                                                  rms_t_squared=rms_t_squared,
@@ -152,47 +154,28 @@ class DynamicsAnalysis(AbstractAnalysis):
         return results, warns
 
     @staticmethod
-    def _maskedLinearRegression(arr: ma.MaskedArray, dt: float) -> np.ndarray:
+    def _linearRegression(arr: np.ndarray, dt: float) -> np.ndarray:
         """
         Takes a 3d ACF array as input and returns a 2d array indicating the slope along the 3rd dimension of the input array.
-        The dimensions of the output array match the first two dimensions of the input array. The input array can have invalid pixels masked out, this function
-        will exclude them from the calculation.
+        The dimensions of the output array match the first two dimensions of the input array. Since the time points are
+        evenly spaced the least squares slope is just a weighted sum along the 3rd dimension, so no fitting is required.
 
         Args:
-            arr: The masked 3D array of the autocorrelation function of each spectra.
+            arr: The 3D array of the autocorrelation function of each spectra.
             dt: The time interval between each element of the autocorrelation function.
         Returns:
             The 2D array containing the slope of each ACF at each pixel.
         """
-        origShape = arr.shape
-        y = np.reshape(arr, (origShape[0]*origShape[1], origShape[2]))  #Convert to a 2d array [pixels, time]. This is required by the polyfit function.
-        t = np.array([i*dt for i in range(origShape[2])]) # Generate a 1d array representing the time axis.
-        # Y = np.reshape(y[~y.mask], (np.sum((~y.mask).sum()//y.shape[1], y.shape[1])))  # Remove all the masked pixels since the polyfit function doesn't know what to do with them.
-        Y = np.reshape(y[~y.mask], ((~y.mask).sum()//y.shape[1], y.shape[1]))  # Remove all the masked pixels since the polyfit function doesn't know what to do with them.
-        coeff = np.polyfit(t, Y.T, deg=1)  # Linear fit
-        slope = coeff[0, :]  # Get the slope and ignore the y intercept
-        Slope = ma.zeros(y.shape[0]) # Create an empty masked array that includes all pixels again
-        Slope.mask = y.mask[:, 0] # Copy the original mask indicating which pixels are invalid.
-        Slope[~Slope.mask] = slope  # Fill our calculated slopes into the yunmasked pixels.
-        Slope = np.reshape(Slope, (origShape[0], origShape[1])) # Reshape back to a 2d image
-        return Slope
+        t = np.arange(arr.shape[2]) * dt  # Generate a 1d array representing the time axis.
+        t = t - t.mean()
+        weights = t / (t ** 2).sum()  # slope = sum((t - mean(t)) * y) / sum((t - mean(t))**2)
+        return arr @ weights
 
     def copySharedDataToSharedMemory(self): # Inherit docstring
-        refdata = mp.RawArray('f', self.refAc.size)
-        refdata = np.frombuffer(refdata, dtype=np.float32).reshape(self.refAc.shape)
-        np.copyto(refdata, self.refAc)
-        self.refAc = refdata
-
-        refmdata = mp.RawArray('f', self.refMean.size)
-        refmdata = np.frombuffer(refmdata, dtype=np.float32).reshape(self.refMean.shape)
-        np.copyto(refmdata, self.refMean)
-        self.refMean = refmdata
-
+        self.refAc = _SharedArray.fromArray(self.refAc)  # Pickling the shared array only transfers the name of the memory block.
+        self.refMean = _SharedArray.fromArray(self.refMean)
         if self.extraReflection is not None:
-            iedata = mp.RawArray('f', self.extraReflection.size)
-            iedata = np.frombuffer(iedata, dtype=np.float32).reshape(self.extraReflection.shape)
-            np.copyto(iedata, self.extraReflection)
-            self.extraReflection = iedata
+            self.extraReflection = _SharedArray.fromArray(self.extraReflection)
 
 
 class DynamicsAnalysisResults(AbstractHDFAnalysisResults): # Inherit docstring.
@@ -37,18 +37,21 @@ Inheritance
 """
 
 from __future__ import annotations
+import copy
 import dataclasses
+import functools
 import os
 import typing
 from datetime import datetime
 import numpy as np
 import pandas as pd
 from scipy import signal as sps
-import multiprocessing as mp
-from typing import Tuple, List, Optional
+from typing import Tuple, List, Optional, Sequence
 from ._abstract import AbstractHDFAnalysisResults, AbstractAnalysis, AbstractAnalysisResults, AbstractAnalysisSettings
+from ._utility import _SharedArray
 from . import warnings
 import pwspy.dataTypes as pwsdt
+from pwspy.dataTypes._data import _WavenumberResampler
 from pwspy import dateTimeFormat
 from pwspy.utility.reflection import reflectanceHelper, Material
 
@@ -80,6 +83,66 @@ def getFromDict(func):
     return newFunc
 
 
+class _PolynomialDetrender:
+    """Removes the least-squares polynomial fit from spectra. Since the wavenumbers are the same for every pixel the
+    fit is a linear projection onto the space of polynomials. An orthonormal basis `q` of the polynomial space is
+    precomputed so that detrending a cube only requires the low rank product `data - (data @ q) @ q.T`. Instances
+    should be retrieved with `fromWavenumbers` which caches the detrender for each set of wavenumbers and polynomial order.
+
+    Args:
+        wavenumbers: The wavenumbers associated with the last axis of the data to be detrended.
+        polynomialOrder: The order of the polynomial to fit.
+    """
+    def __init__(self, wavenumbers: Tuple[float, ...], polynomialOrder: int):
+        k = np.array(wavenumbers, dtype=np.float64)
+        k = (k - k.mean()) / (k.max() - k.min())  # Shifting and scaling doesn't change the polynomial space but greatly improves the conditioning.
+        # The first column of the vandermonde matrix is constant so the first column of `q` will be as well. The remaining columns are orthogonal to it and so have zero-mean.
+        self._basis, _ = np.linalg.qr(np.vander(k, polynomialOrder + 1, increasing=True))
+        self._typedBases = {}
+
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def fromWavenumbers(wavenumbers: Tuple[float, ...], polynomialOrder: int) -> _PolynomialDetrender:
+        """Get the detrender for a set of wavenumbers and polynomial order. Detrenders are cached so repeated calls with the same
+        arguments return the same object.
+
+        Args:
+            wavenumbers: The wavenumbers associated with the last axis of the data to be detrended. Must be hashable.
+            polynomialOrder: The order of the polynomial to fit.
+
+        Returns:
+            A polynomial detrender.
+        """
+        return _PolynomialDetrender(wavenumbers, polynomialOrder)
+
+    def apply(self, data: np.ndarray, out: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Subtract the polynomial fit from the last axis of `data`.
+
+        Args:
+            data: An array with spectra along the last axis.
+            out: An optional array of the same shape as `data` to store the residual in. Must not overlap `data`.
+
+        Returns:
+            A tuple containing: The residual after subtracting the polynomial fit, The standard deviation of the polynomial fit along the last axis.
+        """
+        dtype = np.float32 if data.dtype == np.float32 else np.float64
+        if dtype not in self._typedBases:
+            self._typedBases[dtype] = self._basis.astype(dtype)
+        basis = self._typedBases[dtype]
+        flattened = data.reshape((-1, data.shape[-1]))
+        if out is None:
+            out = np.empty(data.shape, dtype=dtype)
+        assert out.flags['C_CONTIGUOUS'], "`out` must be C-contiguous so that it can be written to through a reshaped view."
+        assert not np.may_share_memory(out, data), "`out` can't overlap `data`, the fit is written to it before being subtracted."
+        coefficients = flattened @ basis
+        outFlat = out.reshape(flattened.shape)
+        np.matmul(coefficients, basis.T, out=outFlat)  # The polynomial fit.
+        np.subtract(flattened, outFlat, out=outFlat)
+        # The polynomial fit of each pixel is `coefficients @ q.T`. Because `q` is orthonormal and only the first column has a non-zero mean the variance is just the sum of squares of the other coefficients.
+        rmsPoly = np.sqrt(np.einsum('ij,ij->i', coefficients[:, 1:], coefficients[:, 1:]) / data.shape[-1])
+        return out, rmsPoly.reshape(data.shape[:-1])
+
+
 class PWSAnalysis(AbstractAnalysis):
     """The standard PWS analysis routine. Initialize and then `run` for as many different PwsCubes as you want.
     For a given set of settings and reference you only need to instantiate one instance of this class. You can then perform `run`
@@ -93,12 +156,21 @@ class PWSAnalysis(AbstractAnalysis):
             ExtraReflectanceCube: Effectively identical to supplying an ERMataData object.
             ExtraReflectionCube: An object representing the stray reflection in units of counts/ms. It is up to the user to make sure that the data is scaled appropriately to match the data being analyzed.
         ref: The reference acquisition used for analysis.
+        tileRows: If `None` (default) each step of the analysis is applied to the full data cube in turn. Otherwise the
+            analysis is run in a fused mode where all steps are applied to blocks of `tileRows` rows of the image at a time.
+            This avoids the creation of many full-size temporary copies of the data, reducing peak memory usage to roughly
+            twice the size of the data cube. The results are equivalent to the default mode. In this mode the `PwsCube`
+            passed to `run` is not modified by the reference normalization and extra reflection subtraction.
     """
-    def __init__(self, settings: PWSAnalysisSettings, extraReflectance: typing.Optional[typing.Union[pwsdt.ERMetaData, pwsdt.ExtraReflectanceCube, pwsdt.ExtraReflectionCube]], ref: pwsdt.PwsCube):
+    def __init__(self, settings: PWSAnalysisSettings, extraReflectance: typing.Optional[typing.Union[pwsdt.ERMetaData, pwsdt.ExtraReflectanceCube, pwsdt.ExtraReflectionCube]], ref: pwsdt.PwsCube,
+                 tileRows: typing.Optional[int] = None):
         from pwspy.dataTypes import ExtraReflectanceCube
         super().__init__()
         self._initWarnings = []
         self.settings = settings
+        if tileRows is not None and tileRows < 1:
+            raise ValueError(f"`tileRows` must be a positive integer. Got {tileRows}.")
+        self.tileRows = tileRows
         if not ref.processingStatus.cameraCorrected:
             ref.correctCameraEffects(settings.cameraCorrection)
         if not ref.processingStatus.normalizedByExposure:
@@ -135,13 +207,77 @@ class PWSAnalysis(AbstractAnalysis):
             ref = ref / theoryR[None, None, :]  # now when we normalize by our reference we will get a result in units of physical reflectance rather than arbitrary units.
         self.ref = ref
         self.extraReflection = Iextra
+        # Build the wavelength->wavenumber resampling operator ahead of time. The tiled and masked modes use it directly and it is cached so `KCube.fromPwsCube` will reuse it.
+        slc = pwsdt.PwsCube._getIndexSlice(ref.wavelengths, settings.wavelengthStart, settings.wavelengthStop)
+        self._kResampler = _WavenumberResampler.fromWavelengths(tuple(ref.wavelengths[slc]))
+
+    def run(self, cube: pwsdt.PwsCube, mask: Optional[typing.Union[np.ndarray, pwsdt.Roi, typing.Sequence[pwsdt.Roi]]] = None) -> Tuple[PWSAnalysisResults, List[warnings.AnalysisWarning]]:
+        """Run the analysis on a PwsCube.
 
-    def run(self, cube: pwsdt.PwsCube) -> Tuple[PWSAnalysisResults, List[warnings.AnalysisWarning]]:  # Inherit docstring
+        Args:
+            cube: A data cube to be analyzed using the settings provided in the constructor of this class.
+            mask: If provided then only the pixels within the mask are analyzed, this can save a lot of time if only a
+                small portion of the image is of interest. Can be a 2D boolean array, an `Roi`, or a sequence of `Roi`s.
+                Pixels outside the mask are NaN in the results and `PWSAnalysisResults.analyzedMask` records which pixels
+                were analyzed. Note that in this mode the autocorrelation minimum subtraction uses the minimum over the
+                analyzed pixels rather than the whole image. The `PwsCube` is not modified by the reference normalization and
+                extra reflection subtraction.
+
+        Returns:
+            A new instance of analysis results and a list of warnings.
+        """
         if not cube.processingStatus.cameraCorrected:
             cube.correctCameraEffects(self.settings.cameraCorrection)
         if not cube.processingStatus.normalizedByExposure:
             cube.normalizeByExposure()
         warns = self._initWarnings
+        if mask is not None:
+            mask = self._combineMasks(mask, cube.shape[:2])
+            reflectance, cube, rms, rmsPoly, slope, rSquared, ld = self._runMasked(cube, mask)
+        elif self.tileRows is not None:
+            reflectance, cube, rms, rmsPoly, slope, rSquared, ld = self._runFused(cube)
+        else:
+            reflectance, cube, rms, rmsPoly, slope, rSquared, ld = self._runFullCube(cube)
+
+        results = PWSAnalysisResults.create(
+            meanReflectance=reflectance,
+            reflectance=cube,
+            rms=rms,
+            polynomialRms=rmsPoly,
+            autoCorrelationSlope=slope,
+            rSquared=rSquared,
+            ld=ld,
+            settings=self.settings,
+            imCubeIdTag=cube.metadata.idTag,
+            referenceIdTag=self.ref.metadata.idTag,
+            extraReflectionTag=self.extraReflection.metadata.idTag if self.extraReflection is not None else None,
+            analyzedMask=mask)
+        warns = [warn for warn in warns if warn is not None]  # Filter out null values.
+        return results, warns
+
+    @staticmethod
+    def _combineMasks(mask: typing.Union[np.ndarray, pwsdt.Roi, typing.Sequence[pwsdt.Roi]], shape: Tuple[int, int]) -> np.ndarray:
+        """Convert the `mask` argument of `run` to a single 2D boolean array."""
+        if isinstance(mask, pwsdt.Roi):
+            mask = [mask]
+        if isinstance(mask, np.ndarray):
+            combined = mask.astype(bool, copy=False)
+        else:
+            combined = np.zeros(shape, dtype=bool)
+            for roi in mask:
+                if roi.shape != tuple(shape):
+                    raise ValueError(f"The shape of the ROI {roi.shape} does not match the shape of the image {tuple(shape)}.")
+                combined[roi.getBoundingBox()] |= roi.croppedMask
+        if combined.shape != tuple(shape):
+            raise ValueError(f"The shape of the mask {combined.shape} does not match the shape of the image {tuple(shape)}.")
+        return combined
+
+    def _runFullCube(self, cube: pwsdt.PwsCube) -> Tuple[np.ndarray, pwsdt.KCube, np.ndarray, Optional[np.ndarray], Optional[np.ndarray], Optional[np.ndarray], Optional[np.ndarray]]:
+        """Run the analysis by applying each step to the entire data cube in turn.
+
+        Returns:
+            A tuple containing: meanReflectance, reflectance KCube, rms, polynomialRms, autoCorrelationSlope, rSquared, ld
+        """
         cube = self._normalizePwsCube(cube)
         interval = (max(cube.wavelengths) - min(cube.wavelengths)) / (len(cube.wavelengths) - 1)  # Wavelength interval. We are assuming equally spaced wavelengths here
         cube.data = self._filterSignal(cube.data, 1/interval)  # Used for denoising
@@ -150,10 +286,9 @@ class PWSAnalysis(AbstractAnalysis):
         # Determine the mean-reflectance for each pixel in the cell.
         reflectance = cube.data.mean(axis=2)
         cube = pwsdt.KCube.fromPwsCube(cube)  # -- Convert to K-Space
-        cube.data = self._filterWavenumber(cube, self.settings.waveNumberCutoff) # This step didn't exist until after pwspy 0.2.11. Rather than denoising it is intended to filter out high opd signals.
-        cubePoly = self._fitPolynomial(cube, self.settings.polynomialOrder)
+        cube.data = self._filterWavenumber(cube.data, cube.wavenumbers, self.settings.waveNumberCutoff) # This step didn't exist until after pwspy 0.2.11. Rather than denoising it is intended to filter out high opd signals.
         # Remove the polynomial fit from filtered cubeCell.
-        cube.data = cube.data - cubePoly
+        cube.data, rmsPoly = self._removePolynomial(cube.data, cube.wavenumbers, self.settings.polynomialOrder)
 
         # -- RMS
         # Obtain the RMS of each signal in the cube.
@@ -162,27 +297,133 @@ class PWSAnalysis(AbstractAnalysis):
             # RMS - POLYFIT
             # The RMS should be calculated on the mean-subtracted polyfit. This may
             # also be accomplished by calculating the standard-deviation. This is a pointless metric IMO.
-            rmsPoly = cubePoly.std(axis=2)
+            # `rmsPoly` was provided by `_removePolynomial`.
 
             slope, rSquared = cube.getAutoCorrelation(self.settings.autoCorrMinSub, self.settings.autoCorrStopIndex)
             ld = self._calculateLd(rms, slope)
         else:
             rmsPoly = slope = rSquared = ld = None
+        return reflectance, cube, rms, rmsPoly, slope, rSquared, ld
 
-        results = PWSAnalysisResults.create(
-            meanReflectance=reflectance,
-            reflectance=cube,
-            rms=rms,
-            polynomialRms=rmsPoly,
-            autoCorrelationSlope=slope,
-            rSquared=rSquared,
-            ld=ld,
-            settings=self.settings,
-            imCubeIdTag=cube.metadata.idTag,
-            referenceIdTag=self.ref.metadata.idTag,
-            extraReflectionTag=self.extraReflection.metadata.idTag if self.extraReflection is not None else None)
-        warns = [warn for warn in warns if warn is not None]  # Filter out null values.
-        return results, warns
+    def _runFused(self, cube: pwsdt.PwsCube) -> Tuple[np.ndarray, pwsdt.KCube, np.ndarray, Optional[np.ndarray], Optional[np.ndarray], Optional[np.ndarray], Optional[np.ndarray]]:
+        """Run the analysis with all steps fused together and applied to blocks of `self.tileRows` rows at a time. Only
+        the output KCube is allocated at full size, the data of `cube` is not modified.
+
+        Returns:
+            A tuple containing: meanReflectance, reflectance KCube, rms, polynomialRms, autoCorrelationSlope, rSquared, ld
+        """
+        self._checkUnprocessed(cube)
+        erData = self.extraReflection.data if self.extraReflection is not None else None
+        kData, wavenumbers, maps = self._analyzeSpectra(cube, erData, self.ref.data, cube.wavelengths, self.tileRows)  # Indexing the cube rather than its data only reads each tile of memory mapped data when it is needed.
+        return (maps[0], self._createKCube(kData, wavenumbers, cube)) + maps[1:]
+
+    def _runMasked(self, cube: pwsdt.PwsCube, mask: np.ndarray) -> Tuple[np.ndarray, pwsdt.KCube, np.ndarray, Optional[np.ndarray], Optional[np.ndarray], Optional[np.ndarray], Optional[np.ndarray]]:
+        """Run the analysis only for the spectra within `mask`. The spectra are gathered into a compact array, analyzed,
+        and then the results are scattered back into NaN-filled arrays the size of the image. The data of `cube` is not modified.
+
+        Returns:
+            A tuple containing: meanReflectance, reflectance KCube, rms, polynomialRms, autoCorrelationSlope, rSquared, ld
+        """
+        self._checkUnprocessed(cube)
+        # Each analyzed pixel becomes a row of a (N, 1, wavelength) array so that it can be processed like any other cube.
+        data = cube[mask][:, None, :]
+        erData = self.extraReflection.data[mask][:, None, :] if self.extraReflection is not None else None
+        refData = self.ref.data[mask][:, None, :]
+        tileRows = self.tileRows * cube.shape[1] if self.tileRows is not None else max(data.shape[0], 1)  # Tile by the same number of pixels as the fused mode would.
+        kData, wavenumbers, maps = self._analyzeSpectra(data, erData, refData, cube.wavelengths, tileRows)
+        fullKData = np.full(mask.shape + (len(wavenumbers),), np.nan, dtype=np.float32)
+        fullKData[mask] = kData[:, 0, :]
+        fullMaps = []
+        for m in maps:
+            if m is None:
+                fullMaps.append(None)
+            else:
+                fullMap = np.full(mask.shape, np.nan, dtype=m.dtype)
+                fullMap[mask] = m[:, 0]
+                fullMaps.append(fullMap)
+        return (fullMaps[0], self._createKCube(fullKData, wavenumbers, cube)) + tuple(fullMaps[1:])
+
+    def _checkUnprocessed(self, cube: pwsdt.PwsCube):
+        """The fused and masked modes don't modify the PwsCube, make sure it hasn't already been processed in a way that would invalidate the results."""
+        if self.extraReflection is not None:
+            assert cube.shape == self.extraReflection.data.shape
+            if cube.processingStatus.extraReflectionSubtracted:
+                raise Exception("The PwsCube has already has extra reflection subtracted.")
+        if cube.processingStatus.normalizedByReference:
+            raise Exception("This PwsCube has already been normalized by a reference.")
+
+    def _createKCube(self, kData: np.ndarray, wavenumbers: Tuple[float, ...], cube: pwsdt.PwsCube) -> pwsdt.KCube:
+        """Wrap an array of results in a KCube with metadata matching what `_runFullCube` would produce."""
+        slc = pwsdt.PwsCube._getIndexSlice(cube.wavelengths, self.settings.wavelengthStart, self.settings.wavelengthStop)
+        md = copy.deepcopy(cube.metadata)  # Match the metadata that `PwsCube.selIndex` would produce.
+        md.dict['wavelengths'] = cube.wavelengths[slc]
+        return pwsdt.KCube(kData, wavenumbers, metadata=md)
+
+    def _analyzeSpectra(self, data: typing.Union[np.ndarray, pwsdt.PwsCube], erData: Optional[np.ndarray], refData: np.ndarray, wavelengths: Sequence[float],
+                        tileRows: int) -> Tuple[np.ndarray, Tuple[float, ...], Tuple[np.ndarray, np.ndarray, Optional[np.ndarray], Optional[np.ndarray], Optional[np.ndarray], Optional[np.ndarray]]]:
+        """Apply all steps of the analysis to blocks of `tileRows` rows of a 3D array of spectra at a time, writing the results into
+        preallocated arrays. None of the input arrays are modified.
+
+        Args:
+            data: The 3D array of (camera corrected and exposure normalized) spectra. Can also be a `PwsCube`, which is indexed one tile at a time.
+            erData: The extra reflection to subtract from `data`. Same shape as `data`. Can be None.
+            refData: The reference spectra to normalize by. Same shape as `data`.
+            wavelengths: The wavelengths of the last axis of `data`.
+            tileRows: The number of rows of `data` to process at once.
+
+        Returns:
+            A tuple containing: The KCube data array, The wavenumbers of the KCube, A tuple of 2D arrays (meanReflectance, rms, polynomialRms, autoCorrelationSlope, rSquared, ld)
+        """
+        interval = (max(wavelengths) - min(wavelengths)) / (len(wavelengths) - 1)  # Wavelength interval. We are assuming equally spaced wavelengths here
+        slc = pwsdt.PwsCube._getIndexSlice(wavelengths, self.settings.wavelengthStart, self.settings.wavelengthStop)  # The rest of the analysis will be performed only on the selected wavelength range.
+        resampler = self._kResampler
+        if resampler.wavelengths != tuple(wavelengths[slc]):  # The cube doesn't have the same wavelengths as the reference.
+            resampler = _WavenumberResampler.fromWavelengths(tuple(wavelengths[slc]))
+        wavenumbers = resampler.wavenumbers
+        doAdvanced = not self.settings.skipAdvanced
+        shape2d = data.shape[:2]
+        kData = np.empty(shape2d + (len(wavenumbers),), dtype=np.float32)
+        reflectance = np.empty(shape2d, dtype=np.float32)
+        rms = np.empty(shape2d, dtype=np.float32)
+        if doAdvanced:
+            rmsPoly = np.empty(shape2d, dtype=np.float32)
+            slope = np.empty(shape2d, dtype=np.float32)
+            rSquared = np.empty(shape2d, dtype=np.float32)
+            acfMin = np.inf
+        else:
+            rmsPoly = slope = rSquared = ld = None
+
+        for start in range(0, shape2d[0], tileRows):
+            rows = slice(start, start + tileRows)
+            tile = data[rows]
+            if erData is not None:
+                tile = tile - erData[rows]
+            tile = tile / refData[rows]
+            tile = self._filterSignal(tile, 1/interval)  # Used for denoising
+            tile = tile[:, :, slc]
+            reflectance[rows] = tile.mean(axis=2)
+            tile = resampler.apply(tile.astype(np.float32, copy=False))  # -- Convert to K-Space
+            tile = self._filterWavenumber(tile, wavenumbers, self.settings.waveNumberCutoff)
+            tile, tileRmsPoly = self._removePolynomial(tile, wavenumbers, self.settings.polynomialOrder, out=kData[rows])
+            rms[rows] = tile.std(axis=2)
+            if doAdvanced:
+                rmsPoly[rows] = tileRmsPoly
+                if self.settings.autoCorrMinSub:
+                    _, tileAcfMin = pwsdt.KCube._getNormalizedAutocorrelation(tile, maxLag=1, returnMinimum=True)
+                    acfMin = min(acfMin, tileAcfMin)  # Minimum subtraction uses the minimum of the whole cube, we'll need a second pass.
+                else:
+                    acf = pwsdt.KCube._getNormalizedAutocorrelation(tile, maxLag=self.settings.autoCorrStopIndex)
+                    slope[rows], rSquared[rows] = pwsdt.KCube._fitAutocorrelation(acf, wavenumbers, self.settings.autoCorrStopIndex)
+
+        if doAdvanced:
+            if self.settings.autoCorrMinSub:
+                for start in range(0, shape2d[0], tileRows):
+                    rows = slice(start, start + tileRows)
+                    # `acfMin` was calculated with the FFT, use it here too so that the offset exactly matches the ACF it is subtracted from.
+                    acf = pwsdt.KCube._getNormalizedAutocorrelation(kData[rows], maxLag=self.settings.autoCorrStopIndex, directSum=False)
+                    slope[rows], rSquared[rows] = pwsdt.KCube._fitAutocorrelation(acf, wavenumbers, self.settings.autoCorrStopIndex, offset=acfMin)
+            ld = self._calculateLd(rms, slope)
+        return kData, wavenumbers, (reflectance, rms, rmsPoly, slope, rSquared, ld)
 
     def _normalizePwsCube(self, cube: pwsdt.PwsCube) -> pwsdt.PwsCube:
         if self.extraReflection is not None:
@@ -198,43 +439,42 @@ class PWSAnalysis(AbstractAnalysis):
             return sps.filtfilt(b, a, data, axis=2).astype(data.dtype)  # Actually do the filtering on the data.
 
     @staticmethod
-    def _filterWavenumber(cube: pwsdt.KCube, cutoff: float):
+    def _filterWavenumber(data: np.ndarray, wavenumbers: typing.Sequence[float], cutoff: float):
         """
 
         Args:
-            cube: A pwspy KCube
+            data: A 3D array of KCube data with wavenumber along the last axis. This can be a portion of a full KCube.
+            wavenumbers: The wavenumbers associated with the last axis of `data`.
             cutoff: The cutoff frequency of the filter, in units of um (inverse wavenumber)
 
         Returns:
             The data after being low-pass filtered.
         """
         if cutoff is None: # skip filtering
-            return cube.data
+            return data
         else:
             # Wavenumber interval. We are assuming equally spaced wavenumbers here. Units: Radians/um
-            interval = (max(cube.wavenumbers) - min(cube.wavenumbers)) / (len(cube.wavenumbers) - 1)
+            interval = (max(wavenumbers) - min(wavenumbers)) / (len(wavenumbers) - 1)
 
             sampleFreq =  2 * np.pi / interval # In units of um (inverse wavenumber)
             sos = sps.butter(2, cutoff, fs=sampleFreq, output='sos')
-            return sps.sosfiltfilt(sos, cube.data, axis=2).astype(cube.data.dtype)
+            return sps.sosfiltfilt(sos, data, axis=2).astype(data.dtype)
 
     # -- Polynomial Fit
     @staticmethod
-    def _fitPolynomial(cube: pwsdt.KCube, polynomialOrder: int):
-        polynomialOrder
-        flattenedData = cube.data.reshape((cube.data.shape[0] * cube.data.shape[1], cube.data.shape[2]))
-        # Flatten the array to 2d and put the wavenumber axis first.
-        flattenedData = np.rollaxis(flattenedData, 1)
-        # make an empty array to hold the fit values.
-        cubePoly = np.zeros(flattenedData.shape, dtype=cube.data.dtype)
-        # At this point polydata goes from holding the cube data to holding the polynomial values for each pixel. still 2d.
-        polydata = np.polyfit(cube.wavenumbers, flattenedData, polynomialOrder)
-        for i in range(polynomialOrder + 1):
-            # Populate cubePoly with the fit values.
-            cubePoly += (np.array(cube.wavenumbers)[:, np.newaxis] ** i) * polydata[polynomialOrder - i, :]
-        cubePoly = np.moveaxis(cubePoly, 0, 1)
-        cubePoly = cubePoly.reshape(cube.data.shape)  # reshape back to a cube.
-        return cubePoly
+    def _removePolynomial(data: np.ndarray, wavenumbers: typing.Sequence[float], polynomialOrder: int, out: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Remove the least-squares polynomial fit from each spectrum of `data`.
+
+        Args:
+            data: A 3D array of KCube data with wavenumber along the last axis. This can be a portion of a full KCube.
+            wavenumbers: The wavenumbers associated with the last axis of `data`.
+            polynomialOrder: The order of the polynomial to fit.
+            out: An optional array of the same shape as `data` to store the residual in.
+
+        Returns:
+            A tuple containing: The data with the polynomial fit subtracted, The standard deviation of the polynomial fit for each pixel.
+        """
+        return _PolynomialDetrender.fromWavenumbers(tuple(wavenumbers), polynomialOrder).apply(data, out=out)
 
     # Ld Calculation
     @staticmethod
@@ -248,16 +488,9 @@ class PWSAnalysis(AbstractAnalysis):
         return ld
 
     def copySharedDataToSharedMemory(self):  # Inherit docstring
-        refdata = mp.RawArray('f', self.ref.data.size)  # Create an empty ctypes array of shared memory
-        refdata = np.frombuffer(refdata, dtype=np.float32).reshape(self.ref.data.shape)  # Wrap the shared memory array in a numpy array and reshape back to origianl shape
-        np.copyto(refdata, self.ref.data)  # Copy our PwsCubes data to the shared memory array.
-        self.ref.data = refdata # Reassign the shared memory array to our PwsCube object data attribute.
-
+        self.ref.data = _SharedArray.fromArray(self.ref.data)  # Pickling the shared array only transfers the name of the memory block.
         if self.extraReflection is not None:
-            iedata = mp.RawArray('f', self.extraReflection.data.size)
-            iedata = np.frombuffer(iedata, dtype=np.float32).reshape(self.extraReflection.data.shape)
-            np.copyto(iedata, self.extraReflection.data)
-            self.extraReflection.data = iedata
+            self.extraReflection.data = _SharedArray.fromArray(self.extraReflection.data)
 
 
 class NCADCPWSAnalysis(AbstractAnalysis):
@@ -273,14 +506,14 @@ class NCADCPWSAnalysis(AbstractAnalysis):
         adcSpectra = self._getADCSpectra(self._pwsAnalysis.ref)
         self._pwsAnalysis.ref.data = self._pwsAnalysis.ref.data - adcSpectra
 
-    def run(self, cube: pwsdt.PwsCube) -> Tuple[PWSAnalysisResults, List[warnings.AnalysisWarning]]:
+    def run(self, cube: pwsdt.PwsCube, mask: Optional[typing.Union[np.ndarray, pwsdt.Roi, typing.Sequence[pwsdt.Roi]]] = None) -> Tuple[PWSAnalysisResults, List[warnings.AnalysisWarning]]:  # See PWSAnalysis.run for docstring
         if not cube.processingStatus.cameraCorrected:
             cube.correctCameraEffects(self._pwsAnalysis.settings.cameraCorrection, binning=1) # Binning isn't stored in Nano data. assume binning is 1
         if not cube.processingStatus.normalizedByExposure:
             cube.normalizeByExposure()
         adcSpectra = self._getADCSpectra(cube)
         cube.data = cube.data - adcSpectra
-        return self._pwsAnalysis.run(cube)
+        return self._pwsAnalysis.run(cube, mask=mask)
 
     def copySharedDataToSharedMemory(self):
         self._pwsAnalysis.copySharedDataToSharedMemory()
@@ -298,7 +531,7 @@ class PWSAnalysisResults(AbstractHDFAnalysisResults):
     @staticmethod
     def fields():  # Inherit docstring
         return ('time', 'reflectance', 'meanReflectance', 'rms', 'polynomialRms', 'autoCorrelationSlope', 'rSquared',
-                'ld', 'imCubeIdTag', 'referenceIdTag', 'extraReflectionTag', 'settings')
+                'ld', 'imCubeIdTag', 'referenceIdTag', 'extraReflectionTag', 'settings', 'analyzedMask')
 
     @staticmethod
     def name2FileName(name: str) -> str:  # Inherit docstring
@@ -311,7 +544,7 @@ class PWSAnalysisResults(AbstractHDFAnalysisResults):
     @classmethod
     def create(cls, settings: PWSAnalysisSettings, reflectance: pwsdt.KCube, meanReflectance: np.ndarray, rms: np.ndarray,
                polynomialRms: np.ndarray, autoCorrelationSlope: np.ndarray, rSquared: np.ndarray, ld: np.ndarray,
-               imCubeIdTag: str, referenceIdTag: str, extraReflectionTag: Optional[str]):  # Inherit docstring
+               imCubeIdTag: str, referenceIdTag: str, extraReflectionTag: Optional[str], analyzedMask: Optional[np.ndarray] = None):  # Inherit docstring
         d = {'time': datetime.now().strftime(dateTimeFormat),
             'reflectance': reflectance,
             'meanReflectance': meanReflectance,
@@ -323,7 +556,8 @@ class PWSAnalysisResults(AbstractHDFAnalysisResults):
             'imCubeIdTag': imCubeIdTag,
             'referenceIdTag': referenceIdTag,
             'extraReflectionTag': extraReflectionTag,
-            'settings': settings}
+            'settings': settings,
+            'analyzedMask': analyzedMask}
         return cls(None, d)
 
     @AbstractHDFAnalysisResults.FieldDecorator
@@ -406,6 +640,14 @@ class PWSAnalysisResults(AbstractHDFAnalysisResults):
         """The `idtag` of the extra reflectance correction used."""
         return bytes(np.array(self.file['extraReflectionTag'])).decode()
 
+    @AbstractHDFAnalysisResults.FieldDecorator
+    def analyzedMask(self) -> Optional[np.ndarray]:
+        """A 2D boolean array indicating which pixels were analyzed. `None` if the whole image was analyzed. Pixels that
+        weren't analyzed are NaN in the other fields."""
+        if 'analyzedMask' not in self.file:  # The whole image was analyzed, or the file predates this field.
+            return None
+        return np.array(self.file['analyzedMask'])
+
     def releaseMemory(self):
         """
         The cached properties continue to stay in RAM until they are deleted, this method deletes all cached data to release the memory.
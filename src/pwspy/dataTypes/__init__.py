@@ -57,10 +57,29 @@ Other Classes
     :nosignatures:
 
     Roi
+    RoiLabelImage
     RoiFile
     CameraCorrection
     Acquisition
     FluorescenceImage
+    MetadataIndex
+    FixedPointCodec
+    HDFCompression
+
+FFT Backends
+--------------
+The FFT implementation used by the data classes can be selected with `setFFTBackend`. By default numpy is used.
+
+.. autosummary::
+    :toctree: generated/
+    :nosignatures:
+
+    FFTBackend
+    NumpyFFTBackend
+    ScipyFFTBackend
+    PyFFTWBackend
+    getFFTBackend
+    setFFTBackend
 
 Inheritance
 -------------
@@ -75,13 +94,19 @@ import os
 _jsonSchemasPath = os.path.join(os.path.split(__file__)[0], 'jsonSchemas')
 from ._metadata import (PwsMetaData, Acquisition, DynMetaData, ERMetaData, FluorMetaData, AnalysisManager, MetaDataBase,
                         MetaDataBase)
-from ._other import Roi, CameraCorrection, RoiFile
+from ._other import Roi, RoiLabelImage, CameraCorrection, RoiFile
 from ._data import (FluorescenceImage, ExtraReflectanceCube, ExtraReflectionCube, PwsCube, KCube, DynCube, ICBase,
                     ICRawBase)
+from ._metadataIndex import MetadataIndex
+from ._fixedPoint import FixedPointCodec
+from ._compression import HDFCompression
+from ._fft import FFTBackend, NumpyFFTBackend, ScipyFFTBackend, PyFFTWBackend, getFFTBackend, setFFTBackend
 
 __all__ = ['PwsMetaData', 'Acquisition', 'DynMetaData', 'ERMetaData', 'FluorMetaData', 'AnalysisManager', 'MetaDataBase',
            'MetaDataBase', 'Roi', 'CameraCorrection', 'FluorescenceImage', 'ExtraReflectionCube',
-           'ExtraReflectanceCube', 'PwsCube', 'KCube', 'DynCube', 'ICBase', 'ICRawBase', 'RoiFile']
+           'ExtraReflectanceCube', 'PwsCube', 'KCube', 'DynCube', 'ICBase', 'ICRawBase', 'RoiFile', 'FFTBackend',
+           'NumpyFFTBackend', 'ScipyFFTBackend', 'PyFFTWBackend', 'getFFTBackend', 'setFFTBackend', 'MetadataIndex',
+           'RoiLabelImage', 'FixedPointCodec', 'HDFCompression']
 
 
 
@@ -0,0 +1,97 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Selection of the HDF5 compression filters used when saving data cubes and analysis results.
+"""
+from __future__ import annotations
+import dataclasses
+import typing as t_
+
+try:
+    import hdf5plugin  # Importing this registers the Blosc and Zstd filters with HDF5 so that files using them can also be read.
+except ImportError:
+    hdf5plugin = None
+
+__all__ = ['HDFCompression']
+
+
+@dataclasses.dataclass(frozen=True)
+class HDFCompression:
+    """Describes how HDF5 datasets should be compressed. `gzip` and `lzf` are always available. `blosc` and `zstd`
+    require the optional `hdf5plugin` package, which must also be installed to read files that were saved with them.
+
+    Args:
+        filter: The compression filter to use. One of `None` (no compression), 'gzip', 'lzf', 'blosc', or 'zstd'.
+        level: The compression level. Higher levels give smaller files but are slower to write. If `None` then a default
+            level is used for the filter. Not used by 'lzf'.
+        shuffle: If True then the bytes of each value are reordered before compression so that bytes of equal
+            significance are stored together. This usually improves the compression of numerical data at very little cost.
+        bloscCompressor: The compressor used internally by the 'blosc' filter. e.g. 'lz4', 'zstd', 'zlib'.
+    """
+    filter: t_.Optional[str] = None
+    level: t_.Optional[int] = None
+    shuffle: bool = False
+    bloscCompressor: str = 'lz4'
+
+    _defaultLevels = {'gzip': 4, 'blosc': 5, 'zstd': 3}
+
+    def __post_init__(self):
+        if self.filter not in (None, 'gzip', 'lzf', 'blosc', 'zstd'):
+            raise ValueError(f"Compression filter {self.filter} is not supported.")
+
+    @classmethod
+    def fromValue(cls, value: t_.Union[None, str, int, HDFCompression]) -> HDFCompression:
+        """Interpret the `compression` argument accepted by the saving methods of PWSpy.
+
+        Args:
+            value: Either an `HDFCompression`, the name of a filter, an integer gzip level (as accepted by h5py) or `None`.
+
+        Returns:
+            The equivalent `HDFCompression`.
+        """
+        if isinstance(value, HDFCompression):
+            return value
+        elif value is None:
+            return cls()
+        elif isinstance(value, bool):
+            raise TypeError("`compression` can't be a boolean.")
+        elif isinstance(value, int):
+            return cls('gzip', level=value)
+        elif isinstance(value, str):
+            return cls(value)
+        raise TypeError(f"`compression` of type {type(value)} is not supported.")
+
+    def toDatasetKwargs(self) -> t_.Dict[str, t_.Any]:
+        """
+        Returns:
+            The keyword arguments that should be passed to `h5py.Group.create_dataset`.
+        """
+        level = self.level if self.level is not None else self._defaultLevels.get(self.filter)
+        if self.filter is None:
+            return {'shuffle': True} if self.shuffle else {}
+        elif self.filter == 'gzip':
+            return {'compression': 'gzip', 'compression_opts': level, 'shuffle': self.shuffle}
+        elif self.filter == 'lzf':
+            return {'compression': 'lzf', 'shuffle': self.shuffle}
+        if hdf5plugin is None:
+            raise ImportError(f"The `hdf5plugin` package is required to use the {self.filter} compression filter.")
+        if self.filter == 'blosc':  # Blosc does its own shuffling which is faster than the HDF5 shuffle filter.
+            shuffle = hdf5plugin.Blosc.SHUFFLE if self.shuffle else hdf5plugin.Blosc.NOSHUFFLE
+            return dict(hdf5plugin.Blosc(cname=self.bloscCompressor, clevel=level, shuffle=shuffle))
+        else:  # zstd
+            return dict(hdf5plugin.Zstd(clevel=level), shuffle=self.shuffle)
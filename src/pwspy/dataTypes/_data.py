@@ -17,6 +17,7 @@
 
 from __future__ import annotations
 import copy
+import functools
 import json
 import logging
 import multiprocessing as mp
@@ -32,10 +33,13 @@ import numpy as np
 import pandas as pd
 import tifffile as tf
 from matplotlib import pyplot as plt, widgets
-from scipy import interpolate as spi
+from scipy import sparse
 from scipy.io import savemat
 from . import _metadata as pwsdtmd
 from . import _other
+from ._fft import getFFTBackend
+from ._fixedPoint import FixedPointCodec
+from ._compression import HDFCompression
 if t_.TYPE_CHECKING:
     from ..utility.reflection import Material
 
@@ -49,17 +53,56 @@ class ICBase(ABC):
         data (np.ndarray): A 3-dimensional array containing the data the dimensions should be [Y, X, Z] where X and Y are the spatial coordinates of the image
             and Z corresponds to the `index` dimension, e.g. wavelength, wavenumber, time, etc.
         index (tuple(Number)): A tuple containing the values of the index for the data. This could be a tuple of wavelength values, times (in the case of Dyanmics), etc.
-        dtype (type): the data type that the data should be stored as. The default is numpy.float32.
+        dtype (type): the data type that the data should be stored as. The default is numpy.float32. If `data` already
+            has this type then it is used directly rather than being copied.
+            If `data` is a `numpy.memmap` then it is kept as a read-only view of the file and each region is only read and
+            converted to `dtype` when it is indexed (e.g. `cube[rows]`). Accessing the `data` attribute loads the whole array.
     """
     _index: tuple
-    data: np.ndarray
 
     def __init__(self, data: np.ndarray, index: tuple, dtype=np.float32):
         assert isinstance(data, np.ndarray)
-        self.data = data.astype(dtype)
+        if isinstance(data, np.memmap):
+            self._data = data
+            self._lazyDtype = dtype
+            self._pendingOperations = []  # Elementwise operations that will be applied to the data when it is read.
+        else:
+            self.data = data.astype(dtype, copy=False)
         self._index = index
-        if self.data.shape[2] != len(self.index):
-            raise ValueError(f"The length of the index list doesn't match the index axis of the data array. Got {len(self.index)}, expected {self.data.shape[2]}.")
+        if self.shape[2] != len(self.index):
+            raise ValueError(f"The length of the index list doesn't match the index axis of the data array. Got {len(self.index)}, expected {self.shape[2]}.")
+
+    @property
+    def data(self) -> np.ndarray:
+        """The 3D array of data. For memory mapped data the whole array is loaded into memory the first time this is accessed."""
+        if self._pendingOperations is not None:
+            self.data = self._evaluateLazy(self._data)
+        return self._data
+
+    @data.setter
+    def data(self, data: np.ndarray):
+        self._data = data
+        self._pendingOperations = None
+
+    @property
+    def shape(self) -> t_.Tuple[int, ...]:
+        """The shape of the data array. Unlike `data.shape` this doesn't load memory mapped data."""
+        return self._data.shape
+
+    def _evaluateLazy(self, data: np.ndarray) -> np.ndarray:
+        """Convert a region of memory mapped data to a C-ordered array and apply any deferred operations to it."""
+        data = np.array(data, dtype=self._lazyDtype, order='C')
+        for operation in self._pendingOperations:
+            data = operation(data)
+        return data
+
+    def _applyElementwise(self, operation: t_.Callable[[np.ndarray], np.ndarray]):
+        """Apply an elementwise `operation` to the data. For memory mapped data the operation is deferred until the data is read.
+        `operation` should be picklable (e.g. a `functools.partial` of a module level function)."""
+        if self._pendingOperations is not None:
+            self._pendingOperations.append(operation)
+        else:
+            self.data = operation(self.data)
 
     @property
     @abstractmethod
@@ -100,13 +143,14 @@ class ICBase(ABC):
         Returns:
             The average spectra within the region, the standard deviation of the spectra within the region
         """
+        region = (slice(None), slice(None))
         if isinstance(mask, _other.Roi):
-            mask = mask.mask
+            region = mask.getBoundingBox()  # Only read the data that we need, this matters for memory mapped data.
+            mask = mask.croppedMask
         if mask is None: #Make a mask that includes everything
-            mask = np.ones(self.data.shape[:-1], dtype=np.bool)
-        mean = self.data[mask].mean(axis=0)
-        std = self.data[mask].std(axis=0)
-        return mean, std
+            mask = np.ones(self.shape[:-1], dtype=np.bool)
+        values = self[region][mask]
+        return values.mean(axis=0), values.std(axis=0)
 
     def selectLassoROI(self, displayIndex: t_.Optional[int] = None, clim: t_.Sequence = None) -> _other.Roi:
         """
@@ -169,6 +213,8 @@ class ICBase(ABC):
         return np.array(verts[0])
 
     def __getitem__(self, slic):
+        if self._pendingOperations is not None:
+            return self._evaluateLazy(self._data[slic])  # Only read and convert the requested region of memory mapped data.
         return self.data[slic]
 
     def filterDust(self, sigma: float, pixelSize: float):
@@ -193,7 +239,15 @@ class ICBase(ABC):
             stop: The ending value of the index in the new object. Pass `None` to include everything.
         Returns:
             A new instance of ICBase with only data from `start` to `stop` in the `index`."""
-        wv = np.array(self.index)
+        slc = self._getIndexSlice(self.index, start, stop)
+        data = self.data[:, :, slc].copy()  # The new object shouldn't share memory with this one.
+        index = self.index[slc]
+        return data, index
+
+    @staticmethod
+    def _getIndexSlice(index: t_.Sequence[float], start: t_.Optional[float], stop: t_.Optional[float]) -> slice:
+        """Find the slice of `index` that is used by `selIndex`. The nearest values to `start` and `stop` are both included."""
+        wv = np.array(index)
         if start is None:
             iStart = None
         else:
@@ -205,9 +259,7 @@ class ICBase(ABC):
             iStop += 1  # include the end point
             if iStop >= len(wv):  # Include everything
                 iStop = None
-        data = self.data[:, :, iStart:iStop]
-        index = self.index[iStart:iStop]
-        return data, index
+        return slice(iStart, iStop)
 
     def _add(self, other: t_.Union['self.__class__', numbers.Real, np.ndarray]) -> 'self.__class__':  #TODO these don't return the right datatype. They should probably just be gotten rid of
         if isinstance(other, self.__class__):
@@ -280,7 +332,10 @@ class ICBase(ABC):
         new.data = ret
         return new
 
-    def toHdfDataset(self, g: h5py.Group, name: str, fixedPointCompression: bool = True, compression: str = None) -> h5py.Group:
+    _hdfTileSize = 64  # The X and Y size of the chunks that the data is stored in when saved to HDF.
+
+    def toHdfDataset(self, g: h5py.Group, name: str, fixedPointCompression: t_.Union[bool, FixedPointCodec] = True, compression: t_.Union[None, str, int, HDFCompression] = None,
+                     chunks: t_.Union[bool, t_.Tuple[int, int, int]] = True) -> h5py.Group:
         """
         Save the data of this class to a new HDF dataset.
 
@@ -289,59 +344,77 @@ class ICBase(ABC):
             name (str): the name of the new HDF dataset in group `g`.
             fixedPointCompression (bool): if True then save the data in a special 16bit fixed-point format. Testing has shown that this has a
                 maximum conversion error of 1.4e-3 percent. Saving is ~10% faster but requires only 50% the hard drive space.
-            compression: The value of this argument will be passed to h5py.create_dataset for numpy arrays. See h5py documentation for available options.
+                A `FixedPointCodec` can also be provided to control how the data is scaled, e.g. `FixedPointCodec(perTile=True)`.
+            compression: The compression filter to use. Either an `HDFCompression` or a value that h5py accepts for the
+                `compression` argument of `create_dataset`, e.g. 'gzip', 'lzf', or a gzip level.
+            chunks: If True (default) the data is stored in chunks of small spatial tiles that each contain the full
+                spectrum. This allows a small region of the data to be read from file without reading the whole dataset.
+                If False the data is stored contiguously. A tuple can also be provided to specify the shape of the chunks.
 
         Returns:
             h5py.Group: This is the the same h5py.Group that was passed in a `g`. It should now have a new dataset by the name of 'name'
         """
-
+        if chunks is True:
+            chunks = self._getHdfChunks(self.data.shape)
+        elif chunks is False:
+            chunks = None
+        compression = HDFCompression.fromValue(compression).toDatasetKwargs()
         if fixedPointCompression:
             # Scale data to span the full range of an unsigned 16bit integer. save as integer and save the min and max
             # needed to scale back to the original data. Testing has shown that this has a maximum conversion error of 1.4e-3 percent.
             # Saving is ~10% faster but requires only 50% the hard drive space. Time can be traded for space by using compression
             # when creating the dataset
-            m = self.data.min()
-            M = self.data.max()
-            fpData = self.data - m
-            fpData = fpData / (M - m)
-            fpData *= (2 ** 16 - 1)
-            fpData = fpData.astype(np.uint16)
-            dset = g.create_dataset(name, data=fpData, compression=compression)  # , chunks=(64,64,self.data.shape[2]), compression=2)
+            codec = fixedPointCompression if isinstance(fixedPointCompression, FixedPointCodec) else FixedPointCodec()
+            tileShape = chunks[:2] if chunks is not None else (self._hdfTileSize, self._hdfTileSize)
+            dset = codec.toHdfDataset(g, name, self.data, tileShape, chunks=chunks, **compression)
             dset.attrs['index'] = np.array(self.index)
             dset.attrs['type'] = np.string_(f"{self._hdfTypeName}_fp")
-            dset.attrs['min'] = m
-            dset.attrs['max'] = M
         else:
-            dset = g.create_dataset(name, data=self.data, compression=compression)
+            dset = g.create_dataset(name, data=self.data, chunks=chunks, **compression)
             dset.attrs['index'] = np.array(self.index)
             dset.attrs['type'] = np.string_(self._hdfTypeName)
         return g
 
     @classmethod
-    def decodeHdf(cls, d: h5py.Dataset) -> t_.Tuple[np.array, t_.Tuple[float, ...]]:
+    def _getHdfChunks(cls, shape: t_.Tuple[int, ...]) -> t_.Optional[t_.Tuple[int, ...]]:
+        """Get the HDF chunk shape for an array of `shape`. Spatial tiles with the full length of the last axis."""
+        if 0 in shape:
+            return None  # HDF5 doesn't allow zero-sized chunks.
+        return tuple(min(cls._hdfTileSize, i) for i in shape[:2]) + tuple(shape[2:])
+
+    @classmethod
+    def decodeHdf(cls, d: h5py.Dataset, region: t_.Optional[t_.Tuple[slice, ...]] = None) -> t_.Tuple[np.array, t_.Tuple[float, ...]]:
         """
         Load a new instance of ICBase from an `h5py.Dataset`
 
         Args:
             d: The dataset that the ICBase has been saved to
+            region: An optional tuple of slices. If provided then only this region of the dataset will be read from file.
 
         Returns:
             A tuple containing: (data: The 3D array of `data`,  index: A tuple containing the `index`)
         """
         assert 'type' in d.attrs
         assert 'index' in d.attrs
-        if d.attrs['type'].decode() == cls._hdfTypeName: #standard decoding
-            return np.array(d), tuple(d.attrs['index'])
-        elif d.attrs['type'].decode() == f"{cls._hdfTypeName}_fp": #Fixed point decoding
-            M = d.attrs['max']
-            m = d.attrs['min']
-            arr = np.array(d)
-            arr = arr.astype(np.float32) / (2 ** 16 - 1)
-            arr *= (M - m)
-            arr += m
-            return arr, tuple(d.attrs['index'])
-        else:
+        if d.attrs['type'].decode() not in (cls._hdfTypeName, f"{cls._hdfTypeName}_fp"):
             raise TypeError(f"Got {d.attrs['type'].decode()} instead of {cls._hdfTypeName}")
+        return cls._decodeHdfData(d, region), tuple(d.attrs['index'])
+
+    @staticmethod
+    def _decodeHdfData(d: h5py.Dataset, region: t_.Optional[t_.Tuple[slice, ...]] = None) -> np.ndarray:
+        """Read the data array (or just `region` of it) from a dataset saved by `toHdfDataset`, undoing fixed point
+        compression if it was used. Unlike `decodeHdf` this doesn't check which class saved the dataset."""
+        if d.attrs['type'].decode().endswith('_fp'):  #Fixed point decoding
+            return FixedPointCodec.decode(d, region)
+        return d[()] if region is None else d[region]
+
+
+def _subtract(data: np.ndarray, value: float) -> np.ndarray:
+    return data - value
+
+
+def _divide(data: np.ndarray, value: float) -> np.ndarray:
+    return data / value
 
 
 class ICRawBase(ICBase, ABC):
@@ -355,7 +428,8 @@ class ICRawBase(ICBase, ABC):
         index: A tuple containing the values of the index for the data. This could be a tuple of wavelength values, times (in the case of Dynamics), etc.
         metadata: The metadata object associated with this data object.
         processingStatus: An object that keeps track of which processing steps and corrections have been applied to this object.
-        dtype (type): the data type that the data should be stored as. The default is numpy.float32.
+        dtype (type): the data type that the data should be stored as. The default is numpy.float32. If `data` already
+            has this type then it is used directly rather than being copied.
     """
 
     @dataclass
@@ -389,11 +463,52 @@ class ICRawBase(ICBase, ABC):
             raise Exception(
                 "This PwsCube has not yet been corrected for camera effects. are you sure you want to normalize by exposure?")
         if not self.processingStatus.normalizedByExposure:
-            self.data = self.data / self.metadata.exposure
+            self._applyElementwise(functools.partial(_divide, value=self.metadata.exposure))
         else:
             raise Exception("The PwsCube has already been normalized by exposure.")
         self.processingStatus.normalizedByExposure = True
 
+    _tiffPagesPerBlock = 32  # The number of tiff pages that `_readTiffPages` transposes into the output array at once.
+
+    @staticmethod
+    def _readTiffPages(path: str, lock: t_.Optional[mp.Lock], out: t_.Optional[np.ndarray] = None) -> np.ndarray:
+        """Read a 3D tiff file one page at a time, writing the pages directly into a float32 array with dimensions
+        (Y, X, Z). This avoids building an intermediate (Z, Y, X) copy of the data. If a lock is provided then it is only held
+        while each page is read so that other threads or processes can use the disk in between.
+
+        Args:
+            path: The path to the tiff file.
+            lock: A `Lock` object used to synchronized IO in multithreading and multiprocessing applications.
+            out: An optional preallocated array to write the data into, e.g. an array in shared memory.
+
+        Returns:
+            The data array. This will be `out` if it was provided.
+        """
+        with tf.TiffFile(path) as tif:
+            series = tif.series[0]
+            if len(series.shape) != 3:
+                raise ValueError(f"Expected a 3D tiff file. Got shape {series.shape} from {path}")
+            shape = series.shape[1:] + series.shape[:1]  # Swap axes to match y,x,lambda convention.
+            if out is None:
+                out = np.empty(shape, dtype=np.float32)
+            elif out.shape != shape:
+                raise ValueError(f"`out` has shape {out.shape}, expected {shape}")
+            # Writing a single page into `out` is a very strided copy. It is much faster to transpose a small stack of pages at once.
+            stack = np.empty((ICRawBase._tiffPagesPerBlock,) + shape[:2], dtype=series.dtype)
+            pages = series.pages
+            for start in range(0, shape[2], stack.shape[0]):
+                n = min(stack.shape[0], shape[2] - start)
+                for i in range(n):
+                    if lock is not None:
+                        lock.acquire()
+                    try:
+                        stack[i] = pages[start + i].asarray()
+                    finally:
+                        if lock is not None:
+                            lock.release()
+                out[:, :, start:start + n] = stack[:n].transpose(1, 2, 0)
+        return out
+
     def correctCameraEffects(self, correction: _other.CameraCorrection = None, binning: int = None):
         """Subtracts the darkcounts from the data. count is darkcounts per pixel. binning should be specified if
         it wasn't saved in the micromanager metadata. Both method arguments should be able to be loaded automatically
@@ -412,11 +527,11 @@ class ICRawBase(ICBase, ABC):
             correction = self.metadata.cameraCorrection
             if correction is None: raise ValueError('other.CameraCorrection metadata not found. Binning must be specified in function argument.')
         count = correction.darkCounts * binning ** 2  # Account for the fact that binning multiplies the darkcount.
-        self.data = self.data - count
+        self._applyElementwise(functools.partial(_subtract, value=count))
         if correction.linearityPolynomial is None or correction.linearityPolynomial == (1.0,):
             pass
         else:
-            self.data = np.polynomial.polynomial.polyval(self.data, (0.0,) + correction.linearityPolynomial)  # The [0] item is the y-intercept (already handled by the darkcount)
+            self._applyElementwise(functools.partial(np.polynomial.polynomial.polyval, c=(0.0,) + correction.linearityPolynomial))  # The [0] item is the y-intercept (already handled by the darkcount)
         self.processingStatus.cameraCorrected = True
         return
 
@@ -482,7 +597,8 @@ class ICRawBase(ICBase, ABC):
         """
         pass
 
-    def toHdfDataset(self, g: h5py.Group, name: str, fixedPointCompression: bool = True) -> h5py.Group:
+    def toHdfDataset(self, g: h5py.Group, name: str, fixedPointCompression: t_.Union[bool, FixedPointCodec] = True, compression: t_.Union[None, str, int, HDFCompression] = None,
+                     chunks: t_.Union[bool, t_.Tuple[int, int, int]] = True) -> h5py.Group:
         """
         Save this object into an HDF dataset.
 
@@ -490,13 +606,17 @@ class ICRawBase(ICBase, ABC):
             g: The `h5py.Group` object to create a new dataset in.
             name: The name of the new dataset.
             fixedPointCompression: If True then the data will be converted from floating point to 16-bit fixed point.
-                This results in approximately half the storage requirements at a very slight loss in precision.
+                This results in approximately half the storage requirements at a very slight loss in precision. A
+                `FixedPointCodec` can also be provided to control how the data is scaled.
+            compression: The compression filter to use. Either an `HDFCompression`, the name of a filter, or a gzip level.
+            chunks: If True (default) the data is stored in chunks of small spatial tiles that each contain the full
+                spectrum. If False the data is stored contiguously. A tuple can also be provided to specify the shape of the chunks.
 
         Returns:
             A reference to the `h5py.Group` passed in as `g`.
 
         """
-        g = ICBase.toHdfDataset(self, g, name, fixedPointCompression)
+        g = ICBase.toHdfDataset(self, g, name, fixedPointCompression, compression=compression, chunks=chunks)
         self.metadata.encodeHdfMetadata(g[name])
         g[name].attrs['processingStatus'] = np.string_(json.dumps(self.processingStatus.toDict()))
         return g
@@ -600,7 +720,7 @@ class DynCube(ICRawBase):
                 raise OSError(f"Could not find a valid PWS image cube file at {directory}.")
 
     @classmethod
-    def fromOldPWS(cls, directory, metadata: pwsdtmd.DynMetaData = None,  lock: mp.Lock = None) -> DynCube:
+    def fromOldPWS(cls, directory, metadata: pwsdtmd.DynMetaData = None,  lock: mp.Lock = None, memoryMap: bool = False) -> DynCube:
         """Loads from the file format that was saved by the all-matlab version of the Basis acquisition code.
         Data was saved in raw binary to a file called `image_cube`. Some metadata was saved to .mat files called
         `info2` and `info3`.
@@ -609,6 +729,9 @@ class DynCube(ICRawBase):
             directory: The directory containing the data files.
             metadata: The metadata object associated with this acquisition
             lock: A `Lock` object used to synchronized IO in multithreading and multiprocessing applications.
+            memoryMap: If True then the file is memory mapped rather than read. Data is then only read from disk and
+                converted to float32 when a region of the cube is indexed, e.g. `cube[rows, cols]` or `getMeanSpectra`.
+                This is much faster when only part of the data is needed.
 
         Returns:
             A new instance of `DynCube`.
@@ -618,9 +741,12 @@ class DynCube(ICRawBase):
         try:
             if metadata is None:
                 metadata = pwsdtmd.DynMetaData.fromOldPWS(directory)
+            shape = (metadata.dict['imgHeight'], metadata.dict['imgWidth'], len(metadata.times))
+            if memoryMap:
+                return cls(np.memmap(os.path.join(directory, 'image_cube'), dtype=np.uint16, mode='r', shape=shape, order='F'), metadata)
             with open(os.path.join(directory, 'image_cube'), 'rb') as f:
                 data = np.frombuffer(f.read(), dtype=np.uint16)
-            data = data.reshape((metadata.dict['imgHeight'], metadata.dict['imgWidth'], len(metadata.times)), order='F')
+            data = data.reshape(shape, order='F')
         finally:
             if lock is not None:
                 lock.release()
@@ -628,7 +754,7 @@ class DynCube(ICRawBase):
         return cls(data, metadata)
 
     @classmethod
-    def fromTiff(cls, directory, metadata: pwsdtmd.DynMetaData = None, lock: mp.Lock = None) -> DynCube:
+    def fromTiff(cls, directory, metadata: pwsdtmd.DynMetaData = None, lock: mp.Lock = None, out: t_.Optional[np.ndarray] = None) -> DynCube:
         """Load a dyanmics acquisition from a tiff file. if the metadata for the acquisition has already been loaded then you can provide
         is as the `metadata` argument to avoid loading it again. the `lock` argument is an optional place to provide a multiprocessing.Lock
         which can be used when multiple files in parallel to avoid giving the hard drive too many simultaneous requests, this is probably not necessary.
@@ -637,6 +763,8 @@ class DynCube(ICRawBase):
             directory: The directory containing the data files.
             metadata: The metadata object associated with this acquisition
             lock: A `Lock` object used to synchronized IO in multithreading and multiprocessing applications.
+            out: An optional float32 array with dimensions (Y, X, T) to load the data into, e.g. an array in shared memory.
+                If None then a new array is allocated.
 
         Returns:
             A new instance of `DynCube`.
@@ -650,13 +778,10 @@ class DynCube(ICRawBase):
                 path = os.path.join(directory, 'dyn.tif')
             else:
                 raise OSError("No Tiff file was found at:", directory)
-            with tf.TiffFile(path) as tif:
-                data = np.rollaxis(tif.asarray(), 0, 3)  # Swap axes to match y,x,lambda convention.
         finally:
             if lock is not None:
                 lock.release()
-        data = data.copy(order='C')
-        return cls(data, metadata)
+        return cls(cls._readTiffPages(path, lock, out=out), metadata)
 
     def normalizeByReference(self, reference: t_.Union[DynCube, np.ndarray]):
         """This method can accept either a DynCube (in which case it's average over time will be calculated and used for
@@ -705,19 +830,53 @@ class DynCube(ICRawBase):
         md.dict['times'] = index
         return DynCube(data, md)
 
-    def getAutocorrelation(self) -> np.ndarray:
+    def getAutocorrelation(self, maxLag: t_.Optional[int] = None) -> np.ndarray:
         """
         Returns the autocorrelation function of dynamics data along the time axis. The ACF is calculated using
         fourier transforms using IFFT(FFT(data)*conj(FFT(data)))/length(data).
 
+        Args:
+            maxLag: If provided then only the lags from 0 to `maxLag` are calculated. Rather than using fourier transforms
+                each lag of the circular ACF is calculated directly as a dot product along the time axis, one block of
+                rows at a time. This is much faster and uses much less memory when `maxLag` is small compared to the
+                number of time points. For larger values of `maxLag` the fourier transform method is used and the result
+                is truncated. The result is in single precision (unless the data is double precision) but the sums are
+                accumulated in double precision.
+
         Returns:
-            A 3D array of the autocorrelation function of the original data.
-        """
+            A 3D array of the autocorrelation function of the original data. The third axis has one lag for each time
+            point, even if the number of time points is odd, or `maxLag + 1` lags if `maxLag` is provided.
+        """
+        if maxLag is not None:
+            if not 0 <= maxLag < self.data.shape[2]:
+                raise ValueError(f"`maxLag` must be between 0 and {self.data.shape[2] - 1}. Got {maxLag}.")
+            if maxLag + 1 < 4 * np.log2(self.data.shape[2]):  # Roughly where the cost of the direct calculation overtakes the fourier transforms.
+                return self._getTruncatedAutocorrelation(maxLag)
+            return self.getAutocorrelation()[:, :, :maxLag + 1].astype(np.result_type(self.data.dtype, np.float32))
         data = self.data - self.data.mean(axis=2)[:, :, None]  # By subtracting the mean we get an ACF where the 0-lag value is the variance of the signal.
-        F = np.fft.rfft(data, axis=2)
-        ac = np.fft.irfft(F * np.conjugate(F), axis=2) / data.shape[2]
+        fft = getFFTBackend()
+        F = fft.rfft(data, axis=2)
+        ac = fft.irfft(F * np.conjugate(F), n=data.shape[2], axis=2) / data.shape[2]  # Without `n` an odd length would be treated as one shorter.
         return ac
 
+    _autocorrelationBlockBytes = 2**24  # The approximate size of the blocks of data used by `_getTruncatedAutocorrelation`.
+
+    def _getTruncatedAutocorrelation(self, maxLag: int) -> np.ndarray:
+        """Calculate the first `maxLag + 1` lags of the circular ACF directly. See `getAutocorrelation`."""
+        ny, nx, nt = self.data.shape
+        out = np.empty((ny, nx, maxLag + 1), dtype=np.result_type(self.data.dtype, np.float32))
+        rowsPerBlock = max(1, self._autocorrelationBlockBytes // (nx * nt * 8))
+        for start in range(0, ny, rowsPerBlock):
+            block = self.data[start:start + rowsPerBlock].astype(np.float64)
+            block -= block.mean(axis=2)[:, :, None]  # By subtracting the mean we get an ACF where the 0-lag value is the variance of the signal.
+            outBlock = out[start:start + rowsPerBlock]
+            for lag in range(maxLag + 1):
+                acf = np.einsum('ijk,ijk->ij', block[:, :, :nt - lag], block[:, :, lag:])
+                if lag > 0:  # The wrapped around part of the circular ACF.
+                    acf += np.einsum('ijk,ijk->ij', block[:, :, nt - lag:], block[:, :, :lag])
+                outBlock[:, :, lag] = acf / nt
+        return out
+
     def filterDust(self, kernelRadius: float, pixelSize: float = None):
         """
         This method blurs the data of the cube along the X and Y dimensions. This is useful if the cube is being
@@ -886,7 +1045,8 @@ class PwsCube(ICRawBase):
             and Z corresponds to the `index` dimension, e.g. wavelength, wavenumber, time, etc.
         metadata: The metadata object associated with this data object.
         processingStatus: An object that keeps track of which processing steps and corrections have been applied to this object.
-        dtype (type): the data type that the data should be stored as. The default is numpy.float32.
+        dtype (type): the data type that the data should be stored as. The default is numpy.float32. If `data` already
+            has this type then it is used directly rather than being copied.
     """
 
     _hdfTypeName = "ImCube"  # This is used for saving/loading from HDF. Important not to change it or old files will stop working.
@@ -927,7 +1087,7 @@ class PwsCube(ICRawBase):
                     raise OSError(f"Could not find a valid PWS image cube file at {directory}.")
 
     @classmethod
-    def fromOldPWS(cls, directory: str, metadata: pwsdtmd.PwsMetaData = None, lock: mp.Lock = None):
+    def fromOldPWS(cls, directory: str, metadata: pwsdtmd.PwsMetaData = None, lock: mp.Lock = None, memoryMap: bool = False):
         """
         Loads from the file format that was saved by the all-matlab version of the Basis acquisition code.
         Data was saved in raw binary to a file called `image_cube`. Some metadata was saved to .mat files called
@@ -937,6 +1097,9 @@ class PwsCube(ICRawBase):
             directory: The directory containing the data files.
             metadata: The metadata object associated with this acquisition
             lock: A `Lock` object used to synchronized IO in multithreading and multiprocessing applications.
+            memoryMap: If True then the file is memory mapped rather than read. Data is then only read from disk and
+                converted to float32 when a region of the cube is indexed, e.g. `cube[rows, cols]` or `getMeanSpectra`.
+                This is much faster when only part of the data is needed.
 
         Returns:
             A new instance of `PwsCube`.
@@ -946,9 +1109,12 @@ class PwsCube(ICRawBase):
         try:
             if metadata is None:
                 metadata = pwsdtmd.PwsMetaData.fromOldPWS(directory)
+            shape = (metadata.dict['imgHeight'], metadata.dict['imgWidth'], len(metadata.wavelengths))
+            if memoryMap:
+                return cls(np.memmap(os.path.join(directory, 'image_cube'), dtype=np.uint16, mode='r', shape=shape, order='F'), metadata)
             with open(os.path.join(directory, 'image_cube'), 'rb') as f:
                 data = np.frombuffer(f.read(), dtype=np.uint16)
-            data = data.reshape((metadata.dict['imgHeight'], metadata.dict['imgWidth'], len(metadata.wavelengths)), order='F')
+            data = data.reshape(shape, order='F')
         finally:
             if lock is not None:
                 lock.release()
@@ -956,7 +1122,7 @@ class PwsCube(ICRawBase):
         return cls(data, metadata)
 
     @classmethod
-    def fromTiff(cls, directory, metadata: pwsdtmd.PwsMetaData = None, lock: mp.Lock = None):
+    def fromTiff(cls, directory, metadata: pwsdtmd.PwsMetaData = None, lock: mp.Lock = None, out: t_.Optional[np.ndarray] = None):
         """
         Loads from a 3D tiff file named `pws.tif`, or in some older data `MMStack.ome.tif`. Metadata can be stored in
         the tags of the tiff file but if there is a pwsmetadata.json file found then this is preferred.
@@ -967,6 +1133,8 @@ class PwsCube(ICRawBase):
             directory: The directory containing the data files.
             metadata: The metadata object associated with this acquisition
             lock: A `Lock` object used to synchronized IO in multithreading and multiprocessing applications.
+            out: An optional float32 array with dimensions (Y, X, Wavelength) to load the data into, e.g. an array in
+                shared memory. If None then a new array is allocated.
 
         Returns:
             A new instance of `PwsCube`.
@@ -982,13 +1150,10 @@ class PwsCube(ICRawBase):
                 path = os.path.join(directory, 'pws.tif')
             else:
                 raise OSError("No Tiff file was found at:", directory)
-            with tf.TiffFile(path) as tif:
-                data = np.rollaxis(tif.asarray(), 0, 3)  # Swap axes to match y,x,lambda convention.
         finally:
             if lock is not None:
                 lock.release()
-        data = data.copy(order='C')
-        return cls(data, metadata)
+        return cls(cls._readTiffPages(path, lock, out=out), metadata)
 
     @classmethod
     def fromNano(cls, directory: str, metadata: pwsdtmd.PwsMetaData = None, lock: mp.Lock = None) -> PwsCube:
@@ -1197,16 +1362,23 @@ class KCube(ICBase):
         Returns:
             A new instance of `KCube`
         """
-        # Convert to wavenumber and reverse the order so we are ascending in order. Units of radian/micron
-        wavenumbers = (2 * np.pi) / (np.array(cube.wavelengths, dtype=np.float64) * 1e-3)[::-1]
-        data = cube.data[:, :, ::-1]
-        # Generate evenly spaced wavenumbers
-        #        dk = (self.wavenumbers[-1] - self.wavenumbers[0])/(len(self.wavenumbers)-1);
-        evenWavenumbers = np.linspace(wavenumbers[0], wavenumbers[-1], num=len(wavenumbers), dtype=np.float64)
-        # Interpolate to the evenly spaced wavenumbers
-        interpFunc = spi.interp1d(wavenumbers, data, kind='linear', axis=2)
-        data = interpFunc(evenWavenumbers)
-        return cls(data, tuple(evenWavenumbers.astype(np.float32)), metadata=cube.metadata)
+        data, wavenumbers = cls._wavelengthToWavenumberData(cube.data, cube.wavelengths)
+        return cls(data, wavenumbers, metadata=cube.metadata)
+
+    @staticmethod
+    def _wavelengthToWavenumberData(data: np.ndarray, wavelengths: t_.Sequence[float]) -> t_.Tuple[np.ndarray, t_.Tuple[float, ...]]:
+        """Resample the last axis of `data` from evenly spaced `wavelengths` to evenly spaced wavenumbers. This works
+        on any array with the spectra along the last axis, so it can be used on a portion of a cube.
+
+        Args:
+            data: An array with the spectra along the last axis.
+            wavelengths: The wavelengths associated with each element of the last axis of `data`.
+
+        Returns:
+            A tuple containing: The resampled array, The tuple of wavenumbers (radians/micron) for the last axis of the new array.
+        """
+        resampler = _WavenumberResampler.fromWavelengths(tuple(wavelengths))
+        return resampler.apply(data), resampler.wavenumbers
 
     @property
     def wavenumbers(self) -> t_.Tuple[float, ...]:
@@ -1281,7 +1453,7 @@ class KCube(ICBase):
         fftSize = int(2 ** (np.ceil(np.log2((2 * len(xVals)) - 1))))  # %This is the next size of fft that is  at least 2x greater than is needed but is a power of two. Results in interpolation, helps amplitude accuracy and fft efficiency.
         if useHannWindow: w = np.hanning(len(xVals))
         else: w = np.ones((len(xVals)))
-        sig = np.fft.irfft(opd * w[None, None, :], n=fftSize, axis=2)
+        sig = getFFTBackend().irfft(opd * w[None, None, :], n=fftSize, axis=2)
         #I don't think we need to normalize by the number of elements like we do in getOpd
 
         # by multiplying by Hann window we reduce the total power of signal. To account for that,
@@ -1293,7 +1465,7 @@ class KCube(ICBase):
         return sig, waveNumbers
 
 
-    def getAutoCorrelation(self, isAutocorrMinSub: bool, stopIndex: int) -> t_.Tuple[np.ndarray, np.ndarray]:
+    def getAutoCorrelation(self, isAutocorrMinSub: bool, stopIndex: int, useDirectSum: t_.Optional[bool] = None) -> t_.Tuple[np.ndarray, np.ndarray]:
         """The autocorrelation of a signal is the covariance of a signal with a
         lagged version of itself, normalized so that the covariance at
         zero-lag is equal to 1.0 (c[0] = 1.0).  The same process without
@@ -1313,73 +1485,139 @@ class KCube(ICBase):
         when performed on signals with a length equal to a power of 2.  To
         take advantage of this property, a Z-point fft is performed on the
         signal, where Z is a number greater than (2*P)-1 that is also a power
-        of 2."""
-        fftSize = int(2 ** (np.ceil(np.log2((2 * len(
-            self.wavenumbers)) - 1))))  # This is the next size of fft that is  at least 2x greater than is needed but is a power of two. Results in interpolation, helps amplitude accuracy and fft efficiency.
-
-        # Determine the fft for each signal.  The length of each signal's fft
-        # will be fftSize.
-        cubeFft = np.fft.rfft(self.data, n=fftSize, axis=2)
-
-        # Determine the ifft of the cubeFft.  The resulting ifft of each signal
-        # will be of length fftSize..
-        cubeAutocorr = np.fft.irfft(np.abs(cubeFft) ** 2, axis=2)  # This is the autocovariance.
-        # Obtain only the lags desired.
-        # Then, normalize each autocovariance so the value at zero-lags is 1.
-        cubeAutocorr = cubeAutocorr[:, :, :len(self.wavenumbers)]
-        cubeAutocorr /= cubeAutocorr[:, :, 0, np.newaxis]
+        of 2.
 
+        When only a few lags are needed (no minimum subtraction and a small `stopIndex`) it is faster to calculate
+        the autocorrelation directly as a sum of products for each lag.
+
+        Args:
+            isAutocorrMinSub: If True then the minimum of the autocorrelation (over all lags and pixels) is subtracted before fitting.
+            stopIndex: The number of lags to include in the linear fit.
+            useDirectSum: If True the autocorrelation is calculated with direct sums rather than FFTs. If False the FFT
+                is always used. If None (default) the faster method is chosen automatically.
+
+        Returns:
+            A tuple containing: The 2D array of the slope of the log of the autocorrelation vs. lag squared, The 2D array of the
+                coefficient of determination (R^2) of the fit.
+        """
         # In some instances, minimum subtraction is desired.  In this case,
         # determine the minimum of each signal and subtract that value from
-        # each value in the signal.
+        # each value in the signal. The minimum is taken over all lags so we can't restrict the calculation to `stopIndex` lags.
         if isAutocorrMinSub:
-            cubeAutocorr -= cubeAutocorr.min()
+            cubeAutocorr, offset = self._getNormalizedAutocorrelation(self.data, maxLag=stopIndex, directSum=useDirectSum, returnMinimum=True)
+        else:
+            cubeAutocorr = self._getNormalizedAutocorrelation(self.data, maxLag=stopIndex, directSum=useDirectSum)
+            offset = 0
+
+        cubeSlope, rSquared = self._fitAutocorrelation(cubeAutocorr, self.wavenumbers, stopIndex, offset)
+        cubeSlope = cubeSlope.astype(self.data.dtype)#Make sure to to upscale precision
+        rSquared = rSquared.astype(self.data.dtype)
+        return cubeSlope, rSquared
+
+    @staticmethod
+    def _getNormalizedAutocorrelation(data: np.ndarray, maxLag: t_.Optional[int] = None, directSum: t_.Optional[bool] = None,
+                                      returnMinimum: bool = False) -> t_.Union[np.ndarray, t_.Tuple[np.ndarray, float]]:
+        """Calculate the autocovariance along the last axis of `data` normalized so that the value at zero-lag is 1. Only
+        the non-negative lags are returned. The calculation is done on blocks of pixels so that the full set of lags
+        only ever exists in memory for a single block. See `getAutoCorrelation` for details.
 
+        Args:
+            data: An array with the spectra along the last axis.
+            maxLag: The number of lags to return. If None then all lags are returned.
+            directSum: If True then each lag is calculated as a direct sum of products, this is faster than the FFT when
+                only a small number of lags is needed. If None (default) the faster method is chosen automatically.
+            returnMinimum: If True then the minimum of the normalized autocorrelation over all lags, including those beyond `maxLag`, is also returned.
+
+        Returns:
+            A float64 array of the same shape as `data`, except for the last axis which has length `maxLag`, containing
+                the normalized autocorrelation. If `returnMinimum` is True then a tuple of this array and the minimum value is returned.
+        """
+        length = data.shape[-1]
+        nLags = length if maxLag is None else min(maxLag, length)
+        nCalcLags = length if returnMinimum else nLags  # The minimum requires that we calculate every lag.
+        if directSum is None:
+            directSum = nCalcLags * 3 <= length  # Roughly where direct sums stop beating the FFT.
+        fftSize = int(2 ** (np.ceil(np.log2((2 * length) - 1))))  # This is the next size of fft that is  at least 2x greater than is needed but is a power of two. Results in interpolation, helps amplitude accuracy and fft efficiency.
+
+        fft = getFFTBackend()
+        flattened = data.reshape((-1, length))
+        cubeAutocorr = np.empty((flattened.shape[0], nLags), dtype=np.float64)
+        minimum = np.inf
+        blockSize = 2 ** 14
+        for i in range(0, flattened.shape[0], blockSize):
+            block = flattened[i:i+blockSize]
+            if directSum:
+                blockAutocorr = np.empty((block.shape[0], nCalcLags), dtype=np.float64)
+                for lag in range(nCalcLags):
+                    blockAutocorr[:, lag] = np.einsum('ij,ij->i', block[:, :length-lag], block[:, lag:], dtype=np.float64)
+            else:
+                # Determine the fft for each signal.  The length of each signal's fft
+                # will be fftSize.
+                blockFft = fft.rfft(block, n=fftSize, axis=1)
+
+                # Determine the ifft of the blockFft.  The resulting ifft of each signal
+                # will be of length fftSize..
+                blockAutocorr = fft.irfft(np.abs(blockFft) ** 2, n=fftSize, axis=1)  # This is the autocovariance.
+                # Obtain only the lags desired.
+                blockAutocorr = blockAutocorr[:, :nCalcLags]
+            # Normalize each autocovariance so the value at zero-lag is 1.
+            blockAutocorr /= blockAutocorr[:, 0, np.newaxis]
+            if returnMinimum and blockAutocorr.size > 0:
+                minimum = min(minimum, blockAutocorr.min())
+            cubeAutocorr[i:i+blockSize] = blockAutocorr[:, :nLags]
+        cubeAutocorr = cubeAutocorr.reshape(data.shape[:-1] + (nLags,))
+        if returnMinimum:
+            return cubeAutocorr, minimum
+        else:
+            return cubeAutocorr
+
+    @staticmethod
+    def _fitAutocorrelation(cubeAutocorr: np.ndarray, wavenumbers: t_.Sequence[float], stopIndex: int, offset: float = 0) -> t_.Tuple[np.ndarray, np.ndarray]:
+        """Fit a line to the logarithm of the first `stopIndex` lags of a normalized autocorrelation vs. lag squared. The
+        least-squares fit is calculated from running sums over blocks of pixels so that only a small block of the log
+        autocorrelation ever exists in memory.
+
+        Args:
+            cubeAutocorr: A 3D array of the normalized autocorrelation, as returned by `_getNormalizedAutocorrelation`. Only
+                the first `stopIndex` lags are used. This array is not modified.
+            wavenumbers: The wavenumbers of the data that the autocorrelation was calculated from.
+            stopIndex: The number of lags to include in the fit.
+            offset: A value to subtract from the autocorrelation before taking the logarithm. Used for minimum subtraction.
+
+        Returns:
+            A tuple containing: The 2D array of slopes, The 2D array of the coefficient of determination of the fit.
+        """
         # Convert the lags from units of indices to wavenumbers.
-        lags = np.array(self.wavenumbers) - min(self.wavenumbers)
+        lags = np.array(wavenumbers, dtype=np.float64) - min(wavenumbers)
 
         # Square the lags. This is how it is in the paper. I'm not sure why though.
-        lagsSquared = lags ** 2
-
-        # Before taking the log of the autocorrelation, zero values must be
-        # modified to prevent outputs of "inf" or "-inf".
-        cubeAutocorr[cubeAutocorr == 0] = 1e-323
-
-        # Obtain the log of the autocorrelation.
-        cubeAutocorrLog = np.log(cubeAutocorr)
-
-        # A first-order polynomial fit is determined between lagsSquared and
-        # and cubeAutocorrLog.  This fit is to be performed only on the first
-        # linear-portion of the lagsSquared vs. cubeAutocorrLog relationship.
-        # The index of the last point to be used is indicated by stopIndex.
-        lagsSquared = lagsSquared[:stopIndex]
-        cubeAutocorrLog = cubeAutocorrLog[:, :, :stopIndex]
-        cubeAutocorrLog = np.moveaxis(cubeAutocorrLog, 2, 0)
-        cubeAutocorrLog = cubeAutocorrLog.reshape(
-            (cubeAutocorrLog.shape[0], cubeAutocorrLog.shape[1] * cubeAutocorrLog.shape[2]))
-
-        # Determine the first-order polynomial fit for each cubeAutocorrLag.
-        V = np.stack([np.ones(lagsSquared.shape), lagsSquared])
-        V = V.T
-        M = np.matmul(V, np.linalg.pinv(V))
-        cubeLinear = np.matmul(M, cubeAutocorrLog)
-        cubeSlope = (cubeLinear[1, :] - cubeLinear[0, :]) / (lagsSquared[1] - lagsSquared[0])
-        cubeSlope = cubeSlope.reshape(self.data.shape[0], self.data.shape[1])
-        # -- Coefficient of Determination
-        # Obtain the mean of the observed data
-        meanObserved = cubeAutocorrLog.mean(axis=0)
-        # Obtain the regression sum of squares.
-        ssReg = ((cubeLinear - meanObserved) ** 2).sum(axis=0)
-        # Obtain the residual sum of squares.
-        ssErr = ((cubeAutocorrLog - cubeLinear) ** 2).sum(axis=0)
-        # Obtain the total sume of squares.
-        ssTot = ssReg + ssErr
-        # Obtain rSquared.
-        rSquared = ssReg / ssTot
-        rSquared = rSquared.reshape(self.data.shape[0], self.data.shape[1])
-
-        cubeSlope = cubeSlope.astype(self.data.dtype)#Make sure to to upscale precision
-        rSquared = rSquared.astype(self.data.dtype)
+        lagsSquared = lags[:stopIndex] ** 2
+        n = len(lagsSquared)
+        sumX = lagsSquared.sum()
+        varX = n * (lagsSquared ** 2).sum() - sumX ** 2  # `n` times the sum of squared deviations of x.
+
+        flattened = cubeAutocorr.reshape((-1, cubeAutocorr.shape[-1]))
+        cubeSlope = np.empty(flattened.shape[0], dtype=np.float64)
+        rSquared = np.empty(flattened.shape[0], dtype=np.float64)
+        blockSize = 2 ** 16
+        for i in range(0, flattened.shape[0], blockSize):
+            cubeAutocorrLog = flattened[i:i+blockSize, :stopIndex] - offset  # This is a copy, the original array isn't modified.
+            # Before taking the log of the autocorrelation, zero values must be
+            # modified to prevent outputs of "inf" or "-inf".
+            cubeAutocorrLog[cubeAutocorrLog == 0] = 1e-323
+            np.log(cubeAutocorrLog, out=cubeAutocorrLog)
+            # A first-order polynomial fit is determined between lagsSquared and
+            # and cubeAutocorrLog using the closed form least-squares solution.
+            sumY = cubeAutocorrLog.sum(axis=1)
+            sumXY = cubeAutocorrLog @ lagsSquared
+            sumYY = np.einsum('ij,ij->i', cubeAutocorrLog, cubeAutocorrLog)
+            covXY = n * sumXY - sumX * sumY
+            varY = n * sumYY - sumY ** 2
+            cubeSlope[i:i+blockSize] = covXY / varX
+            # -- Coefficient of Determination. For a linear fit this is equal to the squared correlation coefficient.
+            rSquared[i:i+blockSize] = covXY ** 2 / (varX * varY)
+        cubeSlope = cubeSlope.reshape(cubeAutocorr.shape[:-1])
+        rSquared = rSquared.reshape(cubeAutocorr.shape[:-1])
         return cubeSlope, rSquared
 
     @classmethod
@@ -1503,7 +1741,10 @@ class _FFTHelper:
             w = np.ones((dataLength))  # Create unity window
 
         # Calculate the Fourier Transform of the signal multiplied by Hann window
-        fft = np.fft.rfft(data * w, n=fftSize, axis=data.ndim-1)
+        fftBackend = getFFTBackend()
+        if fftBackend.singlePrecision and data.dtype == np.float32:
+            w = w.astype(np.float32)  # Avoid promoting the data to double precision.
+        fft = fftBackend.rfft(data * w, n=fftSize, axis=data.ndim-1)
         fft = np.abs(fft)  # We're only interested in the magnitude.
         # Normalize the FFT by the quantity of wavelengths.
         fft /= dataLength
@@ -1516,3 +1757,73 @@ class _FFTHelper:
         else:
             raise ValueError(f"{normalization} is not a valid normalization.")
         return fft
+
+
+class _WavenumberResampler:
+    """A linear operator that resamples spectra from a set of evenly spaced wavelengths to evenly spaced wavenumbers
+    using linear interpolation. Each output wavenumber depends on only two input wavelengths so the operator is stored
+    as a sparse matrix and applied as a single matrix multiplication over all pixels. Instances should be retrieved
+    with `fromWavelengths` which caches the operator for each unique set of wavelengths.
+
+    Args:
+        wavelengths: The wavelengths (nanometers) associated with the last axis of the data that will be resampled.
+    """
+    def __init__(self, wavelengths: t_.Tuple[float, ...]):
+        # Convert to wavenumber and reverse the order so we are ascending in order. Units of radian/micron
+        wavenumbers = (2 * np.pi) / (np.array(wavelengths, dtype=np.float64) * 1e-3)[::-1]
+        # Generate evenly spaced wavenumbers
+        evenWavenumbers = np.linspace(wavenumbers[0], wavenumbers[-1], num=len(wavenumbers), dtype=np.float64)
+        # Find the pair of original wavenumbers that surround each new wavenumber and the linear interpolation weights.
+        lower = np.clip(np.searchsorted(wavenumbers, evenWavenumbers, side='right') - 1, 0, len(wavenumbers) - 2)
+        upperWeight = (evenWavenumbers - wavenumbers[lower]) / (wavenumbers[lower + 1] - wavenumbers[lower])
+        # Column indices are flipped so that the operator can be applied to the data in its original (wavelength) order.
+        rows = np.concatenate([np.arange(len(wavenumbers))] * 2)
+        cols = len(wavenumbers) - 1 - np.concatenate([lower, lower + 1])
+        weights = np.concatenate([1 - upperWeight, upperWeight])
+        self._matrix = sparse.csr_matrix((weights, (cols, rows)), shape=(len(wavenumbers), len(wavenumbers)))  # Shape is (input, output) so it can right-multiply the data.
+        self._typedMatrices = {}
+        self.wavelengths = tuple(wavelengths)
+        self.wavenumbers: t_.Tuple[float, ...] = tuple(evenWavenumbers.astype(np.float32))
+
+    _blockBytes = 2**24  # The approximate size of the blocks of data that `apply` resamples at once when `out` is provided.
+
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def fromWavelengths(wavelengths: t_.Tuple[float, ...]) -> _WavenumberResampler:
+        """Get the resampling operator for a set of wavelengths. Operators are cached so repeated calls with the same
+        wavelengths return the same object.
+
+        Args:
+            wavelengths: The wavelengths (nanometers) associated with the last axis of the data that will be resampled. Must be hashable.
+
+        Returns:
+            A resampling operator
+        """
+        return _WavenumberResampler(wavelengths)
+
+    def apply(self, data: np.ndarray, out: t_.Optional[np.ndarray] = None) -> np.ndarray:
+        """Resample the last axis of `data` from wavelength to wavenumber. Any number of leading dimensions is supported
+        so this can be applied to a full cube or just a portion of it.
+
+        Args:
+            data: An array with spectra along the last axis.
+            out: An optional C-contiguous array of the same shape to store the result in. May be `data` itself. The
+                result is calculated one block of spectra at a time so that no full size temporary array is needed.
+
+        Returns:
+            The resampled array. Float32 data produces a float32 result, other data types produce a float64 result.
+        """
+        dtype = np.float32 if data.dtype == np.float32 else np.float64
+        if dtype not in self._typedMatrices:
+            self._typedMatrices[dtype] = self._matrix.astype(dtype)
+        matrix = self._typedMatrices[dtype]
+        flattened = data.reshape((-1, data.shape[-1]))
+        if out is None:
+            return (flattened @ matrix).reshape(data.shape)
+        assert out.flags['C_CONTIGUOUS'], "`out` must be C-contiguous so that it can be written to through a reshaped view."
+        outFlat = out.reshape(flattened.shape)
+        rowsPerBlock = max(1, self._blockBytes // (flattened.shape[1] * flattened.itemsize))
+        for start in range(0, flattened.shape[0], rowsPerBlock):
+            block = slice(start, start + rowsPerBlock)
+            outFlat[block] = flattened[block] @ matrix  # Each block is fully calculated before it is written, so `out` can be `data`.
+        return out
@@ -0,0 +1,201 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Selectable implementations of the real-valued FFT used by the data classes of `pwspy.dataTypes`. By default numpy is
+used. `scipy.fft` (multithreaded) and pyFFTW (if installed) can be selected with `setFFTBackend`.
+"""
+from __future__ import annotations
+import collections
+import threading
+import typing as t_
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+__all__ = ['FFTBackend', 'NumpyFFTBackend', 'ScipyFFTBackend', 'PyFFTWBackend', 'getFFTBackend', 'setFFTBackend']
+
+
+class FFTBackend(ABC):
+    """Abstract class for an implementation of the real-valued forward and inverse FFT.
+
+    Args:
+        singlePrecision: If True then float32 input will be transformed in single precision (complex64) rather than
+            being promoted to double precision. This is faster and uses half the memory. Not all backends support this.
+    """
+    def __init__(self, singlePrecision: bool = False):
+        self.singlePrecision = singlePrecision
+
+    @abstractmethod
+    def rfft(self, data: np.ndarray, n: t_.Optional[int] = None, axis: int = -1) -> np.ndarray:
+        """Compute the FFT of real input. Equivalent to `numpy.fft.rfft`.
+
+        Args:
+            data: The input array.
+            n: The length of the transform. The input is zero-padded or truncated to this length. If None then the length of `axis` is used.
+            axis: The axis to transform.
+
+        Returns:
+            The complex valued transform.
+        """
+        pass
+
+    @abstractmethod
+    def irfft(self, data: np.ndarray, n: t_.Optional[int] = None, axis: int = -1) -> np.ndarray:
+        """Compute the inverse of `rfft`. Equivalent to `numpy.fft.irfft`.
+
+        Args:
+            data: The complex input array.
+            n: The length of the real output along `axis`. If None then `2*(m-1)` is used where `m` is the length of `axis`.
+            axis: The axis to transform.
+
+        Returns:
+            The real valued inverse transform.
+        """
+        pass
+
+    def _castInput(self, data: np.ndarray, complexInput: bool) -> np.ndarray:
+        """Cast the input to the precision that will be used for the transform."""
+        if self.singlePrecision and data.dtype in ((np.complex64,) if complexInput else (np.float32,)):
+            return data
+        return data.astype(np.complex128 if complexInput else np.float64, copy=False)
+
+
+class NumpyFFTBackend(FFTBackend):
+    """Uses `numpy.fft`. This is the default backend. Numpy always calculates in double precision so `singlePrecision` is not supported."""
+    def __init__(self):
+        super().__init__(singlePrecision=False)
+
+    def rfft(self, data: np.ndarray, n: t_.Optional[int] = None, axis: int = -1) -> np.ndarray:  # Inherit docstring
+        return np.fft.rfft(data, n=n, axis=axis)
+
+    def irfft(self, data: np.ndarray, n: t_.Optional[int] = None, axis: int = -1) -> np.ndarray:  # Inherit docstring
+        return np.fft.irfft(data, n=n, axis=axis)
+
+
+class ScipyFFTBackend(FFTBackend):
+    """Uses `scipy.fft` which supports multithreading and single precision transforms. Scipy internally caches the
+    twiddle factors for recently used transform sizes.
+
+    Args:
+        workers: The number of threads to use. Negative values wrap around from `os.cpu_count()`, -1 uses all cores.
+        singlePrecision: If True then float32 input will be transformed in single precision.
+    """
+    def __init__(self, workers: int = -1, singlePrecision: bool = True):
+        import scipy.fft
+        super().__init__(singlePrecision=singlePrecision)
+        self._fft = scipy.fft
+        self.workers = workers
+
+    def __getstate__(self):  # Modules can't be pickled. This allows the backend to be sent to worker processes.
+        state = self.__dict__.copy()
+        del state['_fft']
+        return state
+
+    def __setstate__(self, state):
+        import scipy.fft
+        self.__dict__.update(state)
+        self._fft = scipy.fft
+
+    def rfft(self, data: np.ndarray, n: t_.Optional[int] = None, axis: int = -1) -> np.ndarray:  # Inherit docstring
+        return self._fft.rfft(self._castInput(data, False), n=n, axis=axis, workers=self.workers)
+
+    def irfft(self, data: np.ndarray, n: t_.Optional[int] = None, axis: int = -1) -> np.ndarray:  # Inherit docstring
+        return self._fft.irfft(self._castInput(data, True), n=n, axis=axis, workers=self.workers)
+
+
+class PyFFTWBackend(FFTBackend):
+    """Uses the FFTW library via the optional `pyfftw` package. FFTW plans are cached by (shape, n, axis, dtype) so that
+    planning is only done once for each size of data that is transformed.
+
+    Args:
+        threads: The number of threads to use.
+        singlePrecision: If True then float32 input will be transformed in single precision.
+        plannerEffort: The FFTW planner effort, e.g. 'FFTW_ESTIMATE', 'FFTW_MEASURE'. Greater effort means slower
+            planning but possibly faster transforms.
+        maxPlans: The maximum number of plans to keep in the cache.
+    """
+    def __init__(self, threads: int = 1, singlePrecision: bool = True, plannerEffort: str = 'FFTW_MEASURE', maxPlans: int = 32):
+        try:
+            import pyfftw
+        except ImportError as e:
+            raise ImportError("The `pyfftw` package is required to use the PyFFTWBackend.") from e
+        super().__init__(singlePrecision=singlePrecision)
+        self._pyfftw = pyfftw
+        self.threads = threads
+        self.plannerEffort = plannerEffort
+        self._maxPlans = maxPlans
+        self._plans = collections.OrderedDict()
+        self._lock = threading.Lock()  # FFTW plan objects have internal buffers so they can't be executed concurrently.
+
+    def __getstate__(self):  # The module, the lock, and the plans can't be pickled. Worker processes plan for themselves.
+        state = self.__dict__.copy()
+        for name in ['_pyfftw', '_plans', '_lock']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        import pyfftw
+        self.__dict__.update(state)
+        self._pyfftw = pyfftw
+        self._plans = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _execute(self, builder: t_.Callable, data: np.ndarray, n: t_.Optional[int], axis: int) -> np.ndarray:
+        axis = axis % data.ndim
+        key = (builder.__name__, data.shape, n, axis, data.dtype)
+        with self._lock:
+            if key in self._plans:
+                self._plans.move_to_end(key)
+            else:
+                self._plans[key] = builder(self._pyfftw.empty_aligned(data.shape, dtype=data.dtype), n=n, axis=axis,
+                                           threads=self.threads, planner_effort=self.plannerEffort)
+                if len(self._plans) > self._maxPlans:
+                    self._plans.popitem(last=False)
+            return self._plans[key](data).copy()  # The plan's output array is reused on the next call so we need a copy.
+
+    def rfft(self, data: np.ndarray, n: t_.Optional[int] = None, axis: int = -1) -> np.ndarray:  # Inherit docstring
+        return self._execute(self._pyfftw.builders.rfft, self._castInput(data, False), n, axis)
+
+    def irfft(self, data: np.ndarray, n: t_.Optional[int] = None, axis: int = -1) -> np.ndarray:  # Inherit docstring
+        return self._execute(self._pyfftw.builders.irfft, self._castInput(data, True), n, axis)
+
+
+_backend: FFTBackend = NumpyFFTBackend()
+
+
+def getFFTBackend() -> FFTBackend:
+    """
+    Returns:
+        The FFT backend currently used by `pwspy.dataTypes`.
+    """
+    return _backend
+
+
+def setFFTBackend(backend: FFTBackend):
+    """Select the FFT implementation used by `pwspy.dataTypes`. e.g. `setFFTBackend(ScipyFFTBackend(workers=-1))`
+
+    This only applies to the current process. `pwspy.analysis.ParallelRunner` passes the backend that is selected when
+    its worker processes are started on to them.
+
+    Args:
+        backend: The FFT backend to use.
+    """
+    global _backend
+    if not isinstance(backend, FFTBackend):
+        raise TypeError(f"`backend` must be an instance of FFTBackend, not {type(backend)}")
+    _backend = backend
@@ -0,0 +1,172 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+The 16-bit fixed point format used by `ICBase.toHdfDataset` to save image cubes in half the space of 32-bit floats.
+"""
+from __future__ import annotations
+import typing as t_
+
+import h5py
+import numpy as np
+
+__all__ = ['FixedPointCodec']
+
+
+class FixedPointCodec:
+    """Converts floating point data cubes to and from 16-bit fixed point when saving them to HDF. The data is scaled to
+    span the full range of an unsigned 16bit integer and the minimum and maximum needed to scale back to the original
+    data are saved as attributes of the dataset. If the data contains NaNs then the largest value is reserved to
+    represent NaN.
+
+    Encoding and decoding are done one block of rows at a time using preallocated buffers so that no full size floating
+    point temporaries are created.
+
+    Args:
+        perTile: If False (default) a single minimum and maximum is used for the whole cube. This is the format that has
+            always been used and can be read by older versions of PWSpy. If True then a separate minimum and maximum is used
+            for each spatial tile of the data, so a few outlier pixels only reduce the precision of the tiles that they are in.
+            The tiles are the same as the HDF chunks, unless that would result in too many tiles to store as attributes.
+    """
+    MAXCODE = 2 ** 16 - 1
+    _maxTiles = 4096  # HDF5 limits the size of attributes. Keep the arrays of minimums and maximums well under that limit.
+
+    def __init__(self, perTile: bool = False):
+        self.perTile = perTile
+
+    def toHdfDataset(self, g: h5py.Group, name: str, data: np.ndarray, tileShape: t_.Tuple[int, int],
+                     **createKwargs) -> h5py.Dataset:
+        """Create a new dataset containing `data` in fixed point format.
+
+        Args:
+            g: The parent HDF Group of the new dataset.
+            name: The name of the new HDF dataset in group `g`.
+            data: A 3D floating point array.
+            tileShape: The (Y, X) shape of the HDF chunks. The data is encoded one row of tiles at a time.
+            createKwargs: Additional keyword arguments are passed to `h5py.Group.create_dataset`. e.g. `compression`, `chunks`.
+
+        Returns:
+            The new dataset.
+        """
+        ny, nx = data.shape[:2]
+        blockRows = max(1, min(tileShape[0], ny))
+        if self.perTile:
+            tileShape = self._limitTileShape(tileShape, data.shape)
+            blockRows = tileShape[0]
+        else:
+            tileShape = (ny, nx)
+        m, M = self._getTileRange(data, tileShape)
+        hasNans = bool(np.isnan(np.min(data))) if data.size > 0 else False  # `np.min` propagates NaN.
+        scale = np.zeros_like(M)
+        np.divide(self.MAXCODE, M - m, out=scale, where=M > m)  # Constant tiles are saved as all 0.
+
+        dset = g.create_dataset(name, shape=data.shape, dtype=np.uint16, **createKwargs)
+        buffer = np.empty((blockRows,) + data.shape[1:], dtype=np.float32)
+        codes = np.empty(buffer.shape, dtype=np.uint16)
+        for start in range(0, ny, blockRows):
+            block = data[start:start + blockRows]
+            buf, out = buffer[:block.shape[0]], codes[:block.shape[0]]
+            offsetImg, scaleImg = (self._expandTiles(a, start, block.shape[0], tileShape, nx) for a in (m, scale))
+            np.subtract(block, offsetImg, out=buf)
+            np.multiply(buf, scaleImg, out=buf)
+            buf += .5  # Round to the nearest integer rather than truncating.
+            if hasNans:
+                np.minimum(buf, self.MAXCODE - 1, out=buf)
+            with np.errstate(invalid='ignore'):  # NaNs are filled in below.
+                np.copyto(out, buf, casting='unsafe')
+            if hasNans:
+                np.copyto(out, self.MAXCODE, where=np.isnan(block))
+            dset[start:start + block.shape[0]] = out
+
+        if self.perTile:
+            dset.attrs['fpTileShape'] = np.array(tileShape)
+            dset.attrs['min'] = m
+            dset.attrs['max'] = M
+        else:
+            dset.attrs['min'] = m[0, 0]
+            dset.attrs['max'] = M[0, 0]
+        if hasNans:
+            dset.attrs['nanValue'] = self.MAXCODE
+        return dset
+
+    @classmethod
+    def decode(cls, d: h5py.Dataset, region: t_.Optional[t_.Tuple[slice, ...]] = None) -> np.ndarray:
+        """Read a dataset (or just `region` of it) that was saved in fixed point format.
+
+        Args:
+            d: The dataset to read.
+            region: An optional tuple of slices. If provided then only this region of the dataset will be read from file.
+
+        Returns:
+            The decoded data as a float32 array.
+        """
+        arr = d[()] if region is None else d[region]
+        m = np.asarray(d.attrs['min'], dtype=np.float64)
+        M = np.asarray(d.attrs['max'], dtype=np.float64)
+        nanValue = d.attrs['nanValue'] if 'nanValue' in d.attrs else None
+        out = np.empty(arr.shape, dtype=np.float32)
+        if 'fpTileShape' not in d.attrs:  # A single scale for the whole dataset.
+            np.multiply(arr, np.float32((M - m) / cls.MAXCODE), out=out)
+            out += np.float32(m)
+        else:
+            tileShape = tuple(d.attrs['fpTileShape'])
+            region = (tuple(region) if region is not None else ()) + (slice(None),) * 3
+            rows = np.arange(*region[0].indices(d.shape[0])) // tileShape[0]
+            cols = np.arange(*region[1].indices(d.shape[1])) // tileShape[1]
+            offsetImg = m[np.ix_(rows, cols)].astype(np.float32)[:, :, None]
+            scaleImg = ((M - m) / cls.MAXCODE)[np.ix_(rows, cols)].astype(np.float32)[:, :, None]
+            for start in range(0, arr.shape[0], tileShape[0]):  # Work in blocks so the intermediate values stay in cache.
+                s = slice(start, start + tileShape[0])
+                np.multiply(arr[s], scaleImg[s], out=out[s])
+                out[s] += offsetImg[s]
+        if nanValue is not None:
+            out[arr == nanValue] = np.nan
+        return out
+
+    @classmethod
+    def _limitTileShape(cls, tileShape: t_.Tuple[int, int], shape: t_.Tuple[int, ...]) -> t_.Tuple[int, int]:
+        """Increase the tile shape by whole numbers of HDF chunks until there are few enough tiles to store."""
+        ty, tx = max(1, min(tileShape[0], shape[0])), max(1, min(tileShape[1], shape[1]))
+        while -(-shape[0] // ty) * -(-shape[1] // tx) > cls._maxTiles:
+            ty, tx = ty * 2, tx * 2
+        return ty, tx
+
+    @staticmethod
+    def _getTileRange(data: np.ndarray, tileShape: t_.Tuple[int, int]) -> t_.Tuple[np.ndarray, np.ndarray]:
+        """Return 2D arrays of the minimum and maximum of each tile, ignoring NaN."""
+        if data.size == 0:
+            return np.zeros((1, 1)), np.ones((1, 1))
+        ys, xs = range(0, data.shape[0], tileShape[0]), range(0, data.shape[1], tileShape[1])
+        m, M = np.empty((len(ys), len(xs))), np.empty((len(ys), len(xs)))
+        for i, y in enumerate(ys):
+            for j, x in enumerate(xs):
+                tile = data[y:y + tileShape[0], x:x + tileShape[1]]
+                m[i, j] = np.fmin.reduce(tile, axis=None)  # Unlike `np.min` this ignores NaN.
+                M[i, j] = np.fmax.reduce(tile, axis=None)
+        allNan = np.isnan(m)  # Tiles that are entirely NaN.
+        m[allNan] = 0
+        M[allNan] = 1
+        return m, M
+
+    @staticmethod
+    def _expandTiles(a: np.ndarray, start: int, rows: int, tileShape: t_.Tuple[int, int], nx: int) -> np.ndarray:
+        """Expand a 2D array of per-tile values to the pixels of the block of rows beginning at `start`."""
+        if a.size == 1:
+            return np.float32(a.item())
+        rowIdx = np.arange(start, start + rows) // tileShape[0]
+        colIdx = np.arange(nx) // tileShape[1]
+        return a[np.ix_(rowIdx, colIdx)].astype(np.float32)[:, :, None]
@@ -21,8 +21,10 @@ import logging
 import multiprocessing as mp
 import os
 import pathlib
+import shutil
 import subprocess
 import sys
+import threading
 import typing as t_
 import abc
 import warnings
@@ -34,12 +36,13 @@ import numpy as np
 import tifffile as tf
 from scipy import io as spio
 from pwspy.dataTypes import _jsonSchemasPath
-from pwspy.dataTypes._other import CameraCorrection, Roi, RoiFile
+from pwspy.dataTypes._other import CameraCorrection, Roi, RoiFile, RoiLabelImage
 import pwspy.dataTypes._data as pwsdtd
 from pwspy import dateTimeFormat
 from pwspy.utility.misc import cached_property
 if t_.TYPE_CHECKING:
     from pwspy.analysis import AbstractHDFAnalysisResults
+    from pwspy.dataTypes._compression import HDFCompression
 
 
 class MetaDataBase(abc.ABC):
@@ -50,8 +53,11 @@ class MetaDataBase(abc.ABC):
         metadata: A dictionary containing the metadata
         filePath: The path to the location the metadata was loaded from
         acquisitionDirectory: A reference to the `Acquisition` associated with this object.
+        skipValidation: If True then `metadata` is not checked against the json schema. Only use this for metadata that
+            is known to be valid, e.g. metadata that was validated when it was saved to a `MetadataIndex`.
 
     """
+    _validatorLock = threading.Lock()  # jsonschema's `RefResolver` keeps a stack of scopes while validating so a validator can't be used by two threads at once.
 
     @property
     @abc.abstractmethod
@@ -66,12 +72,17 @@ class MetaDataBase(abc.ABC):
         This serves as a schematic that can be checked against when loading metadata to make sure it contains the required information."""
         pass
 
-    def __init__(self, metadata: dict, filePath: t_.Optional[str] = None, acquisitionDirectory: t_.Optional[Acquisition] = None):
+    def __init__(self, metadata: dict, filePath: t_.Optional[str] = None, acquisitionDirectory: t_.Optional[Acquisition] = None,
+                 skipValidation: bool = False):
         logger = logging.getLogger(__name__)
         self.filePath = filePath
         self.acquisitionDirectory = acquisitionDirectory
-        refResolver = jsonschema.RefResolver(pathlib.Path(self._jsonSchemaPath).as_uri(), None)  # This resolver is used to allow derived json schemas to refer to the base schema.
-        jsonschema.validate(instance=metadata, schema=self._jsonSchema, resolver=refResolver, cls=_TupleValidator)
+        if not skipValidation:
+            validator = self._getValidator()
+            with self._validatorLock:
+                error = jsonschema.exceptions.best_match(validator.iter_errors(metadata))
+            if error is not None:
+                raise error
         self.dict: dict = metadata
         try:
             datetime.strptime(self.dict['time'], dateTimeFormat)
@@ -92,6 +103,16 @@ class MetaDataBase(abc.ABC):
         else:
             self.cameraCorrection = None
 
+    @classmethod
+    def _getValidator(cls) -> jsonschema.protocols.Validator:
+        """The schema is checked and the validator is built only once for each subclass and then reused."""
+        validator = cls.__dict__.get('_validator')  # Don't use a validator inherited from a parent class.
+        if validator is None:
+            _TupleValidator.check_schema(cls._jsonSchema)
+            refResolver = jsonschema.RefResolver(pathlib.Path(cls._jsonSchemaPath).as_uri(), None)  # This resolver is used to allow derived json schemas to refer to the base schema. It caches the referenced schemas after the first time they are loaded.
+            validator = cls._validator = _TupleValidator(cls._jsonSchema, resolver=refResolver)
+        return validator
+
     @abc.abstractmethod
     def toDataClass(self, lock: t_.Optional[mp.Lock]) -> pwsdtd.ICBase:
         """Convert the metadata class to a class that loads the data
@@ -196,7 +217,7 @@ class AnalysisManager(abc.ABC):
         """
 
         Args:
-            path: The path to search for analysis files.
+            path: The path to search for analysis files. Analyses saved as HDF files and as `DirectoryStore`s are both found.
 
         Returns:
             A list of the names of analyses that were found.
@@ -204,22 +225,30 @@ class AnalysisManager(abc.ABC):
         anPath = os.path.join(path, 'analyses')
         if os.path.exists(anPath):
             files = os.listdir(os.path.join(path, 'analyses'))
-            return [cls.getAnalysisResultsClass().fileName2Name(f) for f in files]
+            resultsClass = cls.getAnalysisResultsClass()
+            return [resultsClass.storeName2Name(f) if f.endswith(resultsClass.StoreSuffix) else resultsClass.fileName2Name(f)
+                    for f in files]
         else:
             return []
 
-    def saveAnalysis(self, analysis: AbstractHDFAnalysisResults, name: str, overwrite: bool = False):
+    def saveAnalysis(self, analysis: AbstractHDFAnalysisResults, name: str, overwrite: bool = False,
+                     compression: t_.Union[None, str, int, HDFCompression] = None,
+                     fileFormat: t_.Optional[AbstractHDFAnalysisResults.FileFormats] = None):
         """
 
         Args:
             analysis: An AnalysisResults object to be saved.
             name: The name to save the analysis as
             overwrite: If `True` then any existing file of the same name will be replaced. If `False` an exception will be raised.
+            compression: The compression filter to use for the datasets in the file. See `HDFCompression`.
+            fileFormat: The format to save the analysis in. See `AbstractHDFAnalysisResults.FileFormats`. If `None` an HDF file is saved.
         """
         path = os.path.join(self.__filePath, 'analyses')
         if not os.path.exists(path):
             os.mkdir(path)
-        analysis.toHDF(path, name, overwrite=overwrite)
+        if fileFormat is None:
+            fileFormat = analysis.FileFormats.Hdf
+        analysis.toHDF(path, name, overwrite=overwrite, compression=compression, fileFormat=fileFormat)
 
     def loadAnalysis(self, name: str) -> AbstractHDFAnalysisResults:
         """
@@ -238,7 +267,12 @@ class AnalysisManager(abc.ABC):
         Args:
             name: The name of the analysis to be deleted
         """
-        os.remove(os.path.join(self.__filePath, 'analyses', self.getAnalysisResultsClass().name2FileName(name)))
+        resultsClass = self.getAnalysisResultsClass()
+        storePath = os.path.join(self.__filePath, 'analyses', resultsClass.name2StoreName(name))
+        if os.path.isdir(storePath):
+            shutil.rmtree(storePath)
+        else:
+            os.remove(os.path.join(self.__filePath, 'analyses', resultsClass.name2FileName(name)))
 
 
 class DynMetaData(MetaDataBase, AnalysisManager):
@@ -258,9 +292,10 @@ class DynMetaData(MetaDataBase, AnalysisManager):
     with open(_jsonSchemaPath) as f:
         _jsonSchema = json.load(f)
 
-    def __init__(self, metadata: dict, filePath: t_.Optional[str] = None, fileFormat: t_.Optional[FileFormats] = None, acquisitionDirectory: t_.Optional[Acquisition] = None):
+    def __init__(self, metadata: dict, filePath: t_.Optional[str] = None, fileFormat: t_.Optional[FileFormats] = None, acquisitionDirectory: t_.Optional[Acquisition] = None,
+                 skipValidation: bool = False):
         self.fileFormat = fileFormat
-        MetaDataBase.__init__(self, metadata, filePath, acquisitionDirectory=acquisitionDirectory)
+        MetaDataBase.__init__(self, metadata, filePath, acquisitionDirectory=acquisitionDirectory, skipValidation=skipValidation)
         AnalysisManager.__init__(self, filePath)
 
     def toDataClass(self, lock: mp.Lock = None) -> pwsdtd.DynCube:
@@ -395,13 +430,24 @@ class ERMetaData:
     FILESUFFIX = '_eReflectance.h5'
     DATASETTAG = 'extraReflection'
     _MDTAG = 'metadata'
+    _validator = None
 
     def __init__(self, inheritedMetadata: dict, numericalAperture: float, filePath: str = None):
         self.inheritedMetadata = inheritedMetadata
         self.inheritedMetadata['numericalAperture'] = numericalAperture
-        jsonschema.validate(instance=inheritedMetadata, schema=self._jsonSchema, cls=_TupleValidator)
+        error = jsonschema.exceptions.best_match(self._getValidator().iter_errors(inheritedMetadata))
+        if error is not None:
+            raise error
         self.filePath = filePath
 
+    @classmethod
+    def _getValidator(cls) -> jsonschema.protocols.Validator:
+        """The schema is checked and the validator is built the first time it is needed and then reused."""
+        if cls._validator is None:
+            _TupleValidator.check_schema(cls._jsonSchema)
+            cls._validator = _TupleValidator(cls._jsonSchema)
+        return cls._validator
+
     @property
     def idTag(self) -> str:
         """A unique tag to identify this acquisition by."""
@@ -513,8 +559,8 @@ class FluorMetaData(MetaDataBase):
     with open(_jsonSchemaPath) as f:
         _jsonSchema = json.load(f)
 
-    def __init__(self, md: dict, filePath: t_.Optional[str] = None, acquisitionDirectory: t_.Optional[Acquisition] = None):
-        super().__init__(md, filePath, acquisitionDirectory)
+    def __init__(self, md: dict, filePath: t_.Optional[str] = None, acquisitionDirectory: t_.Optional[Acquisition] = None, skipValidation: bool = False):
+        super().__init__(md, filePath, acquisitionDirectory, skipValidation=skipValidation)
 
     def toDataClass(self, lock: mp.Lock = None) -> pwsdtd.FluorescenceImage:
         return pwsdtd.FluorescenceImage.fromMetadata(self, lock)
@@ -595,8 +641,9 @@ class PwsMetaData(MetaDataBase, AnalysisManager):
     with open(_jsonSchemaPath) as f:
         _jsonSchema = json.load(f)
 
-    def __init__(self, metadata: dict, filePath: t_.Optional[str] = None, fileFormat: PwsMetaData.FileFormats = None, acquisitionDirectory: t_.Optional[Acquisition] = None):
-        MetaDataBase.__init__(self, metadata, filePath, acquisitionDirectory=acquisitionDirectory)
+    def __init__(self, metadata: dict, filePath: t_.Optional[str] = None, fileFormat: PwsMetaData.FileFormats = None, acquisitionDirectory: t_.Optional[Acquisition] = None,
+                 skipValidation: bool = False):
+        MetaDataBase.__init__(self, metadata, filePath, acquisitionDirectory=acquisitionDirectory, skipValidation=skipValidation)
         AnalysisManager.__init__(self, filePath)
         self.fileFormat: PwsMetaData.FileFormats = fileFormat
         self.dict['wavelengths'] = tuple(np.array(self.dict['wavelengths']).astype(float))
@@ -865,6 +912,28 @@ class Acquisition:
         else:
             return RoiFile.loadAny(self.filePath, name, num, acquisition=self)
 
+    def getRoiLabelImage(self, name: str) -> RoiLabelImage:
+        """Load all of the ROIs with the same name into a single label image.
+
+        Args:
+            name: The name of the ROIs to load.
+
+        Returns:
+            The label image. The `numbers` attribute gives the ROI number associated with each label.
+
+        Raises:
+            ValueError: If no ROIs of that name are found or if the ROIs overlap.
+        """
+        roiFiles = sorted((roiFile for roiFile in self.loadAllRois() if roiFile.name == name), key=lambda roiFile: roiFile.number)
+        if len(roiFiles) == 0:
+            raise ValueError(f"No ROIs named {name} were found in {self.filePath}.")
+        return RoiLabelImage.fromRois([roiFile.getRoi() for roiFile in roiFiles], numbers=[roiFile.number for roiFile in roiFiles])
+
+    def loadAllRois(self) -> t_.List[RoiFile]:
+        """Load all of the Rois found in the acquisition's file path. This is faster than loading each Roi with `loadRoi`.
+        See documentation for RoiFile.loadAllInPath()"""
+        return RoiFile.loadAllInPath(self.filePath, acquisition=self)
+
     def saveRoi(self, roiName: str, roiNumber: int, roi: Roi, overwrite: bool = False) -> RoiFile:
         """
         Save a Roi to file in the acquisition's file path.
@@ -0,0 +1,239 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+import copy
+import json
+import logging
+import os
+import pathlib
+import threading
+import typing as t_
+
+import numpy as np
+
+from ._metadata import Acquisition, PwsMetaData, DynMetaData, FluorMetaData, MetaDataBase
+from ._other import RoiFile
+
+
+class MetadataIndex:
+    """An optional on-disk cache of the metadata of the acquisitions under a dataset root directory. Constructing an
+    `Acquisition` normally requires opening several files (TIFF headers, JSON files, ROI files) which can be very slow
+    on network storage. The index stores the parsed metadata, the detected file formats, the ROI listings and the
+    analysis names for each acquisition in a single JSON-lines file in the root directory.
+
+    Each entry records the modification time and size of the files and folders it was built from. When an entry is
+    requested these are checked with `os.stat` and only the entries that are out of date are rebuilt from the original
+    files. Directories that are not valid acquisitions are also recorded so that they don't need to be probed again.
+
+    The index can be used as a context manager, in which case it is saved when the context exits.
+
+    Args:
+        rootDirectory: The root directory of the dataset. All acquisitions must be inside of this directory.
+    """
+    FILENAME = 'pwspyMetadataIndex.jsonl'
+    _VERSION = 1  # Increment this if the format of the entries changes. Entries with a different version are ignored.
+
+    def __init__(self, rootDirectory: t_.Union[str, os.PathLike]):
+        self.rootDirectory = os.path.abspath(rootDirectory)
+        self._entries: t_.Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._modified = False
+        self._load()
+
+    @property
+    def filePath(self) -> str:
+        """The path to the file that the index is saved in."""
+        return os.path.join(self.rootDirectory, self.FILENAME)
+
+    def __enter__(self) -> MetadataIndex:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.save()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def getAcquisition(self, directory: t_.Union[str, os.PathLike]) -> Acquisition:
+        """Get the `Acquisition` for a directory. If the index entry is up to date then no files are opened.
+
+        Args:
+            directory: The file path to the root directory of the acquisition.
+
+        Returns:
+            The `Acquisition` with its `pws`, `dynamics`, and `fluorescence` metadata already loaded.
+
+        Raises:
+            OSError: If `directory` is not a valid acquisition.
+        """
+        entry = self._getEntry(directory)
+        if not entry['valid']:
+            raise OSError(f"Could not find a valid PWS or Dynamics Acquisition at {directory}.")
+        return self._acquisitionFromEntry(entry)
+
+    def getRois(self, directory: t_.Union[str, os.PathLike]) -> t_.List[t_.Tuple[str, int, RoiFile.FileFormats]]:
+        """The index equivalent of `Acquisition.getRois`.
+
+        Args:
+            directory: The file path to the root directory of the acquisition.
+
+        Returns:
+            A list of tuples of the name, number, and file format of each ROI in the acquisition.
+        """
+        entry = self._getEntry(directory)
+        return [(name, num, RoiFile.FileFormats[fformat]) for name, num, fformat in entry['rois']]
+
+    def getAnalyses(self, directory: t_.Union[str, os.PathLike]) -> t_.Dict[str, t_.List[str]]:
+        """The index equivalent of `AnalysisManager.getAnalyses`.
+
+        Args:
+            directory: The file path to the root directory of the acquisition.
+
+        Returns:
+            A dictionary with keys 'pws' and 'dynamics' containing the names of the analyses found for each type of acquisition.
+        """
+        entry = self._getEntry(directory)
+        return copy.deepcopy(entry['analyses'])
+
+    def prune(self):
+        """Remove the entries for directories that no longer exist."""
+        with self._lock:
+            for key in [k for k in self._entries if not os.path.isdir(self._absPath(k))]:
+                del self._entries[key]
+                self._modified = True
+
+    def save(self):
+        """Write the index to file. Nothing is written if there have been no changes since it was loaded."""
+        with self._lock:
+            if not self._modified:
+                return
+            tempPath = self.filePath + '.tmp'
+            with open(tempPath, 'w') as f:
+                for entry in self._entries.values():
+                    f.write(json.dumps(entry, default=_jsonDefault) + '\n')
+            os.replace(tempPath, self.filePath)  # Replacing the file in one step means that a crash can't leave a half-written index.
+            self._modified = False
+
+    def _load(self):
+        if not os.path.exists(self.filePath):
+            return
+        with open(self.filePath, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.getLogger(__name__).warning(f"Skipping an unreadable line in {self.filePath}")
+                    continue
+                if entry.get('version') == self._VERSION:
+                    self._entries[entry['path']] = entry
+
+    def _relPath(self, path: str) -> str:
+        """Paths are stored relative to the root directory, with forward slashes, so that the index still works if the dataset is moved or opened from another OS."""
+        return pathlib.Path(os.path.relpath(os.path.abspath(path), self.rootDirectory)).as_posix()
+
+    def _absPath(self, relPath: str) -> str:
+        return os.path.normpath(os.path.join(self.rootDirectory, *relPath.split('/')))
+
+    def _getEntry(self, directory: t_.Union[str, os.PathLike]) -> dict:
+        """Return the entry for `directory`, rebuilding it first if it is missing or out of date."""
+        key = self._relPath(directory)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and self._isCurrent(entry):
+            return entry
+        entry = self._createEntry(key)
+        with self._lock:
+            self._entries[key] = entry
+            self._modified = True
+        return entry
+
+    def _isCurrent(self, entry: dict) -> bool:
+        return all(self._stamp(self._absPath(path)) == (None if stamp is None else tuple(stamp)) for path, stamp in entry['stamps'].items())
+
+    @staticmethod
+    def _stamp(path: str) -> t_.Optional[t_.Tuple[int, int]]:
+        """The modification time and size of a file. None if it doesn't exist."""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _createEntry(self, key: str) -> dict:
+        """Load an acquisition from the original files and record everything we need to recreate it."""
+        directory = self._absPath(key)
+        entry = {'version': self._VERSION, 'path': key, 'valid': False, 'pws': None, 'dynamics': None,
+                 'fluorescence': [], 'rois': [], 'analyses': {'pws': [], 'dynamics': []}}
+        try:
+            acq = Acquisition(directory)
+        except OSError:
+            # Not an acquisition. Changes to the directory or any of its subdirectories might make it one.
+            stampedPaths = [directory] + ([e.path for e in os.scandir(directory) if e.is_dir()] if os.path.isdir(directory) else [])
+            entry['stamps'] = {self._relPath(p): self._stamp(p) for p in stampedPaths}
+            return entry
+        entry['valid'] = True
+        if acq.pws is not None:
+            entry['pws'] = self._metadataToEntry(acq.pws)
+            entry['analyses']['pws'] = acq.pws.getAnalyses()
+        if acq.dynamics is not None:
+            entry['dynamics'] = self._metadataToEntry(acq.dynamics)
+            entry['analyses']['dynamics'] = acq.dynamics.getAnalyses()
+        entry['fluorescence'] = [self._metadataToEntry(md) for md in acq.fluorescence]
+        entry['rois'] = [(name, num, fformat.name) for name, num, fformat in acq.getRois()]
+        # The acquisition directory and the metadata directories are stamped along with every file in them. Adding or
+        # removing a file changes the modification time of its directory. The analysis directories only affect the list of analysis names.
+        stampedPaths = []
+        for d in {directory} | {md.filePath for md in [acq.pws, acq.dynamics] + acq.fluorescence if md is not None}:
+            stampedPaths += [d] + [e.path for e in os.scandir(d) if e.is_file()]
+        for md in [acq.pws, acq.dynamics]:
+            if md is not None:
+                stampedPaths.append(os.path.join(md.filePath, 'analyses'))
+        entry['stamps'] = {self._relPath(p): self._stamp(p) for p in stampedPaths}
+        return entry
+
+    def _metadataToEntry(self, md: MetaDataBase) -> dict:
+        fileFormat = getattr(md, 'fileFormat', None)
+        return {'metadata': md.dict, 'filePath': self._relPath(md.filePath), 'fileFormat': fileFormat.name if fileFormat is not None else None}
+
+    def _acquisitionFromEntry(self, entry: dict) -> Acquisition:
+        """Create an `Acquisition` with its cached properties already filled in from the index entry."""
+        acq = Acquisition.__new__(Acquisition)  # Skip `__init__` which would probe the files.
+        acq.filePath = self._absPath(entry['path'])
+        acq.__dict__['pws'] = self._metadataFromEntry(entry['pws'], PwsMetaData, acq)
+        acq.__dict__['dynamics'] = self._metadataFromEntry(entry['dynamics'], DynMetaData, acq)
+        acq.__dict__['fluorescence'] = [self._metadataFromEntry(md, FluorMetaData, acq) for md in entry['fluorescence']]
+        return acq
+
+    def _metadataFromEntry(self, mdEntry: t_.Optional[dict], mdClass: t_.Type[MetaDataBase], acq: Acquisition) -> t_.Optional[MetaDataBase]:
+        if mdEntry is None:
+            return None
+        kwargs = {}
+        if mdEntry['fileFormat'] is not None:
+            kwargs['fileFormat'] = mdClass.FileFormats[mdEntry['fileFormat']]
+        # The metadata was validated when the entry was created.
+        return mdClass(copy.deepcopy(mdEntry['metadata']), self._absPath(mdEntry['filePath']), acquisitionDirectory=acq, skipValidation=True, **kwargs)
+
+
+def _jsonDefault(obj):
+    """Metadata loaded from .mat files can contain numpy scalars which the `json` module doesn't handle."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
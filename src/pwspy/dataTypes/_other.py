@@ -22,15 +22,19 @@ Created on Sat Feb  9 15:57:52 2019
 @author: Nick Anthony
 """
 from __future__ import annotations
+import collections
+import contextlib
 import json
 import logging
 import os
 import dataclasses
+import threading
 from enum import Enum, auto
 from glob import glob
 import h5py
 import numpy as np
 from scipy import io as spio
+from scipy import ndimage
 from shapely import geometry, wkb
 import cv2
 from rasterio import features
@@ -102,18 +106,29 @@ class Roi:
     mask, this is useful if you want to adjust the Roi later. Rather than calling the constructor directly you will
     generally create one of these objects through one of the `class methods` that construct one for you.
 
+    Internally only the region of the mask within the bounding box of the Roi is stored. This keeps a small Roi on a
+    large image from using much memory. The full size `mask` is created each time it is accessed, when possible use
+    `croppedMask` and `getBoundingBox` instead.
+
     Args:
         mask: A 2D boolean array where the True values indicate pixels that are within the ROI.
         verts: Can be a sequence of 2D (x, y) coordinates indicating the border of the ROI or a shapely `Polygon`.
             If an array of coordinates is used then it will be converted to the shell of a shapely polygon internally.
             While this information is partially redundant with the mask it is useful for many applications and can be
             complicated to calculate from `mask`.
+
+    Attributes:
+        shape: The shape of the image that the Roi belongs to.
     """
 
     def __init__(self, mask: np.ndarray, verts: t_.Union[np.ndarray, geometry.Polygon]):
         assert isinstance(mask, np.ndarray), f"Mask data is of type: {type(mask)}. Must be numpy array."
         assert len(mask.shape) == 2
         assert mask.dtype == np.bool
+        self._setPolygon(verts)
+        self.mask = mask
+
+    def _setPolygon(self, verts: t_.Union[np.ndarray, geometry.Polygon]):
         self.polygon: geometry.Polygon
         if isinstance(verts, geometry.MultiPolygon):  # I'm not sure how but it is possible to get a multipolygon. In this case just select out the biggest polygon.
             verts = verts[0]
@@ -125,13 +140,76 @@ class Roi:
             self.polygon = geometry.Polygon(shell=verts)
         self.polygon = self.polygon.buffer(0)  # This little trick `normalizes` the format of the polygon so that holes will plot properly. https://gis.stackexchange.com/questions/374001/plotting-shapely-polygon-with-holes-does-not-plot-all-holes
 
-        self.mask = mask
+    def _setCroppedMask(self, mask: np.ndarray, offset: t_.Tuple[int, int], shape: t_.Tuple[int, int]):
+        """Store the smallest region of `mask` that contains all of its `True` pixels. `offset` is the (row, column) of
+        the first pixel of `mask` within the full image of `shape`."""
+        self.shape = tuple(shape)
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if len(rows) == 0:  # Empty mask
+            self._boundingBox = (slice(0, 0), slice(0, 0))
+            self._croppedMask = np.zeros((0, 0), dtype=bool)
+            return
+        self._boundingBox = (slice(offset[0] + rows[0], offset[0] + rows[-1] + 1), slice(offset[1] + cols[0], offset[1] + cols[-1] + 1))
+        self._croppedMask = np.array(mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1], dtype=bool)  # Copy so that the full size array can be released.
+
+    @property
+    def mask(self) -> np.ndarray:
+        """A 2D boolean array the size of the full image where the True values indicate pixels that are within the ROI."""
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[self._boundingBox] = self._croppedMask
+        return mask
+
+    @mask.setter
+    def mask(self, mask: np.ndarray):
+        self._setCroppedMask(mask, (0, 0), mask.shape)
+
+    @property
+    def croppedMask(self) -> np.ndarray:
+        """The region of `mask` within the bounding box returned by `getBoundingBox`."""
+        return self._croppedMask
 
     @property
     def verts(self) -> np.ndarray:
         """An array of vertices for the outer ring of the polygon. For most ROIs they only have an outer ring anyway."""
         return np.array(self.polygon.exterior.coords)
 
+    def getBoundingBox(self) -> t_.Tuple[slice, slice]:
+        """Find the smallest rectangle that contains all of the pixels of `mask`. Useful for reading only the necessary
+        region of an image.
+
+        Returns:
+            A tuple of slices (rows, columns) that can be used to index a 2D or 3D array.
+        """
+        return self._boundingBox
+
+    def __setstate__(self, state: dict):
+        if 'mask' in state:  # Rois pickled before the mask was stored cropped.
+            mask = state.pop('mask')
+            self.__dict__.update(state)
+            self.mask = mask
+        else:
+            self.__dict__.update(state)
+
+    @classmethod
+    def fromCroppedMask(cls, croppedMask: np.ndarray, offset: t_.Tuple[int, int], shape: t_.Tuple[int, int],
+                        verts: t_.Union[np.ndarray, geometry.Polygon]) -> Roi:
+        """Create an Roi without ever creating a full size mask.
+
+        Args:
+            croppedMask: A 2D boolean array covering a region of the image.
+            offset: The (row, column) coordinate of the first pixel of `croppedMask` within the full image.
+            shape: The shape of the full image.
+            verts: See the documentation of the constructor.
+
+        Returns:
+            A new instance of `Roi`
+        """
+        roi = cls.__new__(cls)
+        roi._setPolygon(verts)
+        roi._setCroppedMask(croppedMask, offset, shape)
+        return roi
+
     @classmethod
     def fromVerts(cls, verts: np.ndarray, dataShape: t_.Tuple[float, float]) -> Roi:
         """
@@ -194,6 +272,137 @@ class Roi:
         return Roi(mask=mask, verts=verts)
 
 
+class RoiLabelImage:
+    """A single integer image that labels the pixels of many ROIs of the same image. Pixels with a value of 0 are not
+    in any ROI, pixels with a value of `i + 1` are in the `i`th ROI. This uses much less memory than a separate full size
+    mask for each ROI and allows per-ROI statistics to be calculated for all ROIs at once. The ROIs may not overlap.
+
+    Args:
+        labels: The 2D integer label image.
+        numbers: The ROI number associated with each label. If `None` then the label values minus one are used.
+    """
+    def __init__(self, labels: np.ndarray, numbers: t_.Optional[t_.Sequence[int]] = None):
+        assert labels.ndim == 2
+        self.labels = labels
+        self.numbers = list(numbers) if numbers is not None else list(range(int(labels.max(initial=0))))
+        self._counts = None
+
+    @classmethod
+    def fromRois(cls, rois: t_.Sequence[Roi], numbers: t_.Optional[t_.Sequence[int]] = None) -> RoiLabelImage:
+        """Combine several ROIs into a label image.
+
+        Args:
+            rois: The ROIs to combine. They must all belong to images of the same shape and must not overlap.
+            numbers: The ROI number associated with each ROI. If `None` then they are numbered in order starting from 0.
+
+        Returns:
+            A new instance of `RoiLabelImage`
+
+        Raises:
+            ValueError: If the ROIs overlap or have different shapes.
+        """
+        if len(rois) == 0:
+            raise ValueError("At least one ROI is required.")
+        shape = rois[0].shape
+        labels = np.zeros(shape, dtype=np.uint16 if len(rois) < 2**16 else np.uint32)
+        for i, roi in enumerate(rois):
+            if roi.shape != shape:
+                raise ValueError(f"ROI {i} has shape {roi.shape} which does not match the shape of the first ROI {shape}.")
+            region = labels[roi.getBoundingBox()]
+            if np.any(region[roi.croppedMask] != 0):
+                raise ValueError(f"ROI {i} overlaps with another ROI.")
+            region[roi.croppedMask] = i + 1
+        return cls(labels, numbers if numbers is not None else range(len(rois)))
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def getBoundingBoxes(self) -> t_.List[t_.Tuple[slice, slice]]:
+        """The bounding box of each ROI. Empty ROIs have an empty bounding box."""
+        boxes = ndimage.find_objects(self.labels, max_label=len(self))
+        return [box if box is not None else (slice(0, 0), slice(0, 0)) for box in boxes]
+
+    def getRoiMask(self, index: int) -> t_.Tuple[t_.Tuple[slice, slice], np.ndarray]:
+        """Get the mask of a single ROI, cropped to its bounding box.
+
+        Args:
+            index: The index of the ROI, this is one less than the value of its label.
+
+        Returns:
+            The bounding box of the ROI, The mask of the ROI within the bounding box.
+        """
+        box = self.getBoundingBoxes()[index]
+        return box, self.labels[box] == index + 1
+
+    def getCounts(self) -> np.ndarray:
+        """The number of pixels in each ROI."""
+        if self._counts is None:
+            self._counts = np.bincount(self.labels.ravel(), minlength=len(self) + 1)[1:len(self) + 1]
+        return self._counts
+
+    def mean(self, image: np.ndarray) -> np.ndarray:
+        """Calculate the mean of a 2D image within each ROI in a single pass.
+
+        Args:
+            image: A 2D array of the same shape as `labels`.
+
+        Returns:
+            A 1D array of the mean value within each ROI. Empty ROIs are NaN.
+        """
+        assert image.shape == self.labels.shape
+        sums = np.bincount(self.labels.ravel(), weights=image.ravel(), minlength=len(self) + 1)[1:len(self) + 1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / self.getCounts()
+
+
+class _HDFFileCache:
+    """A small least-recently-used cache of HDF files that are open for reading. Opening a file can be slow, especially on
+    network storage, so this avoids reopening the same file for each ROI that is loaded from it. If a file has been
+    modified since it was opened it is reopened.
+
+    Args:
+        maxSize: The maximum number of files to keep open.
+    """
+    def __init__(self, maxSize: int = 8):
+        self._maxSize = maxSize
+        self._files: t_.OrderedDict[str, t_.Tuple[t_.Tuple[int, int], h5py.File]] = collections.OrderedDict()
+        self._lock = threading.RLock()  # h5py objects shouldn't be closed while another thread is using them.
+
+    @contextlib.contextmanager
+    def open(self, path: str) -> t_.Iterator[h5py.File]:
+        """A context manager giving an open, read-only, `h5py.File`. The file should not be used after the context exits."""
+        path = os.path.abspath(path)
+        with self._lock:
+            st = os.stat(path)
+            stamp = (st.st_mtime_ns, st.st_size)
+            entry = self._files.pop(path, None)
+            if entry is not None and (entry[0] != stamp or not entry[1].id.valid):
+                entry[1].close()
+                entry = None
+            if entry is None:
+                # Without file locking the open handle doesn't stop other processes from writing to the file. Changes are detected with `stamp`.
+                entry = (stamp, h5py.File(path, 'r', locking=False))
+            self._files[path] = entry  # Move to the end of the ordered dict to mark it as most recently used.
+            while len(self._files) > self._maxSize:
+                _, (_, oldFile) = self._files.popitem(last=False)
+                oldFile.close()
+            yield entry[1]
+
+    def evict(self, path: str):
+        """Close `path` if it is open."""
+        with self._lock:
+            entry = self._files.pop(os.path.abspath(path), None)
+            if entry is not None:
+                entry[1].close()
+
+    def clear(self):
+        """Close all of the open files."""
+        with self._lock:
+            for stamp, hf in self._files.values():
+                hf.close()
+            self._files.clear()
+
+
 class RoiFile:
     """This class represents a single Roi File used to save and load an ROI. Each Roi File is identified by a
     `name` and a `number`. The recommended file format is HDF2, in this format multiple rois of the same name but differing
@@ -215,6 +424,8 @@ class RoiFile:
         HDF2 = auto()  # For a long time this was the default. Each ROI of the same name is saved as an H5PY.Group in an HDF file. Each ROI group contains a dataset for the boolean mask as well as a dataset for the XY coordinates of the enclosing polygon. This saves us from having to constantly recalculate the outline of the ROI for processing purposes.
         HDF3 = auto()  # On 3/26/2021 We switched to this from HDF2. Rather than verts we now store 'wkb' of the underlying shapely file. Allow for ROIs with holes, and other more complex situations.
 
+    _fileCache = _HDFFileCache()  # Shared by all instances.
+
     def __init__(self, name: str, number: int, roi: Roi, filePath: str, fileFormat: RoiFile.FileFormats, acquisition: metadata.Acquisition):
         self._roi = roi
         self.name = name
@@ -249,51 +460,103 @@ class RoiFile:
                 number: The detected Roi number
                 fformat: The file format of the file that the Roi is stored in
         """
-        patterns = [('BW*_*.mat', RoiFile.FileFormats.MAT), ('ROI_*.h5', RoiFile.FileFormats.HDF)]
-        files = {fformat: glob(os.path.join(path, p)) for p, fformat in patterns}  # Lists of the found files keyed by file format
-        ret = []
-        for fformat, fileNames in files.items():
-            if fformat == RoiFile.FileFormats.HDF:  # Could still technically be HDF2 or HDF3
-                for i in fileNames:
-                    with h5py.File(i, 'r') as hf:  # making sure to open this file in read mode makes the function way faster!
-                        for g in hf.keys():
-                            if isinstance(hf[g], h5py.Group):  # HDF3 or HDF2 file format
-                                if 'fileFormat' in hf[g].attrs:  # HDF3 format
-                                    assert 'wkb' in hf[g]
-                                    assert 'ROI_' in i
-                                    name = i.split("ROI_")[-1][:-3]
-                                    try:
-                                        ret.append((name, int(g), RoiFile.FileFormats.HDF3))
-                                    except ValueError:
-                                        logging.getLogger(__name__).warning(f"File {i} contains uninterpretable dataset named {g}")
-                                else:  # HDF2 did not have this fileformat attribute
-                                    if 'mask' in hf[g] and 'verts' in hf[g]:
-                                        assert 'ROI_' in i
-                                        name = i.split("ROI_")[-1][:-3]
-                                        try:
-                                            ret.append((name, int(g), RoiFile.FileFormats.HDF2))
-                                        except ValueError:
-                                            logging.getLogger(__name__).warning(f"File {i} contains uninterpretable dataset named {g}")
-                                    else:
-                                        raise ValueError("File is missing datasets")
-                            elif isinstance(hf[g], h5py.Dataset):  # Legacy format
-                                assert 'roi_' in i
-                                name = i.split('roi_')[-1][:-3]  # Old files used lower case rather than "ROI_"
-                                try:
-                                    ret.append((name, int(g), RoiFile.FileFormats.HDF))
-                                except ValueError:
-                                    logging.getLogger(__name__).warning(f"File {i} contains uninterpretable dataset named {g}")
-
-            elif fformat == RoiFile.FileFormats.MAT:
-                for i in fileNames:  # list in files
-                    i = os.path.split(i)[-1]
-                    if len(i.split("_")) != 2:  # Some old data has files that are not ROIs but are named almost identically, this helps us avoid bugs with them.
-                        continue
-                    num = int(i.split('_')[0][2:])
-                    name = i.split('_')[1][:-4]
-                    ret.append((name, num, RoiFile.FileFormats.MAT))
+        ret = [(name, num, fformat) for filePath, name, num, fformat, obj in RoiFile._iterHDFRois(path)]
+        ret += [(name, num, RoiFile.FileFormats.MAT) for name, num in RoiFile._iterMatRois(path)]
+        return ret
+
+    @classmethod
+    def loadAllInPath(cls, path: str, acquisition: metadata.Acquisition = None) -> t_.List[RoiFile]:
+        """Load every Roi found in `path`. This is much faster than calling `getValidRoisInPath` and then loading each
+        Roi individually since each file is only opened once and the format of each Roi is only detected once.
+
+        Args:
+            path: The path to the folder containing the Roi files.
+            acquisition: The acquisition object that the ROIs belong to.
+
+        Returns:
+            A list of the loaded Roi files, in the same order as the output of `getValidRoisInPath`.
+        """
+        ret = [cls(name, num, cls._roiFromHDF(obj, fformat), filePath=filePath, fileFormat=fformat, acquisition=acquisition)
+               for filePath, name, num, fformat, obj in cls._iterHDFRois(path)]
+        ret += [cls.fromMat(path, name, num, acquisition=acquisition) for name, num in cls._iterMatRois(path)]
         return ret
 
+    @classmethod
+    def clearFileCache(cls):
+        """Close the HDF files that have been kept open for reading. Files are kept open to speed up repeated access, this
+        can be called if the files need to be released, e.g. so they can be deleted on Windows."""
+        cls._fileCache.clear()
+
+    @staticmethod
+    def _iterHDFRois(path: str) -> t_.Iterator[t_.Tuple[str, str, int, RoiFile.FileFormats, t_.Union[h5py.Group, h5py.Dataset]]]:
+        """Yield the file path, name, number, format, and h5py object of each Roi in the HDF files in `path`. Each file is only opened once."""
+        for filePath in glob(os.path.join(path, 'ROI_*.h5')):
+            with RoiFile._fileCache.open(filePath) as hf:
+                for g in hf.keys():
+                    obj = hf[g]
+                    fformat = RoiFile._detectHDFFormat(obj)
+                    if fformat == RoiFile.FileFormats.HDF:
+                        assert 'roi_' in filePath
+                        name = filePath.split('roi_')[-1][:-3]  # Old files used lower case rather than "ROI_"
+                    else:
+                        assert 'ROI_' in filePath
+                        name = filePath.split("ROI_")[-1][:-3]
+                    try:
+                        num = int(g)
+                    except ValueError:
+                        logging.getLogger(__name__).warning(f"File {filePath} contains uninterpretable dataset named {g}")
+                        continue
+                    yield filePath, name, num, fformat, obj
+
+    @staticmethod
+    def _iterMatRois(path: str) -> t_.Iterator[t_.Tuple[str, int]]:
+        """Yield the name and number of each Roi in the .mat files in `path`."""
+        for i in glob(os.path.join(path, 'BW*_*.mat')):
+            i = os.path.split(i)[-1]
+            if len(i.split("_")) != 2:  # Some old data has files that are not ROIs but are named almost identically, this helps us avoid bugs with them.
+                continue
+            num = int(i.split('_')[0][2:])
+            name = i.split('_')[1][:-4]
+            yield name, num
+
+    @staticmethod
+    def _detectHDFFormat(obj: t_.Union[h5py.Group, h5py.Dataset]) -> RoiFile.FileFormats:
+        """Determine the file format of a single Roi saved in an HDF file."""
+        if isinstance(obj, h5py.Group):  # HDF3 or HDF2 file format
+            if 'fileFormat' in obj.attrs:  # HDF3 format
+                assert 'wkb' in obj
+                return RoiFile.FileFormats.HDF3
+            elif 'mask' in obj and 'verts' in obj:  # HDF2 did not have this fileformat attribute
+                return RoiFile.FileFormats.HDF2
+            else:
+                raise ValueError("File is missing datasets")
+        elif isinstance(obj, h5py.Dataset):  # Legacy format
+            return RoiFile.FileFormats.HDF
+        else:
+            raise TypeError(f"Unexpected HDF object of type {type(obj)}")
+
+    @staticmethod
+    def _roiFromHDF(obj: t_.Union[h5py.Group, h5py.Dataset], fformat: RoiFile.FileFormats) -> Roi:
+        """Load a single Roi from an open HDF file."""
+        if fformat == RoiFile.FileFormats.HDF3:
+            polygon = wkb.loads(bytes(obj['wkb'][()]))
+            dset = obj['mask']
+            if 'boundingBox' in dset.attrs:
+                rowStart, rowStop, colStart, colStop = (int(i) for i in dset.attrs['boundingBox'])
+                return Roi.fromCroppedMask(dset[rowStart:rowStop, colStart:colStop].astype(np.bool), (rowStart, colStart), dset.shape, verts=polygon)
+            else:
+                return Roi(np.array(dset).astype(np.bool), verts=polygon)
+        elif fformat == RoiFile.FileFormats.HDF2:
+            verts = obj['verts']
+            if verts.shape is None:
+                return Roi.fromMask(np.array(obj['mask']).astype(np.bool))  # Some old files could be saved without verts. allow loading them.
+            else:
+                return Roi(np.array(obj['mask']).astype(np.bool), verts=np.array(verts))
+        elif fformat == RoiFile.FileFormats.HDF:
+            return Roi.fromMask(np.array(obj).astype(np.bool))
+        else:
+            raise ValueError(f"{fformat} is not an HDF format.")
+
     @staticmethod
     def deleteRoi(directory: str, name: str, number: int, fformat: t_.Optional[RoiFile.FileFormats] = None):
         """Delete the dataset associated with the Roi object specified by `name` and `num`.
@@ -329,6 +592,7 @@ class RoiFile:
             raise FileNotFoundError(f"The ROI file {name},{number} and format {fformat} was not found in {directory}.")
 
         if fformat in [RoiFile.FileFormats.HDF, RoiFile.FileFormats.HDF2, RoiFile.FileFormats.HDF3]:
+            RoiFile._fileCache.evict(path)  # The file can't be opened for writing while it is open for reading.
             with h5py.File(path, 'a') as hf:
                 if np.string_(str(number)) not in hf.keys():
                     raise ValueError(f"The file {path} does not contain ROI number {number}.")
@@ -357,8 +621,8 @@ class RoiFile:
         path = os.path.join(directory, f'ROI_{name}.h5')
         if not os.path.exists(path):
             raise OSError(f"File {path} does not exist.")
-        with h5py.File(path, 'r') as hf:
-            roi = Roi.fromMask(np.array(hf[str(number)]).astype(np.bool))
+        with cls._fileCache.open(path) as hf:
+            roi = cls._roiFromHDF(hf[str(number)], RoiFile.FileFormats.HDF)
             return cls(name, number, roi, filePath=path, fileFormat=RoiFile.FileFormats.HDF, acquisition=acquisition)
 
     @classmethod
@@ -379,13 +643,8 @@ class RoiFile:
         path = os.path.join(directory, f'ROI_{name}.h5')
         if not os.path.exists(path):
             raise OSError(f"File {path} does not exist.")
-        with h5py.File(path, 'r') as hf:
-            dset = hf[str(number)]
-            verts = dset['verts']
-            if verts.shape is None:
-                roi = Roi.fromMask(np.array(dset['mask']).astype(np.bool))  # Some old files could be saved without verts. allow loading them.
-            else:
-                roi = Roi(np.array(dset['mask']).astype(np.bool), verts=np.array(verts))
+        with cls._fileCache.open(path) as hf:
+            roi = cls._roiFromHDF(hf[str(number)], RoiFile.FileFormats.HDF2)
             return cls(name, number, roi, filePath=path, fileFormat=RoiFile.FileFormats.HDF2, acquisition=acquisition)
 
     @classmethod
@@ -405,14 +664,11 @@ class RoiFile:
         path = os.path.join(directory, f'ROI_{name}.h5')
         if not os.path.exists(path):
             raise OSError(f"File {path} does not exist.")
-        with h5py.File(path, 'r') as hf:
+        with cls._fileCache.open(path) as hf:
             group = hf[str(number)]
             assert 'fileFormat' in group.attrs, "No fileFormat attribute found for the ROI file. Try using one of the legacy ROI loading methods."
             assert group.attrs['fileFormat'] == RoiFile.FileFormats.HDF3.name, f'Only HDF3 format is supported by this loading method, not {group.attrs["fileFormat"]}'
-            wkbBytes = bytes(group['wkb'][()])
-            polygon = wkb.loads(wkbBytes)
-            mask = np.array(group['mask']).astype(np.bool)
-            roi = Roi(mask, verts=polygon)
+            roi = cls._roiFromHDF(group, RoiFile.FileFormats.HDF3)
             return cls(name, number, roi, filePath=path, fileFormat=RoiFile.FileFormats.HDF3, acquisition=acquisition)
 
     @classmethod
@@ -449,16 +705,13 @@ class RoiFile:
         Returns:
             A new instance of Roi loaded from file
         """
-        try:
-            return RoiFile.fromHDF(directory, name, number, acquisition=acquisition)
-        except:
-            try:
-                return RoiFile.fromHDF_legacy(directory, name, number, acquisition=acquisition)
-            except:
-                try:
-                    return RoiFile.fromHDF_legacy_legacy(directory, name, number, acquisition=acquisition)
-                except OSError:  # For backwards compatibility purposes
-                    return RoiFile.fromMat(directory, name, number, acquisition=acquisition)
+        path = os.path.join(directory, f'ROI_{name}.h5')
+        if not os.path.exists(path):  # For backwards compatibility purposes
+            return RoiFile.fromMat(directory, name, number, acquisition=acquisition)
+        with cls._fileCache.open(path) as hf:
+            obj = hf[str(number)]
+            fformat = cls._detectHDFFormat(obj)  # Detect the format once rather than trying each of the loaders in turn.
+            return cls(name, number, cls._roiFromHDF(obj, fformat), filePath=path, fileFormat=fformat, acquisition=acquisition)
 
     @classmethod
     def toHDF(cls, roi: Roi, name: str, number: int, directory: str, overwrite: t_.Optional[bool] = False, acquisition: metadata.Acquisition = None) -> RoiFile:
@@ -478,7 +731,9 @@ class RoiFile:
         """
         savePath = os.path.join(directory, f'ROI_{name}.h5')
         numStr = np.string_(str(number))
-        mask = roi.mask.astype(np.uint8)
+        mask = roi.mask.astype(np.uint8)  # The full size mask is saved so that the file can still be read by older versions.
+        rows, cols = roi.getBoundingBox()
+        cls._fileCache.evict(savePath)  # The file can't be opened for writing while it is open for reading.
         with h5py.File(savePath, 'a') as hf:
             if numStr in hf.keys():
                 if overwrite:
@@ -488,7 +743,8 @@ class RoiFile:
             g = hf.create_group(numStr)
             g.attrs['fileFormat'] = RoiFile.FileFormats.HDF3.name
             g.create_dataset(np.string_("wkb"), data=np.void(roi.polygon.wkb))  # np.void is required here so we can save a byte array with `null` in it.
-            g.create_dataset(np.string_("mask"), data=mask, compression=5)
+            dset = g.create_dataset(np.string_("mask"), data=mask, compression=5)
+            dset.attrs['boundingBox'] = (rows.start, rows.stop, cols.start, cols.stop)  # Allows the region of the mask that is needed to be read without reading the whole thing.
         return cls(name, number, roi, filePath=savePath, fileFormat=RoiFile.FileFormats.HDF2, acquisition=acquisition)
 
     def delete(self):
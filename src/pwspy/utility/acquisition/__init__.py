@@ -35,6 +35,9 @@ Classes
    SequenceAcquisition
    SequencerCoordinate
    SequencerCoordinateRange
+   AcquisitionScanner
+   ScanReport
+   ScanFailure
    SequencerStep
    IterableSequencerStep
    ZStackStep
@@ -49,6 +52,7 @@ Inheritance
 
 """
 
+import logging
 import typing as t_
 import warnings
 
@@ -57,18 +61,18 @@ from pwspy.utility.acquisition.steps import RuntimeSequenceSettings
 from .steps import SequencerStep, IterableSequencerStep, ZStackStep, TimeStep, PositionsStep, ContainerStep
 from ._treeItem import TreeItem
 from .sequencerCoordinate import SequenceAcquisition, SequencerCoordinate, SequencerCoordinateRange
+from ._scanner import AcquisitionScanner, ScanReport, ScanFailure
 import os
-import pwspy.dataTypes as pwsdt
-from glob import glob
 
 
-def loadDirectory(directory: os.PathLike) -> t_.Tuple[SequencerStep, t_.List[SequenceAcquisition]]:
+def loadDirectory(directory: os.PathLike, numThreads: int = 16) -> t_.Tuple[SequencerStep, t_.List[SequenceAcquisition]]:
     """
     If `directory` contains a dataset acquired with the acquisition sequencer then this function will return a python
     object representing the sequence settings and a list of references to the acquisitions that are part of the sequence.
 
     Args:
         directory: The file path to the dataset directory.
+        numThreads: The number of threads used to search the directory and load the acquisitions. See `AcquisitionScanner`.
 
     Returns:
         A tuple containing:
@@ -79,13 +83,11 @@ def loadDirectory(directory: os.PathLike) -> t_.Tuple[SequencerStep, t_.List[Seq
     if rtSeq.uuid is None:
         warnings.warn("Old acquisition sequence file must have been loaded. No UUID found. Acquisitions returned by this function may not actually belong to this sequence.")
 
-    files = glob(os.path.join(directory, '**', 'Cell[0-9]*'), recursive=True)
-    acqs = []
-    for f in files:
-        try:
-            acqs.append(SequenceAcquisition(pwsdt.Acquisition(f)))
-        except FileNotFoundError:
-            pass  # There may be "Cell" folders that don't contain a sequencer coordinate.
+    scanner = AcquisitionScanner(numThreads=numThreads, sequence=True)
+    acqs = sorted(scanner.scan(directory), key=lambda acq: acq.acquisition.filePath)  # The scanner yields acquisitions in the order they finish loading.
+    for failure in scanner.report.failures:
+        if not isinstance(failure.exception, FileNotFoundError):  # There may be "Cell" folders that don't contain a sequencer coordinate.
+            logging.getLogger(__name__).warning(f"Failed to load or search {failure.path}: {failure.exception}")
     acqs = [acq for acq in acqs if acq.sequencerCoordinate.uuid == rtSeq.uuid]  # Filter out acquisitions that don't have a matching UUID to the sequence file.
     # TODO verify that all expected acquisitions were found.
     return rtSeq.rootStep, acqs
@@ -0,0 +1,163 @@
+# Copyright 2018-2020 Nick Anthony, Backman Biophotonics Lab, Northwestern University
+#
+# This file is part of PWSpy.
+#
+# PWSpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PWSpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PWSpy.  If not, see <https://www.gnu.org/licenses/>.
+
+from __future__ import annotations
+import concurrent.futures
+import dataclasses
+import fnmatch
+import os
+import time
+import typing as t_
+
+import pwspy.dataTypes as pwsdt
+from .sequencerCoordinate import SequenceAcquisition
+
+
+@dataclasses.dataclass
+class ScanFailure:
+    """A directory that matched the search pattern but could not be loaded, or a directory that could not be searched.
+
+    Attributes:
+        path: The file path of the directory.
+        exception: The exception that was raised while loading or listing it.
+    """
+    path: str
+    exception: Exception
+
+
+@dataclasses.dataclass
+class ScanReport:
+    """Statistics for the most recent run of `AcquisitionScanner.scan`.
+
+    Attributes:
+        directoriesScanned: The number of directories that were listed while walking the tree.
+        acquisitionsFound: The number of acquisitions that were successfully loaded.
+        failures: The directories that matched the search pattern but could not be loaded, and the directories that could not be listed.
+        loadTimes: The time in seconds that it took to load each acquisition, keyed by file path.
+        elapsed: The total time in seconds since the scan was started.
+    """
+    directoriesScanned: int = 0
+    acquisitionsFound: int = 0
+    failures: t_.List[ScanFailure] = dataclasses.field(default_factory=list)
+    loadTimes: t_.Dict[str, float] = dataclasses.field(default_factory=dict)
+    elapsed: float = 0
+
+
+class AcquisitionScanner:
+    """Finds the acquisitions under a dataset directory. Listing the directories and loading the acquisitions are both
+    done by a pool of threads so that many filesystem requests are in flight at once. This makes a large difference on
+    network storage where the latency of each request is high. The acquisitions are yielded as soon as they are loaded.
+
+    Directories whose name matches `pattern` are treated as acquisitions and are not searched any further. Hidden
+    directories (names starting with '.') are skipped.
+
+    Args:
+        pattern: A glob style pattern that the names of acquisition directories must match.
+        numThreads: The number of threads to use.
+        sequence: If True then `SequenceAcquisition` objects will be created rather than just `Acquisition` objects.
+            Acquisitions without a sequencer coordinate file will be reported as failures.
+        index: An optional `MetadataIndex` that the acquisitions will be loaded through. Any index entries that are missing or out of date will be updated.
+        preload: If True then the `pws`, `dynamics`, and `fluorescence` metadata of each acquisition are loaded by the
+            scanning threads. Otherwise they are only loaded when first accessed.
+
+    Attributes:
+        report: Timing information and failures of the most recent scan. This is updated as the scan progresses.
+    """
+    def __init__(self, pattern: str = 'Cell[0-9]*', numThreads: int = 16, sequence: bool = False,
+                 index: t_.Optional[pwsdt.MetadataIndex] = None, preload: bool = True):
+        self._pattern = pattern
+        self._numThreads = numThreads
+        self._sequence = sequence
+        self._index = index
+        self._preload = preload
+        self.report = ScanReport()
+
+    def scan(self, directory: t_.Union[str, os.PathLike]) -> t_.Iterator[t_.Union[pwsdt.Acquisition, SequenceAcquisition]]:
+        """Search `directory` and all of its subdirectories for acquisitions.
+
+        Args:
+            directory: The root directory of the dataset.
+
+        Yields:
+            `Acquisition` objects (or `SequenceAcquisition` objects if `sequence` is True) in the order that they finish loading.
+        """
+        self.report = report = ScanReport()
+        startTime = time.perf_counter()
+        pool = concurrent.futures.ThreadPoolExecutor(self._numThreads)
+        pending: t_.Dict[concurrent.futures.Future, t_.Tuple[str, str]] = {}  # Maps each future to the type of task and the path it was run on.
+        try:
+            pending[pool.submit(self._listDirectory, os.fspath(directory))] = ('list', os.fspath(directory))
+            while len(pending) > 0:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    task, path = pending.pop(future)
+                    if task == 'list':
+                        report.directoriesScanned += 1
+                        subDirectories, acquisitionPaths, failures = future.result()
+                        report.failures.extend(failures)
+                        for p in subDirectories:
+                            pending[pool.submit(self._listDirectory, p)] = ('list', p)
+                        for p in acquisitionPaths:
+                            pending[pool.submit(self._load, p)] = ('load', p)
+                    else:
+                        try:
+                            acq, loadTime = future.result()
+                        except Exception as e:
+                            report.failures.append(ScanFailure(path, e))
+                            continue
+                        report.acquisitionsFound += 1
+                        report.loadTimes[path] = loadTime
+                        report.elapsed = time.perf_counter() - startTime
+                        yield acq
+        finally:
+            for future in pending:  # If the generator is closed early then cancel the work that hasn't started yet.
+                future.cancel()
+            pool.shutdown(wait=True)
+            report.elapsed = time.perf_counter() - startTime
+
+    def _listDirectory(self, path: str) -> t_.Tuple[t_.List[str], t_.List[str], t_.List[ScanFailure]]:
+        """Return the subdirectories that should be searched, the subdirectories that look like acquisitions, and any
+        paths that couldn't be accessed. e.g. a directory that was deleted during the scan or a network error."""
+        subDirectories, acquisitionPaths, failures = [], [], []
+        try:
+            entries = list(os.scandir(path))
+        except OSError as e:
+            failures.append(ScanFailure(path, e))
+            return subDirectories, acquisitionPaths, failures
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if not entry.is_dir():
+                    continue
+            except OSError as e:
+                failures.append(ScanFailure(entry.path, e))
+                continue
+            if fnmatch.fnmatch(entry.name, self._pattern):
+                acquisitionPaths.append(entry.path)
+            else:
+                subDirectories.append(entry.path)
+        return subDirectories, acquisitionPaths, failures
+
+    def _load(self, path: str) -> t_.Tuple[t_.Union[pwsdt.Acquisition, SequenceAcquisition], float]:
+        startTime = time.perf_counter()
+        acq = self._index.getAcquisition(path) if self._index is not None else pwsdt.Acquisition(path)
+        if self._preload:
+            acq.pws, acq.dynamics, acq.fluorescence  # Accessing these properties caches the metadata.
+        if self._sequence:
+            acq = SequenceAcquisition(acq)
+        return acq, time.perf_counter() - startTime
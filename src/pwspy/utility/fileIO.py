@@ -65,11 +65,6 @@ def _loadIms(qout: queue.Queue, qin: queue.Queue, lock: th.Lock):
             im = _load(row['cube'], lock=lock)
             row['cube'] = im
             qout.put((index, row), block=True)  # Once the queue is full we will block here so that we don't overfill the RAM.
-            perc = psutil.virtual_memory().percent
-            logger.info(f"Memory Usage: {perc}%")
-            if perc >= 95:
-                logger.info("Memory limit exceeded. Exiting to avoid lock-up.")
-                return
         except Exception as e:
             qout.put(e)  # Put the error in the queue so it can propagate to the main thread.
             raise e
@@ -107,7 +102,8 @@ def _loadThenProcess(procFunc, procFuncArgs, lock: mp.Lock, row):
 def loadAndProcess(fileFrame: Union[pd.DataFrame, List, Tuple], processorFunc: Optional = None, parallel: Optional = None,
                    procArgs: Optional = None, initializer=None,
                    initArgs=None) -> Union[pd.DataFrame, List, Tuple]:
-    """DEPRECATED! This over-complicated function should be replaced with usage of processParallel.
+    """DEPRECATED! This over-complicated function should be replaced with usage of processParallel. For running an
+    analysis on a large number of acquisitions with bounded memory use `pwspy.analysis.ParallelRunner.iterate`.
     A convenient function to load a series of Data Cubes from a list or dictionary of file paths.
 
     Parameters
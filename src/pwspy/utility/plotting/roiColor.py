@@ -40,9 +40,9 @@ def roiColor(data: np.ndarray, rois: List[Roi], vmin, vmax, scale_bg, hue=0, exp
     Returns:
         np.ndarray: MxNx3 RGB array of the image"""
 
-    mask = np.zeros(rois[0].mask.shape, dtype=np.bool)
+    mask = np.zeros(rois[0].shape, dtype=np.bool)
     for roi in rois:
-        mask = np.logical_or(mask, roi.mask)
+        mask[roi.getBoundingBox()] |= roi.croppedMask
 
     # scale and process rms cube (this is probably not the best way to do it)
     data = data - vmin
@@ -42,6 +42,7 @@ Classes
 
    CubeCombo
 """
+import concurrent.futures
 import logging
 import typing as t_
 
@@ -50,7 +51,6 @@ from pwspy.utility.reflection import reflectanceHelper, Material
 import itertools
 import matplotlib.pyplot as plt
 import numpy as np
-from functools import reduce
 import pandas as pd
 from dataclasses import dataclass
 import matplotlib as mpl
@@ -187,14 +187,22 @@ def _calculateSpectraFromCombos(cubeCombos: t_.Dict[MCombo, t_.List[CubeCombo]],
         as well as the average calculation accross all material combinations. The seconds item is a dictionary containing
         information about every single cube combo.
     """
+    # Each cube appears in many combos. Only calculate its mean spectrum once.
+    meanSpectra: t_.Dict[int, np.ndarray] = {}
+
+    def getMeanSpectra(cube: pwsdt.PwsCube) -> np.ndarray:
+        if id(cube) not in meanSpectra:
+            meanSpectra[id(cube)] = cube.getMeanSpectra(mask)[0]
+        return meanSpectra[id(cube)]
+
     # Generate summaries for every possible combination of measurements.
     allComboSummary: t_.Dict[MCombo, t_.List[t_.Tuple[_ComboSummary, CubeCombo]]] = {}  # Organize combos by the material combo they go with.
     for matCombo in cubeCombos.keys():
         allComboSummary[matCombo] = []
         for combo in cubeCombos[matCombo]:
             mat1, mat2 = combo.keys()
-            spectra1 = combo[mat1].getMeanSpectra(mask)[0]
-            spectra2 = combo[mat2].getMeanSpectra(mask)[0]
+            spectra1 = getMeanSpectra(combo[mat1])
+            spectra2 = getMeanSpectra(combo[mat2])
             weight = (spectra1 - spectra2) ** 2 / (spectra1 ** 2 + spectra2 ** 2) # See `_generateOneRExtraCube` for an explanation of this weighting.
             rExtra = ((theoryR[mat1] * spectra2) - (theoryR[mat2] * spectra1)) / (spectra1 - spectra2)
             I0 = spectra2 / (theoryR[mat2] + rExtra)  # Reconstructed intensity of illumination in same units as `spectra`. This could just as easily be done with material1. They are identical by definition.
@@ -358,52 +366,92 @@ def _generateOneRExtraCube(combo: CubeCombo, theoryR: t_.Dict[Material, pd.Serie
     arr = nominator / denominator
 
     #Even when a weight is calculated as zero if we have weird values (np.nan, np.inf) in arr we will get a messed up end result.
-    arr[np.isinf(arr)] = 0
-    arr[np.isnan(arr)] = 0
-    arr[arr < 0] = 0
-    arr[arr > 1] = 1
+    np.nan_to_num(arr, copy=False, nan=0, posinf=0, neginf=0)
+    np.clip(arr, 0, 1, out=arr)
     #calculate a confidence weighting for every point in the cube.
     # According to propagation of error if we assume that TheoryR has no error
     # and the data (camera counts) has a constant error of C then the error is C * sqrt((T1-T2)*data1^2 + (T2-T1)*data2^2) / (data1 - data2)^2
     # Since we are just looking for a relative measure of confidence we can ignore C. We use the `Variance weighted average'
     # (1/stddev^2)
     #Doing this calculation with noise in Theory instead of data gives us a variance of C^2 * (data1^2 + data2^2) / (data1 - data2)^2. this seems like a better equation to use. TODO Really? Why?
-    weight = (data1-data2)**2 / (data1**2 + data2**2)  # The weight is the inverse of the variance. Higher weight = more reliable data.
+    weight = denominator**2 / (data1**2 + data2**2)  # The weight is the inverse of the variance. Higher weight = more reliable data.
     return arr, weight
 
 
-def generateRExtraCubes(allCombos: t_.Dict[MCombo, t_.List[CubeCombo]], theoryR: t_.Dict[Material, pd.Series], numericalAperture: float) -> \
-        t_.Tuple[pwsdt.ExtraReflectanceCube, t_.Dict[t_.Union[str, MCombo], np.ndarray]]:
-    """Generate a series of extra reflectance cubes based on the input data.
+class _WeightedAccumulator:
+    """Keeps running sums for a weighted average so that the individual arrays being averaged don't need to be kept in memory."""
+    def __init__(self):
+        self.weightedSum: t_.Optional[np.ndarray] = None
+        self.weightSum: t_.Optional[np.ndarray] = None
+        self.count = 0
+
+    def add(self, arr: np.ndarray, weight: np.ndarray):
+        if self.weightedSum is None:
+            self.weightedSum = arr * weight
+            self.weightSum = np.array(weight)
+        else:
+            self.weightedSum += arr * weight
+            self.weightSum += weight
+        self.count += 1
+
+    def merge(self, other: '_WeightedAccumulator'):
+        """Add the sums from another accumulator to this one."""
+        if other.count == 0:
+            return
+        if self.weightedSum is None:
+            self.weightedSum, self.weightSum = other.weightedSum, other.weightSum
+        else:
+            self.weightedSum += other.weightedSum
+            self.weightSum += other.weightSum
+        self.count += other.count
+
+    def mean(self) -> np.ndarray:
+        """The weighted mean of all arrays that have been added."""
+        return self.weightedSum / self.weightSum
+
+    def meanWeight(self) -> np.ndarray:
+        """The mean of all weights that have been added."""
+        return self.weightSum / self.count
+
+
+def _accumulateRExtra(combos: t_.Sequence[CubeCombo], theoryR: t_.Dict[Material, pd.Series]) -> _WeightedAccumulator:
+    """Calculate the extra reflectance of each combo in turn, adding it to a running weighted average."""
+    acc = _WeightedAccumulator()
+    for combo in combos:
+        acc.add(*_generateOneRExtraCube(combo, theoryR))
+    return acc
+
+
+def generateRExtraCubes(allCombos: t_.Dict[MCombo, t_.List[CubeCombo]], theoryR: t_.Dict[Material, pd.Series], numericalAperture: float,
+                        numWorkers: int = 1) -> t_.Tuple[pwsdt.ExtraReflectanceCube, t_.Dict[t_.Union[str, MCombo], np.ndarray]]:
+    """Generate a series of extra reflectance cubes based on the input data. The extra reflectance of each combo is added
+    to a running weighted average and then discarded so memory usage doesn't grow with the number of combos.
 
     Args:
         allCombos: a dict of lists CubeCombos, each keyed by a 2-tuple of Materials.
         theoryR: the theoretically predicted reflectance for each material.
         numericalAperture: The numerical aperture that the PwsCubes were imaged at. The theoryR reflectances should have
             also been calculated at this NA
+        numWorkers: The number of threads to split the combos of each material combo between. Each thread keeps its own
+            running sums, so memory usage grows with the number of threads.
 
     Returns:
         An `ExtraReflectanceCube` object containing data from the weighted average of all measurements.
          A dictionary where the keys are material combos and the values are tuples of the weightedMean and the weight arrays.
     """
     rExtra: t_.Dict[MCombo, np.ndarray] = {}
-    rExtraWeight: t_.Dict[MCombo, np.ndarray] = {}
-    # Calculate weighted sum for all measurements within a certain material combo
-    for matCombo, combosList in allCombos.items():
-        logging.getLogger(__name__).info(f"Calculating rExtra for: {matCombo}")
-        erCubes, weights = zip(*[_generateOneRExtraCube(combo, theoryR) for combo in combosList])
-        weightSum = reduce(lambda x, y: x + y, weights)  # Sum of all weights
-        weightedMean = reduce(lambda x, y: x + y, [cube*weight for cube, weight in zip(erCubes, weights)]) / weightSum  # Weighted mean of ER cubes
-        meanWeight = weightSum / len(weights)
-        rExtra[matCombo] = weightedMean
-        rExtraWeight[matCombo] = meanWeight
-
-    # Calculate weight mean accross all material combos
-    erCubes = list(rExtra.values())
-    weights = list(rExtraWeight.values())
-    weightSum = reduce(lambda x, y: x + y, weights) # Sum of all weights
-    weightedMean = reduce(lambda x, y: x + y, [cube * weight for cube, weight in zip(erCubes, weights)]) / weightSum  # Weighted mean of ER cubes
-    # meanWeight = weightSum / len(weights)
+    total = _WeightedAccumulator()
+    with concurrent.futures.ThreadPoolExecutor(numWorkers) as pool:  # Numpy releases the GIL for the array math so threads can run in parallel without copying the cubes to other processes.
+        # Calculate weighted sum for all measurements within a certain material combo
+        for matCombo, combosList in allCombos.items():
+            logging.getLogger(__name__).info(f"Calculating rExtra for: {matCombo}")
+            acc = _WeightedAccumulator()
+            for partial in pool.map(_accumulateRExtra, [combosList[i::numWorkers] for i in range(numWorkers)], [theoryR] * numWorkers):
+                acc.merge(partial)
+            rExtra[matCombo] = acc.mean()  # Weighted mean of ER cubes
+            # Calculate weight mean accross all material combos
+            total.add(rExtra[matCombo], acc.meanWeight())
+    weightedMean = total.mean()
     sampleCube: pwsdt.PwsCube = list(allCombos.values())[0][0].data1
     md = pwsdt.ERMetaData(sampleCube.metadata.dict, numericalAperture)
     erCube = pwsdt.ExtraReflectanceCube(weightedMean, sampleCube.wavelengths, md)
@@ -347,6 +347,70 @@ class Stack(StackBase):
             out[polarization] = R.real
         return out
 
+    def calculateReflectanceBatch(self, NAs: np.ndarray, thicknesses: np.ndarray, refractiveIndices: Optional[np.ndarray] = None,
+                                  dtype: typing.Type[np.floating] = np.float64) -> typing.Dict[Polarization, np.ndarray]:
+        """Calculate the reflectance of many variations of this `Stack` in a single vectorized call. This gives the same
+        results as building a new `Stack` for each set of thicknesses and calling `calculateReflectance`, but it
+        is much faster. The 2x2 transfer matrices are never built. Instead, the four elements of the total matrix are
+        updated in place for each layer.
+
+        Args:
+            NAs: The numerical apertures to calculate reflectance at.
+            thicknesses: An array of shape (..., numberOfLayers) giving the thickness of each layer. The leading dimensions
+                are batch dimensions. The thicknesses of the layers in the stack are ignored.
+            refractiveIndices: An optional array of shape (..., numberOfLayers, numberOfWavelengths) giving the (real)
+                refractive index of each layer. The leading dimensions are batch dimensions and must broadcast with the
+                batch dimensions of `thicknesses`. If `None` then the refractive indices of the layers in the stack are used.
+            dtype: The floating point type to do the calculation with. `np.float32` uses half the memory of the default
+                and is faster, but it is less accurate. Complex values use the matching complex type.
+
+        Returns:
+            A dictionary containing a reflectance array for each of the two polarizations. The polarization is the key to the dictionary.
+            Each reflectance array has shape (..., M, N) where `...` are the batch dimensions, M is the number of wavelengths
+            and N is the number of NAs.
+        """
+        dtype = np.dtype(dtype)
+        wavelengths = np.asarray(self.wavelengths, dtype=dtype)[:, None]
+        NAs = np.asarray(NAs, dtype=dtype)
+        thicknesses = np.asarray(thicknesses, dtype=dtype)
+        if thicknesses.ndim == 0 or thicknesses.shape[-1] != len(self.layers):
+            raise ValueError(f"The last dimension of `thicknesses` must be the number of layers ({len(self.layers)}). Got shape {thicknesses.shape}.")
+        if refractiveIndices is None:
+            refractiveIndices = np.stack([np.asarray(layer.getRefractiveIndex(self.wavelengths), dtype=dtype) for layer in self.layers])
+        refractiveIndices = np.asarray(refractiveIndices, dtype=dtype)
+        if refractiveIndices.shape[-2:] != (len(self.layers), wavelengths.shape[0]):
+            raise ValueError(f"The last two dimensions of `refractiveIndices` must be (numberOfLayers, numberOfWavelengths) = {(len(self.layers), wavelengths.shape[0])}. Got shape {refractiveIndices.shape}.")
+
+        n = refractiveIndices[..., :, :, None]  # (..., layers, wavelengths, NAs)
+        cosTheta = np.sqrt(1 - (NAs / n) ** 2)  # Equivalent to np.cos(np.arcsin(NAs / n))
+        phi = (2 * np.pi / wavelengths) * n * cosTheta * thicknesses[..., :, None, None]
+        # Phase factors for the propagation matrices. These don't depend on polarization.
+        forward = np.exp(-1j * phi)
+        backward = np.exp(1j * phi)
+
+        out = {}
+        for polarization in Polarization:
+            # The elements of the total transfer matrix. Start with the propagation matrix of the first layer which is diagonal.
+            m00, m01, m10, m11 = forward[..., 0, :, :], 0, 0, backward[..., 0, :, :]
+            for i in range(1, len(self.layers)):
+                if polarization is Polarization.TE:
+                    N1 = n[..., i - 1, :, :] * cosTheta[..., i - 1, :, :]
+                    N2 = n[..., i, :, :] * cosTheta[..., i, :, :]
+                    a21 = 1
+                else:  # Polarization.TM
+                    N1 = n[..., i - 1, :, :] / cosTheta[..., i - 1, :, :]
+                    N2 = n[..., i, :, :] / cosTheta[..., i, :, :]
+                    a21 = cosTheta[..., i, :, :] / cosTheta[..., i - 1, :, :]
+                scale = 1 / (2 * a21 * N2)
+                a = (N2 + N1) * scale
+                b = (N2 - N1) * scale
+                # Multiply by the interface matrix [[a, b], [b, a]] followed by the diagonal propagation matrix of this layer.
+                m00, m01, m10, m11 = ((a * m00 + b * m10) * forward[..., i, :, :], (a * m01 + b * m11) * forward[..., i, :, :],
+                                      (b * m00 + a * m10) * backward[..., i, :, :], (b * m01 + a * m11) * backward[..., i, :, :])
+            r = m10 / m11  # The element of the scattering matrix for reflection is -m10/m11
+            out[polarization] = r.real ** 2 + r.imag ** 2
+        return out
+
     def circularIntegration(self, NAs: np.ndarray) -> pd.Series:
         """Given an array of NumericalApertures (usually from 0 to NAMax.) This function integrates the reflectance over
         a disc of Numerical Apertures (Just like in a microscope the Aperture plane is a disc shape, with higher NA
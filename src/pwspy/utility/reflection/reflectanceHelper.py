@@ -31,6 +31,7 @@ Functions
 
 __all__ = ['getReflectance', 'getRefractiveIndex']
 
+import functools
 import typing
 from numbers import Number
 
@@ -62,14 +63,16 @@ materialCoeffs = {
 }
 
 
-def _init():
-    """This function initializes data from files when the module is imported."""
+@functools.lru_cache(maxsize=None)
+def _getRefractiveIndexTable() -> pd.DataFrame:
+    """Load the refractive index data for all materials. This is done the first time that it is needed rather than
+    when the module is imported. The result is cached so the files are only read once."""
     fileLocation = os.path.join(os.path.split(__file__)[0], 'refractiveIndexFiles')
     ser = {}  # a dictionary of the series by name
     for name, file in materialFiles.items():
         # create a series for each csv file
         arr = np.genfromtxt(os.path.join(fileLocation, file), skip_header=1, delimiter=',')
-        _ = pd.DataFrame({'n': arr[:, 1], 'k': arr[:, 2]}, index=arr[:, 0].astype(np.float) * 1e3)
+        _ = pd.DataFrame({'n': arr[:, 1], 'k': arr[:, 2]}, index=arr[:, 0].astype(float) * 1e3)
         ser[name] = _
 
     # Find the first and last indices that won't require us to do any extrapolation
@@ -98,8 +101,12 @@ def _init():
 
     return df
 
-_n = _init()
-del _init
+
+def __getattr__(name: str):
+    # `_n` used to be loaded at import time. It is still available as a module attribute but is now loaded on first access.
+    if name == '_n':
+        return _getRefractiveIndexTable()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def getRefractiveIndex(mat: Material, wavelengths: typing.Optional[typing.Iterable[float]] =None) -> pd.Series:
@@ -108,21 +115,22 @@ def getRefractiveIndex(mat: Material, wavelengths: typing.Optional[typing.Iterab
     Args:
         mat: The material the retrieve the refractive index of.
         wavelengths: The wavelengths that the refractive index should be calculated at. If left as `None` then the wavelengths
-            used will be determined by the original file that the data was pulled from.
+            used will be determined by the original file that the data was pulled from. Wavelengths outside of the range
+            of the data will have a value of `nan`.
 
     Returns:
         The refractive index. The index of the pandas series is the wavelengths.
     """
-    refractiveIndex = np.array([np.complex(i[0], i[1]) for idx, i in _n[mat].iterrows()])
-    refractiveIndex = pd.Series(refractiveIndex, _n.index)
-    if wavelengths is not None: #Need to do interpolation
-        wavelengths = pd.Index(wavelengths)
-        combinedIdx = refractiveIndex.index.append(
-            wavelengths)  # An index that contains all the original index points and all of the new. That way we can interpolate without first throwing away old data.
-        from scipy.interpolate import griddata
-        out = griddata(refractiveIndex.index, refractiveIndex.values, wavelengths)  #This works with complex numbers
-        refractiveIndex = pd.Series(out, index=wavelengths)
-    return refractiveIndex
+    table = _getRefractiveIndexTable()
+    refractiveIndex = table[(mat, 'n')].values + 1j * table[(mat, 'k')].values
+    if wavelengths is None:
+        return pd.Series(refractiveIndex, index=table.index)
+    wavelengths = pd.Index(wavelengths)
+    x = np.asarray(wavelengths, dtype=float)
+    # `np.interp` doesn't handle complex numbers so the real and imaginary parts are interpolated separately.
+    out = (np.interp(x, table.index.values, refractiveIndex.real, left=np.nan, right=np.nan)
+           + 1j * np.interp(x, table.index.values, refractiveIndex.imag, left=np.nan, right=np.nan))
+    return pd.Series(out, index=wavelengths)
 
 
 def getReflectance(mat1: Union[Number, pd.Series, Material], mat2: Union[Number, pd.Series, Material], wavelengths: Union[np.ndarray, List, Tuple] = None, NA: float = 0) -> pd.Series:
@@ -142,7 +150,30 @@ def getReflectance(mat1: Union[Number, pd.Series, Material], mat2: Union[Number,
     Returns:
         The percentage reflectance. The index of the pandas Series is the wavelengths.
     """
-    index = _n.index if wavelengths is None else wavelengths
+    key = _reflectanceCacheKey(mat1, mat2, wavelengths, NA)
+    if key is None:  # Some of the arguments aren't hashable. Skip the cache.
+        return _calculateReflectance(mat1, mat2, wavelengths, NA)
+    return _cachedReflectance(*key).copy()  # Return a copy so that the caller can't modify the cached result.
+
+
+def _reflectanceCacheKey(mat1, mat2, wavelengths, NA) -> typing.Optional[tuple]:
+    """Return a hashable version of the arguments to `getReflectance`, or `None` if they can't be hashed."""
+    for mat in (mat1, mat2):
+        if not isinstance(mat, (Number, Material)):
+            return None
+    if wavelengths is not None:
+        # `tolist` converts numpy scalars to python scalars so that `np.array` will give back the same dtype.
+        wavelengths = tuple(np.atleast_1d(np.asarray(wavelengths)).tolist())
+    return mat1, mat2, wavelengths, NA
+
+
+@functools.lru_cache(maxsize=64)
+def _cachedReflectance(mat1, mat2, wavelengths: typing.Optional[tuple], NA: float) -> pd.Series:
+    return _calculateReflectance(mat1, mat2, None if wavelengths is None else np.array(wavelengths), NA)
+
+
+def _calculateReflectance(mat1, mat2, wavelengths, NA: float) -> pd.Series:
+    index = _getRefractiveIndexTable().index if wavelengths is None else wavelengths
     if isinstance(index, Number):
         index = np.array([index])
     elif not isinstance(index, np.ndarray):
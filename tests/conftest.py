@@ -1,5 +1,7 @@
 import pathlib as pl
+import typing as t_
 import pwspy.dataTypes as pwsdt
+from pwspy import analysis
 import pytest
 
 
@@ -54,3 +56,36 @@ def dynamicsData() -> Dataset:
     )
     yield ds
     ds.clean()
+
+
+class PWSAnalysisData:
+    """
+    The PWS analysis of an acquisition from a test dataset, run with the "Recommended" settings and no extra reflection correction.
+    """
+    def __init__(self, dataset: Dataset):
+        self.referenceAcquisition = pwsdt.Acquisition(dataset.referenceCellPath)
+        self.acquisition = pwsdt.Acquisition(dataset.datasetPath / "Cell1")
+        self.analysis = self.createAnalysis()
+        self.results, self.warnings = self.analysis.run(self.acquisition.pws.toDataClass())
+
+    def createAnalysis(self, settings: t_.Optional[analysis.pws.PWSAnalysisSettings] = None, **kwargs) -> analysis.pws.PWSAnalysis:
+        """Create a new analysis using a freshly loaded copy of the reference. If `settings` is None the "Recommended"
+        settings are used. Additional keyword arguments are passed to the `PWSAnalysis` constructor."""
+        if settings is None:
+            settings = analysis.pws.PWSAnalysisSettings.loadDefaultSettings("Recommended")
+        kwargs.setdefault('extraReflectance', None)
+        return analysis.pws.PWSAnalysis(settings=settings, ref=self.referenceAcquisition.pws.toDataClass(), **kwargs)
+
+
+@pytest.fixture(scope='session')
+def pwsAnalysis(dynamicsData) -> PWSAnalysisData:
+    """The PWS analysis of the first cell of the dynamics dataset."""
+    return PWSAnalysisData(dynamicsData)
+
+
+@pytest.fixture
+def restoreFFTBackend():
+    """Restores the FFT backend that was selected before the test, even if the test fails."""
+    backend = pwsdt.getFFTBackend()
+    yield
+    pwsdt.setFFTBackend(backend)
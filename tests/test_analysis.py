@@ -38,6 +38,145 @@ class TestAnalysis:
         assert isinstance(result.meanReflectance, np.ndarray)
         assert isinstance(result.reflectance, pwsdt.KCube)
 
+    @pytest.mark.parametrize('compression', [4, 'lzf', pwsdt.HDFCompression('gzip', level=1, shuffle=True)])
+    def test_analysis_compression(self, pwsAnalysis, compression):
+        """Test that analysis results saved with a compression filter can be loaded."""
+        acq, results = pwsAnalysis.acquisition, pwsAnalysis.results
+        acq.pws.saveAnalysis(results, _analysisName, overwrite=True, compression=compression)
+        result = acq.pws.loadAnalysis(_analysisName)
+        assert np.array_equal(result.rms, results.rms, equal_nan=True)
+        assert result.file['reflectance'].compression == pwsdt.HDFCompression.fromValue(compression).filter
+        assert np.allclose(result.reflectance.data, results.reflectance.data, atol=1e-4 * np.abs(results.reflectance.data).max())
+
+    def test_analysis_directory_store(self, pwsAnalysis):
+        """Test that analysis results saved as a directory store match results saved as an HDF file and are listed by `getAnalyses`."""
+        acq, results = pwsAnalysis.acquisition, pwsAnalysis.results
+        storeName = _analysisName + '_store'
+        acq.pws.saveAnalysis(results, _analysisName, overwrite=True)
+        acq.pws.saveAnalysis(results, storeName, overwrite=True, compression='gzip',
+                             fileFormat=analysis.AbstractHDFAnalysisResults.FileFormats.DirectoryStore)
+        try:
+            assert {_analysisName, storeName} <= set(acq.pws.getAnalyses())
+            hdf, store = acq.pws.loadAnalysis(_analysisName), acq.pws.loadAnalysis(storeName)
+            assert isinstance(store.file, analysis.DirectoryStore)
+            for field in ['meanReflectance', 'rms', 'ld']:
+                assert np.array_equal(getattr(hdf, field), getattr(store, field), equal_nan=True)
+            assert np.array_equal(hdf.reflectance.data, store.reflectance.data, equal_nan=True)
+            region = (slice(10, 100), slice(50, 150))
+            assert np.array_equal(hdf.getLazyField('reflectance')[region], store.getLazyField('reflectance')[region], equal_nan=True)
+            with pytest.raises(ValueError):  # Unsupported compression must be rejected before the existing results are deleted.
+                acq.pws.saveAnalysis(results, storeName, overwrite=True, compression='lzf',
+                                     fileFormat=analysis.AbstractHDFAnalysisResults.FileFormats.DirectoryStore)
+            assert np.array_equal(acq.pws.loadAnalysis(storeName).rms, store.rms, equal_nan=True)
+        finally:
+            acq.pws.removeAnalysis(storeName)
+        assert storeName not in acq.pws.getAnalyses()
+
+    @pytest.mark.parametrize('extraReflection', [None, erMeta])
+    def test_pws_analysis_tiled(self, pwsAnalysis, extraReflection):
+        """Test that the tiled (fused) analysis mode gives the same results as the standard mode."""
+        settings = analysis.pws.PWSAnalysisSettings.loadDefaultSettings("Recommended")
+        settings.skipAdvanced = False
+
+        results = []
+        for tileRows in [None, 37]:
+            anls = pwsAnalysis.createAnalysis(settings, extraReflectance=extraReflection, tileRows=tileRows)
+            result, warnings = anls.run(pwsAnalysis.acquisition.pws.toDataClass())
+            results.append(result)
+        full, tiled = results
+        for field in ['meanReflectance', 'rms', 'polynomialRms', 'autoCorrelationSlope', 'rSquared', 'ld']:
+            assert np.allclose(getattr(full, field), getattr(tiled, field), rtol=1e-4, atol=1e-6, equal_nan=True)
+        assert np.allclose(full.reflectance.data, tiled.reflectance.data, rtol=1e-4, atol=1e-6)
+        assert full.reflectance.wavenumbers == tiled.reflectance.wavenumbers
+
+    def test_pws_analysis_masked(self, pwsAnalysis):
+        """Test that analyzing only the pixels within an ROI gives the same results for those pixels as analyzing the whole image."""
+        settings = analysis.pws.PWSAnalysisSettings.loadDefaultSettings("Recommended")
+        settings.skipAdvanced = False
+        settings.autoCorrMinSub = False  # With minimum subtraction the results depend on which pixels were analyzed.
+
+        acq = pwsAnalysis.acquisition
+        anls = pwsAnalysis.createAnalysis(settings)
+        full, warnings = anls.run(acq.pws.toDataClass())
+        mask = np.zeros(full.rms.shape, dtype=bool)
+        mask[100:200, 150:300] = True
+        masked, warnings = anls.run(acq.pws.toDataClass(), mask=mask)
+        assert np.array_equal(masked.analyzedMask, mask)
+        for field in ['meanReflectance', 'rms', 'polynomialRms', 'autoCorrelationSlope', 'rSquared', 'ld']:
+            assert np.isnan(getattr(masked, field)[~mask]).all()
+            assert np.allclose(getattr(full, field)[mask], getattr(masked, field)[mask], rtol=1e-4, atol=1e-6, equal_nan=True)
+
+    @pytest.mark.parametrize('polynomialOrder', [0, 2])
+    def test_remove_polynomial(self, polynomialOrder):
+        """Test that removing the polynomial fit matches the residual and `polynomialRms` of a fit with `np.polyfit`."""
+        wavenumbers = np.linspace(11.2, 12.6, 91)
+        data = np.random.default_rng(0).random((6, 7, len(wavenumbers)))
+        residual, rmsPoly = analysis.pws.PWSAnalysis._removePolynomial(data, wavenumbers, polynomialOrder)
+        coefficients = np.polyfit(wavenumbers, data.reshape((-1, len(wavenumbers))).T, polynomialOrder)
+        fit = np.stack([np.polyval(c, wavenumbers) for c in coefficients.T]).reshape(data.shape)
+        assert np.allclose(residual, data - fit)
+        assert np.allclose(rmsPoly, fit.std(axis=2))
+
+    def test_fft_backend(self, dynamicsData, restoreFFTBackend):
+        """Test that selecting a different FFT backend gives the same OPD and autocorrelation results."""
+        acq = pwsdt.Acquisition(dynamicsData.datasetPath / "Cell1")
+        cube = pwsdt.KCube.fromPwsCube(acq.pws.toDataClass())
+        results = []
+        for backend in [pwsdt.NumpyFFTBackend(), pwsdt.ScipyFFTBackend(workers=2, singlePrecision=True)]:
+            pwsdt.setFFTBackend(backend)
+            opd, opdIndex = cube.getOpd(useHannWindow=True)
+            slope, rSquared = cube.getAutoCorrelation(True, 7)
+            results.append((opd, slope, rSquared))
+        for a, b in zip(*results):
+            assert np.allclose(a, b, rtol=1e-4, atol=1e-6 * np.nanmax(np.abs(a)), equal_nan=True)
+
+    def test_parallel_runner(self, pwsAnalysis):
+        """Test that the ParallelRunner worker pool can be reused for several batches using the `spawn` start method."""
+        acq, expected = pwsAnalysis.acquisition, pwsAnalysis.results
+        with analysis.ParallelRunner(pwsAnalysis.analysis, numProcesses=2, startMethod='spawn') as runner:
+            for batch in range(2):
+                for warnings, results, md in runner.run([acq.pws, acq.pws]):
+                    assert np.allclose(expected.rms, results.rms, equal_nan=True)
+            # A budget smaller than a single acquisition means that only one is in flight at a time.
+            streamed = list(runner.iterate([acq.pws] * 3, saveName=_analysisName, memoryBudget=1))
+            assert len(streamed) == 3
+            for warnings, results, md in streamed:
+                assert np.allclose(expected.rms, results.rms, equal_nan=True)
+
+    def test_parallel_runner_fft_backend(self, pwsAnalysis, restoreFFTBackend):
+        """Test that worker processes started with `spawn` use the FFT backend that was selected in the parent process."""
+        pwsdt.setFFTBackend(pwsdt.ScipyFFTBackend(workers=2, singlePrecision=True))
+        with analysis.ParallelRunner(pwsAnalysis.analysis, numProcesses=1, startMethod='spawn') as runner:
+            backend = runner._getPool().apply(pwsdt.getFFTBackend)
+        assert isinstance(backend, pwsdt.ScipyFFTBackend)
+        assert backend.workers == 2 and backend.singlePrecision
+
+    def test_parallel_runner_stop_early(self, pwsAnalysis):
+        """Test that the ParallelRunner can still be used and closed after the consumer stops iterating early."""
+        cube = pwsAnalysis.acquisition.pws.toDataClass()
+        with analysis.ParallelRunner(pwsAnalysis.analysis, numProcesses=2) as runner:
+            for warnings, results, md in runner.iterate([cube] * 4):
+                break
+            it = runner.iterate([cube] * 4)
+            next(it)
+            it.close()
+            assert len(list(runner.iterate([cube] * 2))) == 2  # The same cube objects can be passed in again.
+
+    def test_parallel_runner_failure(self, pwsAnalysis):
+        """Test that an image that fails to be analyzed is reported without stopping the rest of the batch."""
+        cube = pwsAnalysis.acquisition.pws.toDataClass()
+        badCube = pwsdt.PwsCube(cube.data[:10, :10], cube.metadata)  # Doesn't match the shape of the reference.
+        failures = []
+        with analysis.ParallelRunner(pwsAnalysis.analysis, numProcesses=2) as runner:
+            # A budget smaller than a single acquisition would never be freed again if the failed image kept its reservation.
+            streamed = list(runner.iterate([cube, badCube, cube], memoryBudget=1, failures=failures))
+        assert len(streamed) == 2
+        for warnings, results, md in streamed:
+            assert np.allclose(pwsAnalysis.results.rms, results.rms, equal_nan=True)
+        assert len(failures) == 1
+        assert failures[0].index == 1
+        assert failures[0].metadata is cube.metadata
+
     @pytest.mark.parametrize('extraReflection', [None, erMeta])
     def test_dynamics_analysis(self, dynamicsData, extraReflection):
         """Test that dynamics data can be analyzed, results can be loaded"""
@@ -67,6 +206,45 @@ class TestAnalysis:
         assert isinstance(result.meanReflectance, np.ndarray)
         assert isinstance(result.reflectance, pwsdt.DynCube)
 
+    def test_dynamics_diffusion(self):
+        """Test that the diffusion calculated without masked arrays matches the original masked regression with `np.polyfit`, for an even number of time points."""
+        rng = np.random.default_rng(0)
+
+        def dynCube(amplitude):
+            md = pwsdt.DynMetaData({'system': 'test', 'time': '01-01-2020 01:01:01', 'exposure': 20.0, 'pixelSizeUm': None,
+                                    'binning': 1, 'wavelength': 550, 'times': [i * 20.0 for i in range(100)]})
+            data = rng.standard_normal((12, 13, 100))
+            correlation = rng.uniform(0, .95, (12, 13))  # Correlated noise with a different time constant for each pixel.
+            for i in range(1, data.shape[2]):
+                data[:, :, i] += correlation * data[:, :, i - 1]
+            return pwsdt.DynCube((1000 + amplitude * rng.random((12, 13, 1)) * data).astype(np.float32), md)
+
+        settings = analysis.dynamics.DynamicsAnalysisSettings(extraReflectanceId=None, referenceMaterial=None, numericalAperture=0.52,
+                                                              relativeUnits=True, cameraCorrection=pwsdt.CameraCorrection(100, None))
+        anls = analysis.dynamics.DynamicsAnalysis(settings, None, dynCube(30))
+        cube = dynCube(80)
+        results, warnings = anls.run(cube)
+
+        # The original implementation, using masked arrays and fitting only the valid pixels.
+        cubeAc = np.ma.array(cube.getAutocorrelation(maxLag=settings.diffusionRegressionLength))
+        cubeAc[cubeAc.data[:, :, 0] < np.sqrt(2) * anls.refAc[0]] = np.ma.masked
+        ac = np.ma.array(cubeAc - anls.refAc)
+        ac = ac / ac[:, :, 0][:, :, None]
+        ac[np.any(ac <= 0, axis=2)] = np.ma.masked
+        dt = (cube.times[-1] - cube.times[0]) / (len(cube.times) - 1) / 1e3
+        k = (anls.n_medium * 2 * np.pi) / (cube.metadata.wavelength / 1e3)
+        with np.errstate(invalid='ignore'):  # The logarithm of masked values is excluded from the fit.
+            val = (np.log(ac) / (4 * k ** 2)).reshape((-1, ac.shape[2]))
+        valid = ~np.ma.getmaskarray(val)[:, 0]
+        t = np.arange(ac.shape[2]) * dt
+        expected = np.zeros(valid.shape)
+        expected[valid] = -np.polyfit(t, val.data[valid].T, deg=1)[0]
+
+        diffusion = results.diffusion
+        assert 0 < valid.sum() < valid.size  # Make sure that both valid and invalid pixels are tested.
+        assert np.array_equal(np.ma.getmaskarray(diffusion).ravel(), ~valid)
+        assert np.allclose(np.ma.getdata(diffusion).ravel()[valid], expected[valid], rtol=1e-4)
+
     def test_compilation(self, dynamicsData):
         """Test that ROIs and PWS/Dynamics analysis results can be successfully `compiled` into a data table."""
         settings = analysis.compilation.GenericCompilerSettings(roiArea=True)
@@ -89,4 +267,19 @@ class TestAnalysis:
 
             print(f"Successfully Compiled {len(results)} ROIs for general, PWS, and dynamics analysis.")
 
+    def test_batch_compilation(self, dynamicsData):
+        """Test that compiling all ROIs of an acquisition at once gives the same values as compiling them one at a time."""
+        settings = analysis.compilation.PWSCompilerSettings(reflectance=True, rms=True, polynomialRms=True, autoCorrelationSlope=True,
+                                                            rSquared=True, ld=True, opd=True, meanSigmaRatio=True)
+        pwsComp = analysis.compilation.PWSRoiCompiler(settings)
 
+        acq = pwsdt.Acquisition(dynamicsData.datasetPath / 'Cell1')
+        result = acq.pws.loadAnalysis(_analysisName)
+        rois = [acq.loadRoi(*roiSpecs).getRoi() for roiSpecs in acq.getRois()]
+        batch = pwsComp.runBatch(result, rois)
+        assert len(batch) == len(rois)
+        for roi, (batchResult, batchWarns) in zip(rois, batch):
+            singleResult, singleWarns = pwsComp.run(result, roi)
+            for field in ['reflectance', 'rms', 'polynomialRms', 'autoCorrelationSlope', 'rSquared', 'ld', 'varRatio', 'opd']:
+                assert np.allclose(getattr(singleResult, field), getattr(batchResult, field), rtol=1e-4, equal_nan=True)
+            assert len(singleWarns) == len(batchWarns)
@@ -0,0 +1,177 @@
+import os
+import pytest
+import numpy as np
+import scipy.interpolate as spi
+import tifffile as tf
+import pwspy.dataTypes as pwsdt
+from pwspy.dataTypes._data import _WavenumberResampler
+
+
+class TestMetadataIndex:
+    def test_metadata_index(self, dynamicsData):
+        """Test that acquisitions loaded from the metadata index match the acquisitions loaded from the original files."""
+        indexPath = dynamicsData.datasetPath / pwsdt.MetadataIndex.FILENAME
+        if indexPath.exists():
+            os.remove(indexPath)
+        cellPaths = sorted(dynamicsData.datasetPath.glob("Cell[0-9]*"))
+        try:
+            with pwsdt.MetadataIndex(dynamicsData.datasetPath) as index:
+                for path in cellPaths:
+                    index.getAcquisition(path)
+            assert indexPath.exists()
+
+            index = pwsdt.MetadataIndex(dynamicsData.datasetPath)
+            assert len(index) == len(cellPaths)
+            for path in cellPaths:
+                acq = pwsdt.Acquisition(path)
+                cached = index.getAcquisition(path)
+                assert cached.filePath == acq.filePath
+                assert cached.idTag == acq.idTag
+                assert (cached.pws is None) == (acq.pws is None)
+                if acq.pws is not None:
+                    assert cached.pws.fileFormat == acq.pws.fileFormat
+                    assert cached.pws.wavelengths == acq.pws.wavelengths
+                    assert index.getAnalyses(path)['pws'] == acq.pws.getAnalyses()
+                assert (cached.dynamics is None) == (acq.dynamics is None)
+                assert len(cached.fluorescence) == len(acq.fluorescence)
+                assert index.getRois(path) == acq.getRois()
+        finally:
+            if indexPath.exists():
+                os.remove(indexPath)
+
+
+class TestDynCube:
+    def test_truncated_autocorrelation(self, dynamicsData):
+        """Test that calculating only the first few lags of the ACF matches the full ACF calculated with fourier transforms."""
+        acq = pwsdt.Acquisition(dynamicsData.datasetPath / 'Cell1')
+        cube = acq.dynamics.toDataClass()
+        full = cube.getAutocorrelation()
+        for maxLag in [0, 3]:
+            truncated = cube.getAutocorrelation(maxLag=maxLag)
+            assert truncated.shape == cube.data.shape[:2] + (maxLag + 1,)
+            assert np.allclose(truncated, full[:, :, :maxLag + 1], rtol=1e-4, atol=1e-6 * np.abs(full).max())
+
+    @pytest.mark.parametrize('nt', [100, 101])
+    def test_autocorrelation_length(self, nt):
+        """Test that the ACF has one lag per time point and matches the circular ACF, for both even and odd lengths."""
+        md = pwsdt.DynMetaData({'system': 'test', 'time': '01-01-2020 01:01:01', 'exposure': 20.0, 'pixelSizeUm': None,
+                                'binning': 1, 'wavelength': 550, 'times': [i * 20.0 for i in range(nt)]})
+        data = np.random.default_rng(0).standard_normal((4, 5, nt))
+        acf = pwsdt.DynCube(data, md).getAutocorrelation()
+        assert acf.shape == data.shape
+        data = data - data.mean(axis=2)[:, :, None]
+        expected = np.stack([(data * np.roll(data, -lag, axis=2)).mean(axis=2) for lag in range(nt)], axis=2)
+        assert np.allclose(acf, expected)
+
+
+def _baselineAutoCorrelation(data: np.ndarray, wavenumbers, isAutocorrMinSub: bool, stopIndex: int):
+    """The original implementation of `KCube.getAutoCorrelation`, used as a reference. Returns the slope and R^2."""
+    fftSize = int(2 ** (np.ceil(np.log2((2 * len(wavenumbers)) - 1))))
+    acf = np.fft.irfft(np.abs(np.fft.rfft(data, n=fftSize, axis=2)) ** 2, axis=2)[:, :, :len(wavenumbers)]
+    acf /= acf[:, :, 0, np.newaxis]
+    if isAutocorrMinSub:
+        acf -= acf.min()
+    lagsSquared = ((np.array(wavenumbers) - min(wavenumbers)) ** 2)[:stopIndex]
+    logAcf = np.log(acf[:, :, :stopIndex]).reshape((-1, stopIndex)).T
+    V = np.stack([np.ones(lagsSquared.shape), lagsSquared]).T
+    linear = V @ np.linalg.pinv(V) @ logAcf
+    slope = (linear[1] - linear[0]) / (lagsSquared[1] - lagsSquared[0])
+    ssReg = ((linear - logAcf.mean(axis=0)) ** 2).sum(axis=0)
+    ssErr = ((logAcf - linear) ** 2).sum(axis=0)
+    return slope.reshape(data.shape[:2]), (ssReg / (ssReg + ssErr)).reshape(data.shape[:2])
+
+
+class TestKCube:
+    wavelengths = tuple(float(wv) for wv in range(500, 701, 2))
+
+    def test_wavenumber_resampling(self):
+        """Test that resampling to evenly spaced wavenumbers matches linear interpolation with `interp1d`, including when writing in place."""
+        data = np.random.default_rng(0).random((6, 7, len(self.wavelengths)))
+        wavenumbers = (2 * np.pi) / (np.array(self.wavelengths) * 1e-3)[::-1]
+        evenWavenumbers = np.linspace(wavenumbers[0], wavenumbers[-1], num=len(wavenumbers))
+        expected = spi.interp1d(wavenumbers, data[:, :, ::-1], kind='linear', axis=2)(evenWavenumbers)
+        resampled, resampledWavenumbers = pwsdt.KCube._wavelengthToWavenumberData(data, self.wavelengths)
+        assert np.allclose(resampled, expected)
+        assert np.allclose(resampledWavenumbers, evenWavenumbers)
+        resampler = _WavenumberResampler.fromWavelengths(self.wavelengths)
+        data = data.astype(np.float32)
+        assert resampler.apply(data, out=data) is data
+        assert np.allclose(data, expected, atol=1e-6)
+
+    @pytest.mark.parametrize('isAutocorrMinSub', [False, True])
+    @pytest.mark.parametrize('useDirectSum', [None, False])
+    def test_autocorrelation_fit(self, isAutocorrMinSub, useDirectSum):
+        """Test that the autocorrelation slope and R^2 match the original FFT and least-squares implementation."""
+        rng = np.random.default_rng(0)
+        wavenumbers = _WavenumberResampler.fromWavelengths(self.wavelengths).wavenumbers
+        k = np.array(wavenumbers)[None, None, :]
+        data = np.cos(rng.uniform(2, 6, (6, 7, 1)) * k + rng.uniform(0, 2 * np.pi, (6, 7, 1))) + 0.3 * rng.standard_normal((6, 7, k.shape[2]))
+        data = data.astype(np.float32)
+        slope, rSquared = pwsdt.KCube(data, wavenumbers).getAutoCorrelation(isAutocorrMinSub, 7, useDirectSum=useDirectSum)
+        expectedSlope, expectedRSquared = _baselineAutoCorrelation(data, wavenumbers, isAutocorrMinSub, 7)
+        assert np.allclose(slope, expectedSlope, rtol=1e-5)
+        assert np.allclose(rSquared, expectedRSquared, atol=1e-6)
+
+
+class TestPwsCube:
+    wavelengths = tuple(float(wv) for wv in range(500, 701, 4))
+
+    def _metadata(self, ny: int, nx: int) -> pwsdt.PwsMetaData:
+        return pwsdt.PwsMetaData({'system': 'test', 'time': '01-01-2020 01:01:01', 'exposure': 50.0, 'pixelSizeUm': None,
+                                  'binning': 1, 'wavelengths': list(self.wavelengths), 'imgHeight': ny, 'imgWidth': nx})
+
+    def test_memory_mapped(self, tmp_path):
+        """Test that a memory mapped raw `image_cube` with deferred corrections matches the eagerly loaded data."""
+        data = np.random.default_rng(0).integers(1000, 5000, (20, 15, len(self.wavelengths)), dtype=np.uint16)
+        data.ravel(order='F').tofile(tmp_path / 'image_cube')
+        md = self._metadata(*data.shape[:2])
+        eager = pwsdt.PwsCube.fromOldPWS(tmp_path, md)
+        lazy = pwsdt.PwsCube.fromOldPWS(tmp_path, md, memoryMap=True)
+        assert np.array_equal(eager.data, data)
+        for cube in [eager, lazy]:
+            cube.correctCameraEffects(pwsdt.CameraCorrection(100, None))
+            cube.normalizeByExposure()
+        assert lazy._pendingOperations is not None  # The corrections have been deferred rather than applied.
+        region = (slice(3, 12), slice(2, 9))
+        assert np.array_equal(lazy[region], eager.data[region])
+        mask = np.zeros(data.shape[:2], dtype=bool)
+        mask[5:15, 4:10] = True
+        assert np.allclose(lazy.getMeanSpectra(mask)[0], eager.getMeanSpectra(mask)[0])
+        assert lazy._pendingOperations is not None  # Reading a region doesn't load the whole array.
+        assert np.array_equal(lazy.data, eager.data)
+        assert lazy._pendingOperations is None
+
+    @pytest.mark.parametrize('pagesPerBlock', [32, 7])
+    def test_read_tiff_pages(self, tmp_path, monkeypatch, pagesPerBlock):
+        """Test that streaming the pages of a tiff file into a (Y, X, lambda) array matches reading it all at once, with and without `out`."""
+        monkeypatch.setattr(pwsdt.ICRawBase, '_tiffPagesPerBlock', pagesPerBlock)  # 7 doesn't evenly divide the number of pages.
+        data = np.random.default_rng(0).integers(0, 2**16, (len(self.wavelengths), 20, 15), dtype=np.uint16)
+        tf.imwrite(tmp_path / 'pws.tif', data)
+        expected = np.moveaxis(tf.imread(tmp_path / 'pws.tif'), 0, 2).astype(np.float32)
+        md = self._metadata(*expected.shape[:2])
+        assert np.array_equal(pwsdt.PwsCube.fromTiff(tmp_path, md).data, expected)
+        out = np.empty(expected.shape, dtype=np.float32)
+        cube = pwsdt.PwsCube.fromTiff(tmp_path, md, out=out)
+        assert cube.data is out
+        assert np.array_equal(out, expected)
+        with pytest.raises(ValueError):
+            pwsdt.PwsCube.fromTiff(tmp_path, md, out=np.empty((20, 15, 3), dtype=np.float32))
+
+
+class TestFixedPoint:
+    def test_fixed_point_codec(self, dynamicsData, tmp_path):
+        """Test that data saved with per-tile fixed point scaling can be loaded, in full and by region."""
+        import h5py
+        acq = pwsdt.Acquisition(dynamicsData.datasetPath / 'Cell1')
+        cube = acq.pws.toDataClass()
+        with h5py.File(tmp_path / 'fp.h5', 'w') as hf:
+            cube.toHdfDataset(hf, 'global')
+            cube.toHdfDataset(hf, 'tiled', fixedPointCompression=pwsdt.FixedPointCodec(perTile=True))
+        with h5py.File(tmp_path / 'fp.h5', 'r') as hf:
+            dataRange = np.nanmax(cube.data) - np.nanmin(cube.data)
+            for name in ['global', 'tiled']:
+                data = pwsdt.PwsCube.fromHdfDataset(hf[name]).data
+                assert np.nanmax(np.abs(data - cube.data)) <= 1.01 * dataRange / (2**16 - 1)  # At most about 1 step of the 16 bit scale.
+            region = (slice(10, 100), slice(50, 150))
+            tiled = pwsdt.PwsCube.decodeHdf(hf['tiled'])[0]
+            assert np.array_equal(pwsdt.ICBase._decodeHdfData(hf['tiled'], region), tiled[region], equal_nan=True)
@@ -17,3 +17,35 @@ def test_roi(sequenceData):
             assert isinstance(roi.verts, np.ndarray)
             assert len(roi.verts.shape) == 2
             assert roi.verts.shape[1] == 2
+
+
+def test_cropped_roi(dynamicsData):
+    """Test that the cropped masks of the ROIs and the label image match the full size masks."""
+    acq = pwsdt.Acquisition(dynamicsData.datasetPath / 'Cell1')
+    rois = acq.getRois()
+    for name, num, fformat in rois:
+        roi = acq.loadRoi(name, num, fformat).getRoi()
+        mask = roi.mask
+        assert mask.shape == roi.shape
+        assert mask.sum() == roi.croppedMask.sum()
+        assert np.array_equal(mask[roi.getBoundingBox()], roi.croppedMask)
+    name = rois[0][0]
+    labels = acq.getRoiLabelImage(name)
+    image = np.random.default_rng(0).random(labels.labels.shape)
+    means = labels.mean(image)
+    for i, num in enumerate(labels.numbers):
+        roi = acq.loadRoi(name, num).getRoi()
+        assert np.isclose(means[i], image[roi.mask].mean())
+
+
+def test_bulk_load(dynamicsData):
+    """Test that loading all ROIs at once gives the same ROIs as loading them one at a time."""
+    acq = pwsdt.Acquisition(dynamicsData.datasetPath / 'Cell1')
+    bulk = acq.loadAllRois()
+    specs = acq.getRois()
+    assert len(bulk) == len(specs)
+    for roiFile, (name, num, fformat) in zip(bulk, specs):
+        single = acq.loadRoi(name, num, fformat)
+        assert (roiFile.name, roiFile.number, roiFile.fformat) == (name, num, fformat)
+        assert np.array_equal(roiFile.getRoi().mask, single.getRoi().mask)
+    pwsdt.RoiFile.clearFileCache()
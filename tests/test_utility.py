@@ -1,5 +1,15 @@
-from pwspy.utility.acquisition import loadDirectory, PositionsStep
+import os
+import functools
+import operator
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.interpolate as spi
+import pwspy.dataTypes as pwsdt
+from pwspy.utility.acquisition import loadDirectory, PositionsStep, AcquisitionScanner
 from pwspy.utility.micromanager import PositionList
+from pwspy.utility.reflection import Material, extraReflectance, reflectanceHelper
+from pwspy.utility.reflection.multilayerReflectanceEngine import Stack, Layer, Polarization
 
 
 class TestSequence:
@@ -24,3 +34,119 @@ class TestSequence:
         for acq in acqs:
             iterationNum = acq.sequencerCoordinate.getStepIteration(multiplePosStep)
             print(posList[iterationNum])
+
+
+class TestAcquisitionScanner:
+    def test_scanner(self, sequenceData):
+        """Test that the concurrent scanner finds the same acquisitions as a recursive glob."""
+        expected = sorted(str(p) for p in sequenceData.datasetPath.glob('**/Cell[0-9]*') if p.is_dir())
+        scanner = AcquisitionScanner(numThreads=4)
+        found = sorted(acq.filePath for acq in scanner.scan(sequenceData.datasetPath))
+        assert found == sorted(os.path.abspath(p) for p in expected if p not in [f.path for f in scanner.report.failures])
+        assert scanner.report.acquisitionsFound == len(found)
+        print(f"Found {len(found)} acquisitions in {scanner.report.elapsed:.2f} seconds.")
+
+    def test_scanner_list_error(self, tmp_path, monkeypatch):
+        """Test that a directory that can't be listed is reported as a failure rather than ending the scan."""
+        for name in ['a/Cell1', 'a/Cell2', 'b/Cell3']:
+            (tmp_path / name).mkdir(parents=True)
+        scandir = os.scandir
+
+        def failingScandir(path):
+            if os.path.basename(path) == 'b':
+                raise OSError("Simulated network error.")
+            return scandir(path)
+        monkeypatch.setattr(os, 'scandir', failingScandir)
+        scanner = AcquisitionScanner(numThreads=2, preload=False)
+        list(scanner.scan(tmp_path))
+        # The empty acquisition directories fail to load, but the scan still reaches them. `b` couldn't be searched.
+        failures = {os.path.relpath(f.path, tmp_path): f.exception for f in scanner.report.failures}
+        assert sorted(failures) == ['a/Cell1'.replace('/', os.sep), 'a/Cell2'.replace('/', os.sep), 'b']
+        assert str(failures['b']) == "Simulated network error."
+
+
+class TestStack:
+    def test_batch_reflectance(self):
+        """Test that the batched reflectance calculation matches calculating the reflectance of each stack separately."""
+        wavelengths = np.arange(500., 701, 10)
+        NAs = np.linspace(0, .5, 6)
+        materials = [Material.Glass, 1.45, Material.Water, 1.38, Material.Air]
+        thicknesses = np.random.default_rng(0).uniform(50, 2000, (4, len(materials)))
+        stack = Stack(wavelengths, [Layer(m, 1) for m in materials])
+        batch = stack.calculateReflectanceBatch(NAs, thicknesses)
+        batch32 = stack.calculateReflectanceBatch(NAs, thicknesses, dtype=np.float32)
+        for i, t in enumerate(thicknesses):
+            single = Stack(wavelengths, [Layer(m, d) for m, d in zip(materials, t)]).calculateReflectance(NAs)
+            for polarization in Polarization:
+                assert batch[polarization].shape == (len(thicknesses), len(wavelengths), len(NAs))
+                assert np.allclose(batch[polarization][i], single[polarization], rtol=0, atol=1e-12)
+                assert batch32[polarization].dtype == np.float32
+                assert np.allclose(batch32[polarization][i], single[polarization], rtol=0, atol=1e-5)
+
+
+def _baselineRExtra(allCombos, theoryR):
+    """The original implementation of `generateRExtraCubes`, which kept every cube in memory and averaged them with `reduce`."""
+    add = functools.partial(functools.reduce, operator.add)
+    rExtra, rExtraWeight = {}, {}
+    for matCombo, combos in allCombos.items():
+        erCubes, weights = [], []
+        for combo in combos:
+            data1, data2 = combo.data1.data, combo.data2.data
+            T1 = np.array(theoryR[combo.mat1])[None, None, :]
+            T2 = np.array(theoryR[combo.mat2])[None, None, :]
+            arr = (T1 * data2 - T2 * data1) / (data1 - data2)
+            arr[~np.isfinite(arr)] = 0
+            erCubes.append(np.clip(arr, 0, 1))
+            weights.append((data1 - data2) ** 2 / (data1 ** 2 + data2 ** 2))
+        weightSum = add(weights)
+        rExtra[matCombo] = add([cube * weight for cube, weight in zip(erCubes, weights)]) / weightSum
+        rExtraWeight[matCombo] = weightSum / len(weights)
+    weightedMean = add([rExtra[key] * rExtraWeight[key] for key in rExtra]) / add(rExtraWeight.values())
+    return weightedMean, rExtra
+
+
+class TestExtraReflectance:
+    @pytest.mark.parametrize('numWorkers', [1, 3])
+    def test_generate_rextra_cubes(self, numWorkers):
+        """Test that the streamed weighted average matches the original implementation, including when the combos are split between threads."""
+        rng = np.random.default_rng(0)
+        wavelengths = tuple(range(500, 701, 10))
+        md = pwsdt.PwsMetaData({'system': 'test', 'time': '01-01-2020 01:01:01', 'exposure': 50.0, 'pixelSizeUm': None,
+                                'binning': 1, 'wavelengths': list(wavelengths)})
+        materials = [Material.Air, Material.Water, Material.Ethanol]
+        theoryR = {mat: pd.Series(rng.uniform(0.002, 0.05, len(wavelengths)), index=wavelengths) for mat in materials}
+        trueRExtra = rng.uniform(0.001, 0.01, (8, 9, len(wavelengths)))
+        cubes = {mat: [pwsdt.PwsCube(1e4 * (theoryR[mat].values + trueRExtra) * rng.uniform(0.9, 1.1, (8, 9, 1))
+                                     + rng.normal(0, 5, trueRExtra.shape), md) for i in range(2)] for mat in materials}
+        allCombos = extraReflectance.getAllCubeCombos(extraReflectance.generateMaterialCombos(materials), cubes)
+        erCube, rExtra = extraReflectance.generateRExtraCubes(allCombos, theoryR, 0.52, numWorkers=numWorkers)
+        expected, expectedRExtra = _baselineRExtra(allCombos, theoryR)
+        assert np.allclose(erCube.data, expected, rtol=1e-5, atol=1e-9)
+        for matCombo in allCombos:
+            assert np.allclose(rExtra[matCombo], expectedRExtra[matCombo], rtol=1e-5, atol=1e-9)
+
+
+class TestReflectanceHelper:
+    def test_refractive_index(self):
+        """Test that interpolating the refractive index matches the original `griddata` implementation, including outside the range of the data."""
+        for mat in [Material.Water, Material.Glass, Material.Ethanol, Material.Glycerol_99_5]:
+            table = reflectanceHelper.getRefractiveIndex(mat)
+            wavelengths = np.concatenate([[table.index.min() - 10], np.linspace(table.index.min(), table.index.max(), num=57), [table.index.max() + 10]])
+            expected = spi.griddata(table.index.values, table.values, wavelengths)
+            result = reflectanceHelper.getRefractiveIndex(mat, wavelengths)
+            assert np.array_equal(result.index, wavelengths)
+            assert np.isnan(result.values[[0, -1]]).all()
+            assert np.allclose(result.values, expected, equal_nan=True)
+
+    def test_cached_reflectance(self):
+        """Test that the cached reflectance can't be modified by the caller and matches the uncached calculation."""
+        wavelengths = np.arange(500, 701, 20)
+        r = reflectanceHelper.getReflectance(Material.Glass, Material.Water, wavelengths, NA=0.52)
+        expected = reflectanceHelper._calculateReflectance(Material.Glass, Material.Water, wavelengths, 0.52)
+        assert np.allclose(r, expected)
+        r[:] = 0
+        r.index = r.index + 1
+        again = reflectanceHelper.getReflectance(Material.Glass, Material.Water, wavelengths, NA=0.52)
+        assert np.allclose(again, expected)
+        assert np.array_equal(again.index, expected.index)
+        assert np.allclose(reflectanceHelper.getReflectance(Material.Glass, Material.Water, list(wavelengths), NA=0.52), expected)